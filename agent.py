@@ -100,11 +100,15 @@ class Agent(Daemon):
         # if no check was given, reload them all
         if not checks_to_reload:
             log.debug("No check list was passed, reloading every check")
-            # stop checks
-            for check in self._checksd.get('initialized_checks', []):
-                check.stop()
-
-            self._checksd = load_check_directory(self._agentConfig, hostname)
+            previous_checks = self._checksd.get('initialized_checks', [])
+            # the checks whose code and config didn't change are kept as is
+            self._checksd = load_check_directory(self._agentConfig, hostname, previous_checks=previous_checks)
+
+            # stop the checks that were replaced or removed
+            kept_checks = set(self._checksd['initialized_checks'])
+            for check in previous_checks:
+                if check not in kept_checks:
+                    check.stop()
         else:
             new_checksd = copy(self._checksd)
 
@@ -133,17 +137,21 @@ class Agent(Daemon):
         """
         for check_name in checks:
             idx = None
+            previous_check = None
             for num, check in enumerate(checksd['initialized_checks']):
                 if check.name == check_name:
                     idx = num
-                    # stop the existing check before reloading it
-                    check.stop()
+                    previous_check = check
 
             if not idx and check_name in checksd['init_failed_checks']:
                 # if the check previously failed to load, pop it from init_failed_checks
                 checksd['init_failed_checks'].pop(check_name)
 
-            fresh_check = load_check(self._agentConfig, hostname, check_name)
+            fresh_check = load_check(self._agentConfig, hostname, check_name, previous_check=previous_check)
+
+            # stop the existing check if it was replaced or removed
+            if previous_check is not None and fresh_check is not previous_check:
+                previous_check.stop()
 
             # this is an error dict
             # checks that failed to load are added to init_failed_checks
@@ -190,7 +198,8 @@ class Agent(Daemon):
         # A SIGHUP signals a configuration reload
         signal.signal(signal.SIGHUP, self._handle_sighup)
 
-        # Save the agent start-up stats.
+        # Serve the collector status from memory, and save the start-up stats.
+        CollectorStatus.serve_status()
         CollectorStatus().persist()
 
         # Intialize the collector.
@@ -1,9 +1,14 @@
 # stdlib
+from itertools import islice
 import logging
+import re
+import sys
+import threading
 from time import time
 
 # project
 from checks.metric_types import MetricTypes
+from utils.sketch import DDSketch, DEFAULT_RELATIVE_ACCURACY, TopK
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +24,22 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Number of distinct raw tag strings whose parsed form is kept around.
+TAG_CACHE_SIZE = 10000
+
+# Number of contexts looked at to estimate the memory used per context.
+CONTEXT_STATS_SAMPLE_SIZE = 1000
+
+# Metric names and tag keys tracked to find the ones creating the most
+# contexts, and how many of them get reported.
+CONTEXT_TOP_K_CAPACITY = 100
+CONTEXT_TOP_K = 10
+
+# Single-value metric packet: <name>:<value>|<type>[|@<sample_rate>][|#<tags>]
+# Anything else (multi-value packets, tags before the sample rate) goes through
+# `Aggregator.parse_metric_packet`, which also splits datums on `:`.
+METRIC_PACKET_RE = re.compile(r'^([^:|]+):([^:|]+)\|([a-z]+)(?:\|@([^:|]*))?(?:\|#([^|]*))?$')
+
 
 class Infinity(Exception):
     pass
@@ -28,11 +49,163 @@ class UnknownValue(Exception):
     pass
 
 
+class MetricContext(object):
+    """
+    An interned metric context, shared by all the metric objects aggregated
+    for it (one per bucket in the MetricsBucketAggregator).
+    `key` is (name, sorted and deduped tags, hostname, device_name), `tags`
+    are the ones reported with the metric.
+    """
+    __slots__ = ('id', 'key', 'tags')
+
+    def __init__(self, context_id, key, tags):
+        self.id = context_id
+        self.key = key
+        self.tags = tags
+
+    @property
+    def name(self):
+        return self.key[0]
+
+    @property
+    def hostname(self):
+        return self.key[2]
+
+    @property
+    def device_name(self):
+        return self.key[3]
+
+    def memory_usage(self):
+        """ Approximate size in bytes of the context and of its key. """
+        size = sys.getsizeof(self) + sys.getsizeof(self.key) + sys.getsizeof(self.key[1])
+        if self.tags is not None and self.tags is not self.key[1]:
+            size += sys.getsizeof(self.tags)
+        return size
+
+
+class ContextTable(object):
+    """
+    The contexts known to an aggregator, interned once and referenced by
+    small integer ids. Ids of released contexts get reused.
+
+    New contexts are limited to `context_limit` live contexts overall and
+    `context_limit_per_metric` per metric name. Past a limit, samples are
+    folded into the overflow series of their metric (same name, reported
+    from `overflow_hostname` with no tags nor device), which is always allowed.
+    The metric names and tag keys creating the most contexts are tracked.
+    """
+
+    def __init__(self, context_limit=None, context_limit_per_metric=None, overflow_hostname=None):
+        self.by_key = {}
+        self.by_id = []
+        self.free_ids = []
+        self.context_limit = context_limit
+        self.context_limit_per_metric = context_limit_per_metric
+        self.overflow_hostname = overflow_hostname
+        self.count_by_name = {}
+        # Samples folded into an overflow series since the start
+        self.overflow_count = 0
+        self.top_metrics = TopK(CONTEXT_TOP_K_CAPACITY)
+        self.top_tag_keys = TopK(CONTEXT_TOP_K_CAPACITY)
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def intern(self, key, tags=None, limited=True):
+        """
+        Return the MetricContext of `key`, creating it if needed.
+        `tags` are the ones to report for a new context, default to the key's.
+        `limited` is False for contexts exempt from the limits.
+        """
+        context = self.by_key.get(key)
+        if context is None and not limited:
+            context = self._create(key, tags)
+        elif context is None:
+            name = key[0]
+            self.top_metrics.offer(name)
+            for tag in key[1]:
+                self.top_tag_keys.offer(tag.split(':', 1)[0])
+
+            overflow_key = (name, (), self.overflow_hostname, None)
+            if key != overflow_key and self._over_limit(name):
+                self.overflow_count += 1
+                context = self.by_key.get(overflow_key)
+                if context is None:
+                    context = self._create(overflow_key, None)
+            else:
+                context = self._create(key, tags)
+        return context
+
+    def _over_limit(self, name):
+        if self.context_limit and len(self.by_key) >= self.context_limit:
+            return True
+        if self.context_limit_per_metric and self.count_by_name.get(name, 0) >= self.context_limit_per_metric:
+            return True
+        return False
+
+    def _create(self, key, tags):
+        if self.free_ids:
+            context_id = self.free_ids.pop()
+        else:
+            context_id = len(self.by_id)
+            self.by_id.append(None)
+        context = MetricContext(context_id, key, tags or key[1] or None)
+        self.by_key[key] = context
+        self.by_id[context_id] = context
+        self.count_by_name[key[0]] = self.count_by_name.get(key[0], 0) + 1
+        return context
+
+    def get(self, context_id):
+        return self.by_id[context_id]
+
+    def release(self, context_id):
+        context = self.by_id[context_id]
+        if context is not None:
+            del self.by_key[context.key]
+            self.by_id[context_id] = None
+            self.free_ids.append(context_id)
+            name = context.key[0]
+            if self.count_by_name[name] > 1:
+                self.count_by_name[name] -= 1
+            else:
+                del self.count_by_name[name]
+
+    def memory_usage(self):
+        """ Approximate size in bytes of the table itself, without the contexts. """
+        return sys.getsizeof(self.by_key) + sys.getsizeof(self.by_id) + sys.getsizeof(self.free_ids) + \
+            sys.getsizeof(self.count_by_name)
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    Metric objects only hold their values: the name, tags, hostname and
+    device_name come from the shared MetricContext.
     """
+    __slots__ = ('formatter', 'context', 'last_sample_time')
+
+    def __init__(self, formatter, context, extra_config=None):
+        self.formatter = formatter
+        self.context = context
+        self.last_sample_time = None
+
+    @property
+    def name(self):
+        return self.context.key[0]
+
+    @property
+    def tags(self):
+        return self.context.tags
+
+    @property
+    def hostname(self):
+        return self.context.key[2]
+
+    @property
+    def device_name(self):
+        return self.context.key[3]
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -42,18 +215,32 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def get_partial(self):
+        """ Return the picklable state aggregated so far, to be merged elsewhere. """
+        raise NotImplementedError()
+
+    def merge_partial(self, partial):
+        """ Merge a state returned by `get_partial` into this metric. """
+        raise NotImplementedError()
+
+    def memory_usage(self):
+        """ Approximate size in bytes of the metric and of its value store. """
+        size = sys.getsizeof(self)
+        for cls in type(self).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                value = getattr(self, slot, None)
+                if isinstance(value, (list, set)):
+                    size += sys.getsizeof(value)
+        return size
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Gauge, self).__init__(formatter, context)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
         self.timestamp = time()
 
     def sample(self, value, sample_rate, timestamp=None):
@@ -61,6 +248,18 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def get_partial(self):
+        return (self.value, self.last_sample_time, self.timestamp)
+
+    def merge_partial(self, partial):
+        # Last value wins
+        value, last_sample_time, timestamp = partial
+        if value is None:
+            return
+        if self.value is None or last_sample_time >= self.last_sample_time:
+            self.value = value
+            self.last_sample_time = last_sample_time
+            self.timestamp = timestamp
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -86,6 +285,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -107,15 +307,11 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Count, self).__init__(formatter, context)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value = (self.value or 0) + value
@@ -139,17 +335,13 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def __init__(self, formatter, context, extra_config=None):
+        super(MonotonicCount, self).__init__(formatter, context)
         self.prev_counter = None
         self.curr_counter = None
         self.count = None
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         if self.curr_counter is None:
@@ -187,20 +379,24 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Counter, self).__init__(formatter, context)
         self.value = 0
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def get_partial(self):
+        return (self.value, self.last_sample_time)
+
+    def merge_partial(self, partial):
+        value, last_sample_time = partial
+        self.value += value
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -222,10 +418,10 @@ DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Histogram, self).__init__(formatter, context)
         self.count = 0
         self.samples = []
         self.aggregates = extra_config['aggregates'] if\
@@ -234,20 +430,23 @@ class Histogram(Metric):
         self.percentiles = extra_config['percentiles'] if\
             extra_config is not None and extra_config.get('percentiles') is not None\
             else DEFAULT_HISTOGRAM_PERCENTILES
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
         self.samples.append(value)
         self.last_sample_time = time()
 
-    def flush(self, ts, interval):
-        if not self.count:
-            return []
+    def get_partial(self):
+        return (self.count, self.samples, self.last_sample_time)
 
+    def merge_partial(self, partial):
+        count, samples, last_sample_time = partial
+        self.count += count
+        self.samples.extend(samples)
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
+    def _rollup(self):
+        """ Return min, max, median, sum, avg and the configured percentiles, and reset the samples. """
         self.samples.sort()
         length = len(self.samples)
 
@@ -256,6 +455,16 @@ class Histogram(Metric):
         med = self.samples[int(round(length/2 - 1))]
         sum_ = sum(self.samples)
         avg = sum_ / float(length)
+        percentile_values = [self.samples[int(round(p * length - 1))] for p in self.percentiles]
+
+        self.samples = []
+        return min_, max_, med, sum_, avg, percentile_values
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        min_, max_, med, sum_, avg, percentile_values = self._rollup()
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -283,8 +492,7 @@ class Histogram(Metric):
             interval=interval) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in zip(self.percentiles, percentile_values):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -297,28 +505,75 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
         self.count = 0
 
         return metrics
 
 
+class SketchHistogram(Histogram):
+    """
+    A Histogram that folds samples into a bounded-memory, mergeable DDSketch
+    instead of keeping them all. min, max, sum, avg and count are exact;
+    median and percentiles are within `relative_accuracy` of the exact ones.
+    """
+    __slots__ = ('relative_accuracy', 'sketch')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, context, extra_config)
+        self.samples = None
+        self.relative_accuracy = extra_config['relative_accuracy'] if\
+            extra_config is not None and extra_config.get('relative_accuracy') is not None\
+            else DEFAULT_RELATIVE_ACCURACY
+        self.sketch = DDSketch(self.relative_accuracy)
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        self.last_sample_time = time()
+
+    def get_partial(self):
+        return (self.count, self.sketch, self.last_sample_time)
+
+    def merge_partial(self, partial):
+        count, sketch, last_sample_time = partial
+        self.count += count
+        self.sketch.merge(sketch)
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
+    def _rollup(self):
+        sketch = self.sketch
+        # Same ranks as the ones picked in the sorted samples by Histogram
+        med = sketch.get_value_at_rank(int(round(sketch.count/2 - 1)))
+        avg = sketch.sum / float(sketch.count)
+        percentile_values = [sketch.get_quantile_value(p) for p in self.percentiles]
+
+        self.sketch = DDSketch(self.relative_accuracy)
+        return sketch.min, sketch.max, med, sketch.sum, avg, percentile_values
+
+    def memory_usage(self):
+        return super(SketchHistogram, self).memory_usage() + self.sketch.memory_usage()
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Set, self).__init__(formatter, context)
         self.values = set()
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def get_partial(self):
+        return (self.values, self.last_sample_time)
+
+    def merge_partial(self, partial):
+        values, last_sample_time = partial
+        self.values.update(values)
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -339,15 +594,11 @@ class Set(Metric):
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def __init__(self, formatter, context, extra_config=None):
+        super(Rate, self).__init__(formatter, context)
         self.samples = []
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         ts = time()
@@ -389,6 +640,49 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class TagCache(object):
+    """
+    Bounded cache from the raw tag string of a packet to its parsed form:
+    (sorted and deduped tags, hostname, device_name).
+
+    Entries live in two generations: lookups promote entries to `hot`, and
+    when `hot` is full it replaces `cold`, dropping the least recently used
+    entries in O(1).
+    """
+
+    def __init__(self, size=TAG_CACHE_SIZE):
+        self.size = size
+        self.hot = {}
+        self.cold = {}
+
+    def get(self, raw_tags):
+        parsed = self.hot.get(raw_tags)
+        if parsed is None:
+            parsed = self.cold.get(raw_tags)
+            if parsed is None:
+                parsed = self.parse(raw_tags)
+            if len(self.hot) >= self.size:
+                self.cold = self.hot
+                self.hot = {}
+            self.hot[raw_tags] = parsed
+        return parsed
+
+    @staticmethod
+    def parse(raw_tags):
+        """Magic tags (host, device) override metric hostname and device_name attributes"""
+        hostname = None
+        device_name = None
+        tags = []
+        for tag in sorted(set(raw_tags.split(','))):
+            if tag.startswith('host:'):
+                hostname = tag[5:]
+            elif tag.startswith('device:'):
+                device_name = tag[7:]
+            else:
+                tags.append(tag)
+        return tuple(tags), hostname, device_name
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -399,7 +693,9 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, context_limit=None,
+            context_limit_per_metric=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -420,10 +716,20 @@ class Aggregator(object):
             Histogram: {
                 'aggregates': histogram_aggregates,
                 'percentiles': histogram_percentiles
-            }
+            },
+            SketchHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'relative_accuracy': histogram_relative_accuracy,
+            },
         }
+        # `samples` keeps every sample until the flush, `sketch` bounds the memory
+        self.histogram_class = SketchHistogram if histogram_backend == 'sketch' else Histogram
 
         self.utf8_decoding = utf8_decoding
+        self.tag_cache = TagCache()
+        self.contexts = ContextTable(context_limit, context_limit_per_metric, hostname)
+        self.last_overflow_count = 0
 
     def packets_per_second(self, interval):
         if interval == 0:
@@ -499,6 +805,55 @@ class Aggregator(object):
 
         return parsed_packets
 
+    def parse_metric_context(self, packet):
+        """
+        Parse a metric packet straight into
+        [(context, value, metric_type, sample_rate), ...] where the context is
+        (name, sorted and deduped tags, hostname, device_name), as built by
+        `submit_metric`.
+        Single-value packets are read in one regex match and their tags come
+        from the tag cache; others go through `parse_metric_packet`.
+        """
+        match = METRIC_PACKET_RE.match(packet)
+        if match is not None:
+            name, raw_value, metric_type, raw_sample_rate, raw_tags = match.groups()
+            try:
+                if metric_type in self.ALLOW_STRINGS:
+                    value = raw_value
+                else:
+                    # Try to cast as an int first to avoid precision issues, then as a
+                    # float.
+                    try:
+                        value = int(raw_value)
+                    except ValueError:
+                        value = float(raw_value)
+
+                sample_rate = 1
+                if raw_sample_rate is not None:
+                    sample_rate = float(raw_sample_rate)
+                    assert 0 <= sample_rate <= 1
+
+                if raw_tags is None:
+                    tags, hostname, device_name = (), None, None
+                else:
+                    tags, hostname, device_name = self.tag_cache.get(raw_tags)
+
+                if hostname is None:
+                    hostname = self.hostname
+                return [((name, tags, hostname, device_name), value, metric_type, sample_rate)]
+            except (ValueError, AssertionError):
+                # Let the generic parser raise or log the error
+                pass
+
+        parsed_packets = []
+        for name, value, metric_type, tags, sample_rate in self.parse_metric_packet(packet):
+            hostname, device_name, tags = self._extract_magic_tags(tags)
+            if hostname is None:
+                hostname = self.hostname
+            tags = tuple(sorted(set(tags))) if tags else ()
+            parsed_packets.append(((name, tags, hostname, device_name), value, metric_type, sample_rate))
+        return parsed_packets
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -605,12 +960,23 @@ class Aggregator(object):
                 self.service_check(**service_check)
                 self.service_check_count += 1
             else:
-                parsed_packets = self.parse_metric_packet(packet)
+                parsed_packets = self.parse_metric_context(packet)
                 self.count += 1
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                                       device_name=device_name, sample_rate=sample_rate)
+                for context, value, mtype, sample_rate in parsed_packets:
+                    self.submit_context_metric(context, value, mtype, sample_rate=sample_rate)
+
+    def submit_packets_batch(self, datagrams):
+        """
+        Submit a burst of datagrams drained from the socket in one call.
+        A bad datagram only loses its own packets, as if it had been
+        submitted on its own.
+        """
+        submit_packets = self.submit_packets
+        for datagram in datagrams:
+            try:
+                submit_packets(datagram)
+            except Exception:
+                log.exception('Error submitting datagram `%s`', datagram)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -639,6 +1005,13 @@ class Aggregator(object):
         """ Add a metric to be aggregated """
         raise NotImplementedError()
 
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
+        """
+        Add a metric to be aggregated, given its already built context.
+        `tags` are the ones reported with the metric, default to the context's.
+        """
+        raise NotImplementedError()
+
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
         event = {
             'msg_title': title,
@@ -688,6 +1061,34 @@ class Aggregator(object):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
+    def metric_dicts(self):
+        """ Dicts holding the metric objects """
+        raise NotImplementedError()
+
+    def context_metrics(self, context):
+        """ Metric objects aggregated for the given MetricContext """
+        raise NotImplementedError()
+
+    def context_stats(self, sample_size=CONTEXT_STATS_SAMPLE_SIZE):
+        """
+        Return the number of live contexts and the approximate memory used
+        per context in bytes, estimated over `sample_size` of them.
+        """
+        context_count = len(self.contexts)
+        if not context_count:
+            return 0, 0
+
+        metric_dicts = self.metric_dicts()
+        sample_memory = 0
+        sample = list(islice(self.contexts.by_key.itervalues(), sample_size))
+        for context in sample:
+            sample_memory += context.memory_usage()
+            for metric in self.context_metrics(context):
+                sample_memory += metric.memory_usage()
+
+        overhead = self.contexts.memory_usage() + sum(sys.getsizeof(d) for d in metric_dicts)
+        return context_count, int(sample_memory / len(sample) + overhead / context_count)
+
     def flush_events(self):
         events = self.events
         self.events = []
@@ -713,6 +1114,37 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def send_context_stats(self, prefix):
+        """
+        Submit the number of live contexts, the samples folded into overflow
+        series since the last call, and the metric names and tag keys that
+        created the most contexts since the last call.
+        Return these top metric names and tag keys, as [(item, count), ...].
+        """
+        contexts = self.contexts
+        overflow_count = contexts.overflow_count - self.last_overflow_count
+        self.last_overflow_count = contexts.overflow_count
+
+        stats = [
+            ('%s.contexts' % prefix, len(contexts), ()),
+            ('%s.contexts.overflow' % prefix, overflow_count, ()),
+        ]
+        top_metrics = contexts.top_metrics.top(CONTEXT_TOP_K)
+        top_tag_keys = contexts.top_tag_keys.top(CONTEXT_TOP_K)
+        for name, count in top_metrics:
+            stats.append(('%s.contexts.by_metric' % prefix, count, ('metric_name:%s' % name,)))
+        for tag_key, count in top_tag_keys:
+            stats.append(('%s.contexts.by_tag_key' % prefix, count, ('tag_key:%s' % tag_key,)))
+        contexts.top_metrics.clear()
+        contexts.top_tag_keys.clear()
+
+        for name, value, tags in stats:
+            # These must get through even when the limits are reached
+            context = contexts.intern((name, tags, self.hostname, None), limited=False)
+            self.submit_context_metric(context.key, value, 'g')
+
+        return top_metrics, top_tag_keys
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -721,7 +1153,9 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, context_limit=None,
+            context_limit_per_metric=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -730,20 +1164,33 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy,
+            context_limit,
+            context_limit_per_metric
         )
         self.metric_by_bucket = {}
         self.last_sample_time_by_context = {}
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
+        # Buckets starting before this time are being or have been flushed
+        self.flushing_cutoff_time = 0
+        # Context ids get reused once released: interning a context and
+        # referencing it from a bucket must not interleave with its release
+        # by a flush running in another thread
+        self._contexts_lock = threading.Lock()
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
         }
+        self.metric_class_to_type = dict(
+            (metric_class, mtype) for mtype, metric_class in self.metric_type_to_class.iteritems()
+        )
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
@@ -751,8 +1198,6 @@ class MetricsBucketAggregator(Aggregator):
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
@@ -762,11 +1207,14 @@ class MetricsBucketAggregator(Aggregator):
         else:
             context = (name, tuple(sorted(set(tags))), hostname, device_name)
 
+        self.submit_context_metric(context, value, mtype, timestamp, sample_rate, tags)
+
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
@@ -781,32 +1229,127 @@ class MetricsBucketAggregator(Aggregator):
                 self.current_bucket = bucket_start_timestamp
                 self.current_mbc = metric_by_context
 
-            if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+            with self._contexts_lock:
+                context = self.contexts.intern(context, tags)
+                metric = metric_by_context.get(context.id)
+                if metric is None:
+                    metric_class = self.metric_type_to_class[mtype]
+                    metric = metric_by_context[context.id] = metric_class(self.formatter, context,
+                        self.metric_config.get(metric_class))
+
+            metric.sample(value, sample_rate, timestamp)
+
+    def export_partials(self):
+        """
+        Hand over everything aggregated since the last export, as picklable
+        partial aggregates, and reset the buckets. Used by StsStatsD workers
+        to ship their shard to the process that merges and flushes it.
+        """
+        metric_by_bucket = self.metric_by_bucket
+        self.metric_by_bucket = {}
+        self.current_bucket = None
+        self.current_mbc = {}
 
-            metric_by_context[context].sample(value, sample_rate, timestamp)
+        metric_partials = []
+        exported_ids = set()
+        for bucket_start_timestamp, metric_by_context in metric_by_bucket.iteritems():
+            for context_id, metric in metric_by_context.iteritems():
+                metric_partials.append((bucket_start_timestamp, metric.context.key,
+                                        self.metric_class_to_type[metric.__class__],
+                                        metric.get_partial()))
+                exported_ids.add(context_id)
+        self._release_contexts(exported_ids)
+
+        partials = {
+            'metrics': metric_partials,
+            'events': self.events,
+            'service_checks': self.service_checks,
+            'count': self.count,
+            'event_count': self.event_count,
+            'service_check_count': self.service_check_count,
+            'num_discarded_old_points': self.num_discarded_old_points,
+        }
+        self.events = []
+        self.service_checks = []
+        self.count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+        return partials
+
+    def merge_partials(self, partials):
+        """
+        Merge partial aggregates returned by `export_partials` into the buckets,
+        with the same semantics as if the samples had been submitted here.
+        Partials of buckets already flushed are folded into the first bucket
+        not flushed yet, rather than flushed a second time.
+        """
+        metric_by_bucket = self.metric_by_bucket
+        for bucket_start_timestamp, context, mtype, partial in partials['metrics']:
+            with self._contexts_lock:
+                bucket_start_timestamp = max(bucket_start_timestamp, self.flushing_cutoff_time)
+                if bucket_start_timestamp not in metric_by_bucket:
+                    metric_by_bucket[bucket_start_timestamp] = {}
+                metric_by_context = metric_by_bucket[bucket_start_timestamp]
+
+                context = self.contexts.intern(context)
+                metric = metric_by_context.get(context.id)
+                if metric is None:
+                    metric_class = self.metric_type_to_class[mtype]
+                    metric = metric_by_context[context.id] = metric_class(self.formatter, context,
+                        self.metric_config.get(metric_class))
+
+            metric.merge_partial(partial)
+
+        self.events.extend(partials['events'])
+        self.service_checks.extend(partials['service_checks'])
+        self.count += partials['count']
+        self.event_count += partials['event_count']
+        self.service_check_count += partials['service_check_count']
+        self.num_discarded_old_points += partials['num_discarded_old_points']
 
     def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
+        for context_id, last_sample_time in sample_time_by_context.items():
+            context = self.contexts.get(context_id)
             if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
+                log.debug("%s hasn't been submitted in %ss. Expiring." % (context.key, self.expiry_seconds))
+                self.last_sample_time_by_context.pop(context_id, None)
             else:
                 # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
+                metric = Counter(self.formatter, context)
                 metrics += metric.flush(flush_timestamp, self.interval)
 
+    def _release_contexts(self, context_ids):
+        """ Release the given contexts if no bucket nor counter references them anymore. """
+        with self._contexts_lock:
+            remaining_buckets = self.metric_by_bucket.values()
+            for context_id in context_ids:
+                if context_id in self.last_sample_time_by_context:
+                    continue
+                if any(context_id in metric_by_context for metric_by_context in remaining_buckets):
+                    continue
+                self.contexts.release(context_id)
+
+    def metric_dicts(self):
+        return self.metric_by_bucket.values()
+
+    def context_metrics(self, context):
+        context_id = context.id
+        return [metric_by_context[context_id] for metric_by_context in self.metric_by_bucket.itervalues()
+                if context_id in metric_by_context]
+
     def flush(self):
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
+        with self._contexts_lock:
+            self.flushing_cutoff_time = flush_cutoff_time
 
         metrics = []
+        # Contexts that may not be referenced anymore after this flush
+        flushed_ids = set(self.last_sample_time_by_context)
 
         if self.metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
@@ -816,17 +1359,18 @@ class MetricsBucketAggregator(Aggregator):
                 if bucket_start_timestamp < flush_cutoff_time:
                     not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
                     # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
+                    for context_id, metric in metric_by_context.items():
                         if metric.last_sample_time < expiry_timestamp:
                             # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
+                            log.warning("%s hasn't been submitted in %ss. Expiring." % (metric.context.key, self.expiry_seconds))
+                            not_sampled_in_this_bucket.pop(context_id, None)
+                            self.last_sample_time_by_context.pop(context_id, None)
                         else:
                             metrics += metric.flush(bucket_start_timestamp, self.interval)
                             if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
+                                self.last_sample_time_by_context[context_id] = metric.last_sample_time
+                                not_sampled_in_this_bucket.pop(context_id, None)
+                    flushed_ids.update(metric_by_context)
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
                     self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
 
@@ -837,6 +1381,7 @@ class MetricsBucketAggregator(Aggregator):
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
                 self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
                                           flush_cutoff_time-self.interval, metrics)
+        self._release_contexts(flushed_ids)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -861,7 +1406,9 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None, context_limit=None,
+            context_limit_per_metric=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -870,7 +1417,11 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy,
+            context_limit,
+            context_limit_per_metric
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -878,8 +1429,8 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
             '_dd-r': Rate,
         }
@@ -895,16 +1446,23 @@ class MetricsAggregator(Aggregator):
             context = (name, tuple(), hostname, device_name)
         else:
             context = (name, tuple(sorted(set(tags))), hostname, device_name)
-        if context not in self.metrics:
+
+        self.submit_context_metric(context, value, mtype, timestamp, sample_rate, tags)
+
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
+        # One metric per context here, so metrics are keyed by the interned context key
+        context = self.contexts.intern(context, tags)
+        metric = self.metrics.get(context.key)
+        if metric is None:
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+            metric = self.metrics[context.key] = metric_class(self.formatter, context,
+                self.metric_config.get(metric_class))
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context.name, timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
-            self.metrics[context].sample(value, sample_rate, timestamp)
+            metric.sample(value, sample_rate, timestamp)
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -943,6 +1501,7 @@ class MetricsAggregator(Aggregator):
             if metric.last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
                 del self.metrics[context]
+                self.contexts.release(metric.context.id)
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
@@ -957,6 +1516,13 @@ class MetricsAggregator(Aggregator):
         self.count = 0
         return metrics
 
+    def metric_dicts(self):
+        return [self.metrics]
+
+    def context_metrics(self, context):
+        metric = self.metrics.get(context.key)
+        return [metric] if metric is not None else []
+
 def get_formatter(config):
     formatter = api_formatter
 
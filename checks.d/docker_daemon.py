@@ -10,7 +10,7 @@ from math import ceil
 # project
 from checks import AgentCheck
 from config import _is_affirmative
-from utils.dockerutil import DockerUtil, MountException
+from utils.dockerutil import ContainerCache, DockerUtil, MountException
 from utils.kubernetes import KubeUtil
 from utils.platform import Platform
 from utils.service_discovery.sd_backend import get_sd_backend
@@ -129,6 +129,7 @@ class DockerDaemon(AgentCheck):
                             agentConfig, instances=instances)
 
         self.init_success = False
+        self.container_cache = None
         self._service_discovery = agentConfig.get('service_discovery') and \
             agentConfig.get('service_discovery_backend') == 'docker'
         self.init()
@@ -152,6 +153,13 @@ class DockerDaemon(AgentCheck):
             self._latest_size_query = 0
             self._filtered_containers = set()
             self._disable_net_metrics = False
+            self._size_queried = False
+
+            # Keep the container listing current from the events stream instead of listing them at each run
+            if _is_affirmative(instance.get('container_cache', True)):
+                if self.container_cache is None:
+                    self.container_cache = ContainerCache(self.docker_util)
+                self.container_cache.start()
 
             # Set tagging options
             self.custom_tags = instance.get("tags", [])
@@ -180,6 +188,9 @@ class DockerDaemon(AgentCheck):
             self.collect_ecs_tags = _is_affirmative(instance.get('ecs_tags', True)) and Platform.is_ecs_instance()
 
             self.ecs_tags = {}
+            # Tags computed for a container are cached in it until the ECS or kubernetes tags change
+            self._tags_generation = 0
+            self._tag_sources = ({}, {})
 
         except Exception as e:
             self.log.critical(e)
@@ -210,6 +221,10 @@ class DockerDaemon(AgentCheck):
                 self.log.warning('Could not retrieve kubernetes labels: %s' % str(e))
                 self.kube_labels = {}
 
+        if (self.ecs_tags, self.kube_labels) != self._tag_sources:
+            self._tag_sources = (self.ecs_tags, self.kube_labels)
+            self._tags_generation += 1
+
         # containers running with custom cgroups?
         custom_cgroups = _is_affirmative(instance.get('custom_cgroups', False))
 
@@ -224,13 +239,18 @@ class DockerDaemon(AgentCheck):
         # Report performance container metrics (cpu, mem, net, io)
         self._report_performance_metrics(containers_by_id)
 
-        if self.collect_container_size:
+        # Container sizes are only listed every SIZE_REFRESH_RATE runs
+        if self.collect_container_size and self._size_queried:
             self._report_container_size(containers_by_id)
 
         # Collect disk stats from Docker info command
         if self.collect_disk_stats:
             self._report_disk_stats()
 
+    def stop(self):
+        if self.container_cache is not None:
+            self.container_cache.stop()
+
     def _count_and_weigh_images(self):
         try:
             tags = self._get_tags()
@@ -253,12 +273,16 @@ class DockerDaemon(AgentCheck):
         # Querying the size of containers is slow, we don't do it at each run
         must_query_size = self.collect_container_size and self._latest_size_query == 0
         self._latest_size_query = (self._latest_size_query + 1) % SIZE_REFRESH_RATE
+        self._size_queried = must_query_size
 
         running_containers_count = Counter()
         all_containers_count = Counter()
 
         try:
-            containers = self.docker_client.containers(all=True, size=must_query_size)
+            if self.container_cache is not None:
+                containers = self.container_cache.get_containers(self.docker_client, size=must_query_size)
+            else:
+                containers = self.docker_client.containers(all=True, size=must_query_size)
         except Exception as e:
             message = "Unable to list Docker containers: {0}".format(e)
             self.service_check(SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
@@ -291,8 +315,8 @@ class DockerDaemon(AgentCheck):
             containers_by_id[container['Id']] = container
 
             # grab pid via API if custom cgroups - otherwise we won't find process when
-            # crawling for pids.
-            if custom_cgroups:
+            # crawling for pids. Cached containers keep it until they restart.
+            if custom_cgroups and '_pid' not in container:
                 try:
                     inspect_dict = self.docker_client.inspect_container(container_name)
                     container['_pid'] = inspect_dict['State']['Pid']
@@ -318,7 +342,20 @@ class DockerDaemon(AgentCheck):
         return container["Status"].startswith("Up") or container["Status"].startswith("Restarting")
 
     def _get_tags(self, entity=None, tag_type=None):
-        """Generate the tags for a given entity (container or image) according to a list of tag names."""
+        """Generate the tags for a given entity (container or image) according to a list of tag names.
+        Cache them inside the entity object.
+        """
+        if entity is None:
+            return self._compute_tags()
+
+        cached = entity.get("_tags")
+        if cached is None or cached[0] != self._tags_generation:
+            cached = entity["_tags"] = (self._tags_generation, {})
+        if tag_type not in cached[1]:
+            cached[1][tag_type] = self._compute_tags(entity, tag_type)
+        return list(cached[1][tag_type])
+
+    def _compute_tags(self, entity=None, tag_type=None):
         # Start with custom tags
         tags = list(self.custom_tags)
 
@@ -1,5 +1,7 @@
 # stdlib
 from collections import defaultdict, namedtuple
+import json
+import re
 import time
 import urlparse
 
@@ -16,6 +18,104 @@ class NodeNotFound(Exception):
     pass
 
 
+class NodeStatsStream(object):
+    """
+    Incrementally decode a node stats response, one node at a time, so that
+    only the document of the node being processed is held in memory instead
+    of the stats of the whole cluster.
+
+    `chunks` is an iterable of pieces of the JSON response. `read_header`
+    decodes the top level values preceding `nodes` (e.g. `cluster_name`),
+    `iter_nodes` then yields the (node id, node stats) pairs.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._done = False
+        self.header = {}
+
+    def _read(self):
+        """ Append the next chunk to the buffer, return False at the end of the response. """
+        if self._done:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._done = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = self.WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._read():
+                return
+
+    def _expect(self, chars):
+        """ Consume the next structural character, which must be one of `chars`. """
+        self._skip_whitespace()
+        char = self._buf[self._pos:self._pos + 1]
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %s of the node stats, got %r"
+                             % (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """ Decode the next JSON value, reading more of the response until it is complete. """
+        self._skip_whitespace()
+        while True:
+            # Only retry once the pending data doubled, so that a value split
+            # over many chunks is decoded in linear time
+            pending = len(self._buf) - self._pos
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._read():
+                    # The response is complete: the value is truncated or malformed
+                    raise
+                while len(self._buf) - self._pos < 2 * pending and self._read():
+                    pass
+                continue
+            self._pos = end
+            return value
+
+    def _members(self):
+        """ Yield the keys of the object starting at the current position. """
+        self._expect('{')
+        self._skip_whitespace()
+        if self._buf[self._pos:self._pos + 1] == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def read_header(self):
+        self._top_level = self._members()
+        for key in self._top_level:
+            if key == 'nodes':
+                break
+            self.header[key] = self._value()
+        return self.header
+
+    def iter_nodes(self):
+        for node_id in self._members():
+            yield node_id, self._value()
+        # Top level values following the nodes
+        for key in self._top_level:
+            self.header[key] = self._value()
+
+
 ESInstanceConfig = namedtuple(
     'ESInstanceConfig', [
         'pshard_stats',
@@ -27,6 +127,7 @@ ESInstanceConfig = namedtuple(
         'url',
         'username',
         'pending_task_stats',
+        'stream_node_stats',
         'ssl_verify',
         'ssl_cert',
         'ssl_key',
@@ -38,6 +139,8 @@ class ESCheck(AgentCheck):
     SERVICE_CHECK_CLUSTER_STATUS = 'elasticsearch.cluster_health'
 
     DEFAULT_TIMEOUT = 5
+    # Size of the pieces of the node stats read at once when streaming them
+    STREAM_CHUNK_SIZE = 64 * 1024
 
     # Clusterwise metrics, pre aggregated on ES, compatible with all ES versions
     PRIMARY_SHARD_METRICS = {
@@ -335,6 +438,10 @@ class ESCheck(AgentCheck):
 
         # Host status needs to persist across all checks
         self.cluster_status = {}
+        # One pooled HTTP session per instance, to reuse the connections
+        self._sessions = {}
+        # (version, cluster_stats) -> params with precompiled metric paths
+        self._params_cache = {}
 
     def get_instance_config(self, instance):
         url = instance.get('url')
@@ -348,6 +455,7 @@ class ESCheck(AgentCheck):
             cluster_stats = _is_affirmative(instance.get('is_external', False))
 
         pending_task_stats = _is_affirmative(instance.get('pending_task_stats', True))
+        stream_node_stats = _is_affirmative(instance.get('stream_node_stats', False))
         # Support URLs that have a path in them from the config, for
         # backwards-compatibility.
         parsed = urlparse.urlparse(url)
@@ -382,7 +490,8 @@ class ESCheck(AgentCheck):
             timeout=timeout,
             url=url,
             username=instance.get('username'),
-            pending_task_stats=pending_task_stats
+            pending_task_stats=pending_task_stats,
+            stream_node_stats=stream_node_stats,
         )
         return config
 
@@ -394,19 +503,28 @@ class ESCheck(AgentCheck):
         version = self._get_es_version(config)
 
         health_url, stats_url, pshard_stats_url, pending_tasks_url, stats_metrics, \
-            pshard_stats_metrics = self._define_params(version, config.cluster_stats)
+            pshard_stats_metrics = self._get_params(version, config.cluster_stats)
 
         # Load stats data.
         # This must happen before other URL processing as the cluster name
         # is retreived here, and added to the tag list.
 
         stats_url = urlparse.urljoin(config.url, stats_url)
-        stats_data = self._get_data(stats_url, config)
-        if stats_data['cluster_name']:
+        if config.stream_node_stats:
+            stream = NodeStatsStream(self._get_chunks(stats_url, config))
+            stats_data = stream.read_header()
+            nodes = (node_data for _, node_data in stream.iter_nodes())
+            if 'cluster_name' not in stats_data:
+                # The cluster name is needed to tag the nodes metrics
+                nodes = list(nodes)
+        else:
+            stats_data = self._get_data(stats_url, config)
+            nodes = stats_data['nodes'].itervalues()
+        if stats_data.get('cluster_name'):
             # retreive the cluster name from the data, and append it to the
             # master tag list.
             config.tags.append("cluster_name:{}".format(stats_data['cluster_name']))
-        self._process_stats_data(stats_data, stats_metrics, config)
+        self._process_nodes_stats(nodes, stats_metrics, config)
 
         # Load clusterwise data
         if config.pshard_stats:
@@ -455,6 +573,24 @@ class ESCheck(AgentCheck):
         self.log.debug("Elasticsearch version is %s" % version)
         return version
 
+    def _get_params(self, version, cluster_stats):
+        """ Parameters of `_define_params`, with the paths of the metrics
+            precompiled, computed once per version.
+        """
+        key = (tuple(version), cluster_stats)
+        if key not in self._params_cache:
+            params = self._define_params(version, cluster_stats)
+            self._params_cache[key] = params[:4] + tuple(self._compile_metrics(m) for m in params[4:])
+        return self._params_cache[key]
+
+    @staticmethod
+    def _compile_metrics(metrics):
+        """ Split the dotted paths of the metrics descriptions into tuples of keys. """
+        return dict(
+            (metric, (desc[0], tuple(desc[1].split('.'))) + tuple(desc[2:]))
+            for metric, desc in metrics.iteritems()
+        )
+
     def _define_params(self, version, cluster_stats):
         """ Define the set of URLs and METRICS to use depending on the
             running ES version.
@@ -542,9 +678,28 @@ class ESCheck(AgentCheck):
         return health_url, stats_url, pshard_stats_url, pending_tasks_url, \
             stats_metrics, pshard_stats_metrics
 
+    def _get_session(self, config):
+        if config.url not in self._sessions:
+            self._sessions[config.url] = requests.Session()
+        return self._sessions[config.url]
+
+    def stop(self):
+        for session in self._sessions.itervalues():
+            session.close()
+        self._sessions = {}
+
     def _get_data(self, url, config, send_sc=True):
         """ Hit a given URL and return the parsed json
         """
+        return self._request(url, config, send_sc=send_sc).json()
+
+    def _get_chunks(self, url, config, send_sc=True):
+        """ Hit a given URL and return an iterator over the pieces of its body
+        """
+        resp = self._request(url, config, send_sc=send_sc, stream=True)
+        return resp.iter_content(self.STREAM_CHUNK_SIZE)
+
+    def _request(self, url, config, send_sc=True, stream=False):
         # Load basic authentication configuration, if available.
         if config.username and config.password:
             auth = (config.username, config.password)
@@ -565,13 +720,14 @@ class ESCheck(AgentCheck):
             cert = None
 
         try:
-            resp = requests.get(
+            resp = self._get_session(config).get(
                 url,
                 timeout=config.timeout,
                 headers=headers(self.agentConfig),
                 auth=auth,
                 verify=verify,
-                cert=cert
+                cert=cert,
+                stream=stream
             )
             resp.raise_for_status()
         except Exception as e:
@@ -584,7 +740,7 @@ class ESCheck(AgentCheck):
                 )
             raise
 
-        return resp.json()
+        return resp
 
     def _process_pending_tasks_data(self, data, config):
         p_tasks = defaultdict(int)
@@ -604,8 +760,11 @@ class ESCheck(AgentCheck):
             self._process_metric(node_data, metric, *desc, tags=config.tags)
 
     def _process_stats_data(self, data, stats_metrics, config):
+        self._process_nodes_stats(data['nodes'].itervalues(), stats_metrics, config)
+
+    def _process_nodes_stats(self, nodes, stats_metrics, config):
         cluster_stats = config.cluster_stats
-        for node_data in data['nodes'].itervalues():
+        for node_data in nodes:
             metric_hostname = None
             metrics_tags = list(config.tags)
 
@@ -637,13 +796,16 @@ class ESCheck(AgentCheck):
                         tags=None, hostname=None):
         """data: dictionary containing all the stats
         metric: stackstate metric
-        path: corresponding path in data, flattened, e.g. thread_pool.bulk.queue
+        path: corresponding path in data, flattened, e.g. thread_pool.bulk.queue,
+              or already split into a tuple of keys
         xfom: a lambda to apply to the numerical value
         """
         value = data
+        if isinstance(path, basestring):
+            path = path.split('.')
 
         # Traverse the nested dictionaries
-        for key in path.split('.'):
+        for key in path:
             if value is not None:
                 value = value.get(key, None)
             else:
@@ -702,7 +864,7 @@ class ESCheck(AgentCheck):
         )
 
     def _metric_not_found(self, metric, path):
-        self.log.debug("Metric not found: %s -> %s", path, metric)
+        self.log.debug("Metric not found: %s -> %s", '.'.join(path), metric)
 
     def _create_event(self, status, tags=None):
         hostname = self.hostname.decode('utf-8')
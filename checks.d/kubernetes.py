@@ -147,6 +147,8 @@ class Kubernetes(AgentCheck):
         if _is_affirmative(instance.get('collect_events', DEFAULT_COLLECT_EVENTS)):
             self._process_events(instance, pods_list)
 
+        self.kubeutil.report_api_stats(self, tags=['check:%s' % self.name])
+
     def _publish_raw_metrics(self, metric, dat, tags, depth=0):
         if depth >= self.max_depth:
             self.log.warning('Reached max depth on metric=%s' % metric)
@@ -44,6 +44,7 @@ class KubernetesTopology(AgentCheck):
                 self.service_check(self.SERVICE_CHECK_NAME, status, message=msg)
 
         self.stop_snapshot(instance_key)
+        kubeutil.report_api_stats(self, tags=['check:%s' % self.name])
 
     def _extract_topology(self, kubeutil, instance_key):
         self._extract_services(kubeutil, instance_key)
@@ -78,6 +79,7 @@ class KubernetesTopology(AgentCheck):
             self.component(instance_key, node['metadata']['name'], {'name': 'KUBERNETES_NODE'}, data)
 
     def _extract_deployments(self, kubeutil, instance_key):
+        replicasets_by_namespace = None
         for deployment in kubeutil.retrieve_deployments_list()['items']:
             data = dict()
             externalId = "deployment: %s" % deployment['metadata']['name']
@@ -88,9 +90,12 @@ class KubernetesTopology(AgentCheck):
             deployment_template = deployment['spec']['template']
             if deployment_template and deployment_template['metadata']['labels'] and len(deployment_template['metadata']['labels']) > 0:
                 data['template_labels'] = self._make_labels(kubeutil, deployment_template['metadata'])
-                replicasets = kubeutil.retrieve_replicaset_filtered_list(deployment['metadata']['namespace'], deployment_template['metadata']['labels'])
-                if replicasets['items']:
-                    for replicaset in replicasets['items']:
+                if replicasets_by_namespace is None:
+                    # All the replicasets are listed once, and matched with the deployments here
+                    replicasets_by_namespace = self._group_by_namespace(kubeutil.retrieve_replicasets_list()['items'])
+                selector = deployment_template['metadata']['labels']
+                for replicaset in replicasets_by_namespace[deployment['metadata']['namespace']]:
+                    if self._match_labels(selector, replicaset['metadata'].get('labels') or {}):
                         self.relation(instance_key, externalId, replicaset['metadata']['name'], {'name': 'CREATED'}, dict())
 
             self.component(instance_key, externalId, {'name': 'KUBERNETES_DEPLOYMENT'}, data)
@@ -180,6 +185,22 @@ class KubernetesTopology(AgentCheck):
             original_labels.append("namespace:%s" % metadata['namespace'])
         return original_labels
 
+    def _group_by_namespace(self, items):
+        items_by_namespace = defaultdict(list)
+        for item in items:
+            items_by_namespace[item['metadata'].get('namespace')].append(item)
+        return items_by_namespace
+
+    def _match_labels(self, selector, labels):
+        """
+        Whether the labels match all the name/value pairs of the selector, like
+        the API server does with a `labelSelector` parameter.
+        """
+        for name, value in selector.iteritems():
+            if labels.get(name) != value:
+                return False
+        return True
+
     def _flatten_dict(self, dict_of_list):
         from itertools import chain
         return sorted(set(chain.from_iterable(dict_of_list.itervalues())))
@@ -15,6 +15,47 @@ GAUGE = AgentCheck.gauge
 RATE = AgentCheck.rate
 
 
+class StaggeredRefresh(object):
+    """
+    Spread the refreshes of a set of items (databases, collections) over
+    `interval` seconds, so that each of them is refreshed once per interval
+    but not all of them during the same check run.
+
+    With an interval of 0, every item is refreshed at every run.
+    """
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        # item -> next refresh timestamp
+        self._next_refresh = {}
+
+    def due(self, items, now=None):
+        """ Return the items to refresh during this run, in the given order. """
+        if self.interval <= 0:
+            return list(items)
+        now = time.time() if now is None else now
+
+        # Forget the removed items, and spread the new ones over an interval
+        items = list(items)
+        current = set(items)
+        self._next_refresh = dict(
+            (item, ts) for item, ts in self._next_refresh.iteritems() if item in current
+        )
+        new_items = [item for item in items if item not in self._next_refresh]
+        for i, item in enumerate(new_items):
+            self._next_refresh[item] = now + self.interval * i / len(new_items)
+
+        due = []
+        for item in items:
+            next_refresh = self._next_refresh[item]
+            if next_refresh <= now:
+                due.append(item)
+                # Keep the item's slot in the interval, even if runs were missed
+                missed = int((now - next_refresh) / self.interval)
+                self._next_refresh[item] = next_refresh + self.interval * (missed + 1)
+        return due
+
+
 class MongoDb(AgentCheck):
     """
     MongoDB agent check.
@@ -408,6 +449,15 @@ class MongoDb(AgentCheck):
         # Members' last replica set states
         self._last_state_by_server = {}
 
+        # Long-lived clients, reused across runs: client key -> MongoClient
+        self._clients = {}
+        # Keys of the clients already authenticated
+        self._authenticated_clients = set()
+
+        # Staggered refreshes of the `dbstats` and `collstats` commands:
+        # (server, command) -> StaggeredRefresh
+        self._refreshes = {}
+
         # List of metrics to collect per instance
         self.metrics_to_collect_by_instance = {}
 
@@ -588,6 +638,50 @@ class MongoDb(AgentCheck):
 
         return authenticated
 
+    def _get_client(self, server, timeout, ssl_params, replicaset=None,
+                    read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED):
+        """
+        Return the client connecting to `server` with these parameters, created
+        on the first call and reused by the following runs, with its key.
+        """
+        key = (server, timeout, replicaset, read_preference.mode, tuple(sorted(ssl_params.items())))
+        if key not in self._clients:
+            kwargs = dict(ssl_params)
+            if replicaset is not None:
+                kwargs['replicaset'] = replicaset
+            self._clients[key] = pymongo.mongo_client.MongoClient(
+                server,
+                socketTimeoutMS=timeout,
+                read_preference=read_preference,
+                **kwargs)
+        return self._clients[key], key
+
+    def _authenticate_client(self, key, database, username, password, use_x509):
+        """
+        Authenticate a client once, the driver reuses its credentials for the
+        following connections. A client that fails to authenticate is dropped.
+        """
+        if key in self._authenticated_clients:
+            return True
+        if self._authenticate(database, username, password, use_x509):
+            self._authenticated_clients.add(key)
+            return True
+        self._clients.pop(key).close()
+        return False
+
+    def _get_refresh(self, server, command, interval):
+        key = (server, command)
+        if key not in self._refreshes:
+            self._refreshes[key] = StaggeredRefresh(interval)
+        self._refreshes[key].interval = interval
+        return self._refreshes[key]
+
+    def stop(self):
+        for client in self._clients.itervalues():
+            client.close()
+        self._clients = {}
+        self._authenticated_clients = set()
+
     def check(self, instance):
         """
         Returns a dictionary that looks a lot like what's sent back by
@@ -679,12 +773,12 @@ class MongoDb(AgentCheck):
             ]
 
         timeout = float(instance.get('timeout', DEFAULT_TIMEOUT)) * 1000
+        dbstats_refresh = self._get_refresh(
+            server, 'dbstats', float(instance.get('dbstats_interval', 0)))
+        collstats_refresh = self._get_refresh(
+            server, 'collstats', float(instance.get('collstats_interval', 0)))
         try:
-            cli = pymongo.mongo_client.MongoClient(
-                server,
-                socketTimeoutMS=timeout,
-                read_preference=pymongo.ReadPreference.PRIMARY_PREFERRED,
-                **ssl_params)
+            cli, client_key = self._get_client(server, timeout, ssl_params)
             # some commands can only go against the admin DB
             admindb = cli['admin']
             db = cli[db_name]
@@ -705,7 +799,7 @@ class MongoDb(AgentCheck):
             )
             do_auth = False
 
-        if do_auth and not self._authenticate(db, username, password, use_x509):
+        if do_auth and not self._authenticate_client(client_key, db, username, password, use_x509):
             message = u"Mongo: cannot connect with config `%s`" % clean_server_name
             self.service_check(
                 self.SERVICE_CHECK_NAME,
@@ -734,9 +828,7 @@ class MongoDb(AgentCheck):
         ops = db.current_op()
         status['fsyncLocked'] = 1 if ops.get('fsyncLock') else 0
 
-        status['stats'] = db.command('dbstats')
         dbstats = {}
-        dbstats[db_name] = {'stats': status['stats']}
 
         # Handle replica data, if any
         # See
@@ -752,15 +844,12 @@ class MongoDb(AgentCheck):
 
                 # need a new connection to deal with replica sets
                 setname = replSet.get('set')
-                cli = pymongo.mongo_client.MongoClient(
-                    server,
-                    socketTimeoutMS=timeout,
-                    replicaset=setname,
-                    read_preference=pymongo.ReadPreference.NEAREST,
-                    **ssl_params)
+                cli, client_key = self._get_client(
+                    server, timeout, ssl_params, replicaset=setname,
+                    read_preference=pymongo.ReadPreference.NEAREST)
                 db = cli[db_name]
 
-                if do_auth and not self._authenticate(db, username, password, use_x509):
+                if do_auth and not self._authenticate_client(client_key, db, username, password, use_x509):
                     message = ("Mongo: cannot connect with config %s" % server)
                     self.service_check(
                         self.SERVICE_CHECK_NAME,
@@ -829,9 +918,13 @@ class MongoDb(AgentCheck):
             pass
 
         dbnames = cli.database_names()
-        for db_n in dbnames:
+        # The `dbstats` of large deployments are spread over `dbstats_interval`
+        stats_dbnames = dbnames if db_name in dbnames else [db_name] + dbnames
+        for db_n in dbstats_refresh.due(stats_dbnames):
             db_aux = cli[db_n]
             dbstats[db_n] = {'stats': db_aux.command('dbstats')}
+        if db_name in dbstats:
+            status['stats'] = dbstats[db_name]['stats']
 
         # Go through the metrics and save the values
         for metric_name in metrics_to_collect:
@@ -978,8 +1071,8 @@ class MongoDb(AgentCheck):
             db = cli[db_name]
             # grab the collections from the configutation
             coll_names = instance.get('collections', [])
-            # loop through the collections
-            for coll_name in coll_names:
+            # loop through the collections due for a refresh
+            for coll_name in collstats_refresh.due(coll_names):
                 # grab the stats from the collection
                 stats = db.command("collstats", coll_name)
                 # loop through the metrics
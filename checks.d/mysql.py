@@ -1,5 +1,6 @@
 # stdlib
 import re
+import time
 import traceback
 from contextlib import closing, contextmanager
 from collections import defaultdict
@@ -268,6 +269,40 @@ SYNTHETIC_VARS = {
     'Qcache_instant_utilization': ('mysql.performance.qcache.utilization.instant', GAUGE),
 }
 
+# Seconds the results of the queries on slow-changing server settings are reused for.
+# They are queried again when the check reconnects, the server may have been restarted.
+CACHE_TTL = {
+    'version': 3600,
+    'variables': 300,
+    'innodb_enabled': 3600,
+    'server_pid': 300,
+}
+
+# SHOW ENGINE INNODB STATUS sections are titled by a line between two dashed lines.
+# The patterns below start with a newline rather than `^`, as a literal prefix
+# is much faster to search for.
+INNODB_SECTION_HEADER = re.compile(r'\n-{3,}\n([^-\n][^\n]*)\n-{3,}(?=\n)')
+# Sections parsed one line at a time, SEMAPHORES and TRANSACTIONS have their own parsers
+INNODB_LINE_SECTIONS = frozenset([
+    'FILE I/O',
+    'INSERT BUFFER AND ADAPTIVE HASH INDEX',
+    'LOG',
+    'BUFFER POOL AND MEMORY',
+    'ROW OPERATIONS',
+])
+INNODB_SEMAPHORE_WAIT = re.compile(r' for (\S+) seconds the semaphore:')
+INNODB_SPIN_LINE = re.compile(r'\n((?:Mutex spin waits|RW-shared spins|RW-excl spins) [^\n]*)')
+INNODB_HISTORY_LIST_LENGTH = re.compile(r'\nHistory list length (\d+)')
+INNODB_READ_VIEWS = re.compile(r'\n(\d+) read views open inside InnoDB')
+INNODB_TRANSACTION = re.compile(r'\n---TRANSACTION([^\n]*)')
+INNODB_TRX_WAITING = re.compile(r'\n------- TRX HAS BEEN WAITING (\d+) SEC')
+INNODB_TABLES_IN_USE = re.compile(r'\nmysql tables in use (\d+), locked (\d+)')
+INNODB_LOCK_STRUCTS = re.compile(r'\n(LOCK WAIT |ROLLING BACK )?(\d+) lock struct\(s\)')
+
+# Delay before reconnecting after a failed connection, doubled at each new failure
+RECONNECT_BACKOFF_BASE = 10  # seconds
+RECONNECT_BACKOFF_MAX = 300
+
 
 class MySql(AgentCheck):
     SERVICE_CHECK_NAME = 'mysql.can_connect'
@@ -276,15 +311,21 @@ class MySql(AgentCheck):
 
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
-        self.mysql_version = {}
         self.qcache_stats = {}
 
+        # All by host key
+        self.connections = {}
+        self._reconnect_backoff = {}
+        self._cache = {}
+        self._latest_heavy_queries = {}
+
     def get_library_versions(self):
         return {"pymysql": pymysql.__version__}
 
     def check(self, instance):
         host, port, user, password, mysql_sock, defaults_file, tags, options, queries, ssl, connect_timeout = \
             self._get_config(instance)
+        persistent = _is_affirmative(instance.get('persistent_connection', True))
 
         self._set_qcache_stats()
 
@@ -292,7 +333,7 @@ class MySql(AgentCheck):
             raise Exception("Mysql host and user are needed.")
 
         with self._connect(host, port, mysql_sock, user,
-                           password, defaults_file, ssl, connect_timeout) as db:
+                           password, defaults_file, ssl, connect_timeout, persistent) as db:
             try:
                 # Metadata collection
                 self._collect_metadata(db, host)
@@ -308,6 +349,10 @@ class MySql(AgentCheck):
                 self.log.exception("error!")
                 raise e
 
+    def stop(self):
+        for host_key in self.connections.keys():
+            self._close_connection(host_key)
+
     def _get_config(self, instance):
         self.host = instance.get('server', '')
         self.port = int(instance.get('port', 0))
@@ -353,32 +398,76 @@ class MySql(AgentCheck):
         return hostkey
 
     @contextmanager
-    def _connect(self, host, port, mysql_sock, user, password, defaults_file, ssl, connect_timeout):
+    def _connect(self, host, port, mysql_sock, user, password, defaults_file, ssl, connect_timeout,
+                 persistent=False):
         self.service_check_tags = [
             'server:%s' % (mysql_sock if mysql_sock != '' else host),
             'port:%s' % ('unix_socket' if port == 0 else port)
         ]
+        if defaults_file == '' and mysql_sock != '':
+            self.service_check_tags = [
+                'server:{0}'.format(mysql_sock),
+                'port:unix_socket'
+            ]
 
+        host_key = self._get_host_key()
         db = None
+        try:
+            db = self.connections.get(host_key)
+            if db is not None:
+                try:
+                    db.ping(reconnect=False)
+                    self.log.debug("Reusing MySQL connection")
+                except Exception as e:
+                    self.log.debug("MySQL connection lost, reconnecting: %s", e)
+                    self._close_connection(host_key)
+                    db = None
+
+            if db is None:
+                db = self._open_connection(host_key, host, port, mysql_sock, user, password,
+                                           defaults_file, ssl, connect_timeout)
+                if persistent:
+                    self.connections[host_key] = db
+
+            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK,
+                               tags=self.service_check_tags)
+            yield db
+        except Exception:
+            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
+                               tags=self.service_check_tags)
+            # The connection may be left in a broken state, open a new one next time
+            self._close_connection(host_key)
+            raise
+        finally:
+            if db and not persistent:
+                db.close()
+
+    def _open_connection(self, host_key, host, port, mysql_sock, user, password, defaults_file, ssl,
+                         connect_timeout):
+        failures, retry_ts = self._reconnect_backoff.get(host_key, (0, 0))
+        now = time.time()
+        if now < retry_ts:
+            raise Exception("Not reconnecting to MySQL for another {0:.0f}s after {1} failed attempt(s)"
+                            .format(retry_ts - now, failures))
+
         try:
             ssl = dict(ssl) if ssl else None
 
+            # Autocommit so that queries on a long-lived connection don't read from a stale snapshot
             if defaults_file != '':
                 db = pymysql.connect(
                     read_default_file=defaults_file,
                     ssl=ssl,
-                    connect_timeout=connect_timeout
+                    connect_timeout=connect_timeout,
+                    autocommit=True
                 )
             elif mysql_sock != '':
-                self.service_check_tags = [
-                    'server:{0}'.format(mysql_sock),
-                    'port:unix_socket'
-                ]
                 db = pymysql.connect(
                     unix_socket=mysql_sock,
                     user=user,
                     passwd=password,
-                    connect_timeout=connect_timeout
+                    connect_timeout=connect_timeout,
+                    autocommit=True
                 )
             elif port:
                 db = pymysql.connect(
@@ -387,7 +476,8 @@ class MySql(AgentCheck):
                     user=user,
                     passwd=password,
                     ssl=ssl,
-                    connect_timeout=connect_timeout
+                    connect_timeout=connect_timeout,
+                    autocommit=True
                 )
             else:
                 db = pymysql.connect(
@@ -395,19 +485,49 @@ class MySql(AgentCheck):
                     user=user,
                     passwd=password,
                     ssl=ssl,
-                    connect_timeout=connect_timeout
+                    connect_timeout=connect_timeout,
+                    autocommit=True
                 )
-            self.log.debug("Connected to MySQL")
-            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK,
-                               tags=self.service_check_tags)
-            yield db
         except Exception:
-            self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
-                               tags=self.service_check_tags)
+            failures += 1
+            backoff = min(RECONNECT_BACKOFF_BASE * 2 ** (failures - 1), RECONNECT_BACKOFF_MAX)
+            self._reconnect_backoff[host_key] = (failures, now + backoff)
             raise
-        finally:
-            if db:
+
+        self.log.debug("Connected to MySQL")
+        self._reconnect_backoff.pop(host_key, None)
+        # The server may have been restarted or upgraded since the results were cached
+        self._cache.pop(host_key, None)
+        return db
+
+    def _close_connection(self, host_key):
+        db = self.connections.pop(host_key, None)
+        if db is not None:
+            try:
                 db.close()
+            except Exception as e:
+                self.log.debug("Error closing MySQL connection: %s", e)
+
+    def _get_cached(self, entry, fetch, *args):
+        """ Return the result of `fetch(*args)`, cached for `CACHE_TTL[entry]` seconds. """
+        cache = self._cache.setdefault(self._get_host_key(), {})
+        now = time.time()
+        if entry not in cache or now - cache[entry][0] > CACHE_TTL[entry]:
+            cache[entry] = (now, fetch(*args))
+        return cache[entry][1]
+
+    def _invalidate_cached(self, entry):
+        self._cache.get(self._get_host_key(), {}).pop(entry, None)
+
+    def _heavy_queries_due(self, options):
+        """ Tell if the heavy queries (INNODB STATUS, per schema statistics) must run now. """
+        interval = float(options.get('heavy_queries_interval', 0))
+        host_key = self._get_host_key()
+        now = time.time()
+        if now - self._latest_heavy_queries.get(host_key, 0) < interval:
+            return False
+        self._latest_heavy_queries[host_key] = now
+        return True
 
     def _collect_metrics(self, host, db, tags, options, queries):
 
@@ -416,10 +536,13 @@ class MySql(AgentCheck):
 
         # collect results from db
         results = self._get_stats_from_status(db)
-        results.update(self._get_stats_from_variables(db))
+        results.update(self._get_cached('variables', self._get_stats_from_variables, db))
+        heavy_queries = self._heavy_queries_due(options)
 
-        if (not _is_affirmative(options.get('disable_innodb_metrics', False)) and self._is_innodb_engine_enabled(db)):
-            results.update(self._get_stats_from_innodb_status(db))
+        if (not _is_affirmative(options.get('disable_innodb_metrics', False)) and
+                self._get_cached('innodb_enabled', self._is_innodb_engine_enabled, db)):
+            if heavy_queries:
+                results.update(self._get_stats_from_innodb_status(db))
 
             innodb_keys = [
                 'Innodb_page_size',
@@ -508,7 +631,7 @@ class MySql(AgentCheck):
             metrics.update(GALERA_VARS)
 
         performance_schema_enabled = self._get_variable_enabled(results, 'performance_schema')
-        if _is_affirmative(options.get('extra_performance_metrics', False)) and \
+        if _is_affirmative(options.get('extra_performance_metrics', False)) and heavy_queries and \
                 self._version_compatible(db, host, "5.6.0") and \
                 performance_schema_enabled:
             # report avg query response time per schema to Datadog
@@ -516,7 +639,7 @@ class MySql(AgentCheck):
             results['query_run_time_avg'] = self._query_exec_time_per_schema(db)
             metrics.update(PERFORMANCE_VARS)
 
-        if _is_affirmative(options.get('schema_size_metrics', False)):
+        if _is_affirmative(options.get('schema_size_metrics', False)) and heavy_queries:
             # report avg query response time per schema to Datadog
             results['information_schema_size'] = self._query_size_per_schema(db)
             metrics.update(SCHEMA_VARS)
@@ -646,11 +769,9 @@ class MySql(AgentCheck):
         return version > compat_version
 
     def _get_version(self, db, host):
-        hostkey = self._get_host_key()
-        if hostkey in self.mysql_version:
-            version = self.mysql_version[hostkey]
-            return version
+        return self._get_cached('version', self._query_version, db)
 
+    def _query_version(self, db):
         # Get MySQL version
         with closing(db.cursor()) as cursor:
             cursor.execute('SELECT VERSION()')
@@ -661,7 +782,6 @@ class MySql(AgentCheck):
             # http://dev.mysql.com/doc/refman/4.1/en/information-functions.html#function_version
             version = result[0].split('-')
             version = version[0].split('.')
-            self.mysql_version[hostkey] = version
             return version
 
     def _collect_all_scalars(self, key, dictionary):
@@ -737,7 +857,7 @@ class MySql(AgentCheck):
         pid = None
         # The server needs to run locally, accessed by TCP or socket
         if host in ["localhost", "127.0.0.1"] or db.port == long(0):
-            pid = self._get_server_pid(db)
+            pid = self._get_cached('server_pid', self._get_server_pid, db)
 
         if pid:
             self.log.debug("System metrics for mysql w\ pid: %s" % pid)
@@ -758,6 +878,8 @@ class MySql(AgentCheck):
                     self.rate("mysql.performance.cpu_time", ucpu+scpu, tags=tags)
 
             except Exception:
+                # The server may have been restarted with a new pid
+                self._invalidate_cached('server_pid')
                 self.warning("Error while reading mysql (pid: %s) procfs data\n%s"
                              % (pid, traceback.format_exc()))
 
@@ -901,14 +1023,93 @@ class MySql(AgentCheck):
 
         innodb_status = cursor.fetchone()
         innodb_status_text = innodb_status[2]
+        results = self._parse_innodb_status(innodb_status_text)
+
+        # We need to calculate this metric separately
+        try:
+            results['Innodb_checkpoint_age'] = results[
+                'Innodb_lsn_current'] - results['Innodb_lsn_last_checkpoint']
+        except KeyError as e:
+            self.log.error("Not all InnoDB LSN metrics available, unable to compute: {0}".format(e))
+
+        # Finally we change back the metrics values to string to make the values
+        # consistent with how they are reported by SHOW GLOBAL STATUS
+        for metric, value in results.iteritems():
+            results[metric] = str(value)
+
+        return results
+
+    def _parse_innodb_status(self, innodb_status_text):
+        # The output is split on its section headers first, so that only the
+        # sections feeding metrics are parsed. On busy servers, most of it is
+        # the list of transactions and the latest deadlock, which are either
+        # skipped or only scanned with regular expressions.
         results = defaultdict(int)
+        sections = INNODB_SECTION_HEADER.split(innodb_status_text)
+        if len(sections) < 3:
+            # Not the expected layout, parse every line
+            self._parse_innodb_status_lines(innodb_status_text.splitlines(), results)
+            return results
+
+        for title, body in zip(sections[1::2], sections[2::2]):
+            title = title.strip()
+            if title == 'SEMAPHORES':
+                self._parse_innodb_semaphores(body, results)
+            elif title == 'TRANSACTIONS':
+                self._parse_innodb_transactions(body, results)
+            elif title in INNODB_LINE_SECTIONS:
+                self._parse_innodb_status_lines(body.splitlines(), results)
 
+        return results
+
+    def _parse_innodb_semaphores(self, text, results):
+        # The wait array can list many threads, only the spin lines are tokenised
+        # --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for 1.00 seconds the semaphore:
+        for wait_time in INNODB_SEMAPHORE_WAIT.findall(text):
+            results['Innodb_semaphore_waits'] += 1
+            results['Innodb_semaphore_wait_time'] += long(float(wait_time)) * 1000
+        self._parse_innodb_status_lines(INNODB_SPIN_LINE.findall(text), results)
+
+    def _parse_innodb_transactions(self, text, results):
+        # The list of transactions grows with the number of connections: count
+        # what we need in it without splitting it into lines.
+        match = INNODB_HISTORY_LIST_LENGTH.search(text)
+        if match:
+            # History list length 132
+            results['Innodb_history_list_length'] = long(match.group(1))
+        match = INNODB_READ_VIEWS.search(text)
+        if match:
+            # 1 read views open inside InnoDB
+            results['Innodb_read_views'] = long(match.group(1))
+
+        # ---TRANSACTION 0, not started, process no 13510, OS thread id 1170446656
+        transactions = INNODB_TRANSACTION.findall(text)
+        results['Innodb_current_transactions'] += len(transactions)
+        results['Innodb_active_transactions'] += sum(1 for txn in transactions if 'ACTIVE' in txn)
+
+        # ------- TRX HAS BEEN WAITING 32 SEC FOR THIS LOCK TO BE GRANTED:
+        results['Innodb_row_lock_time'] += sum(long(sec) for sec in INNODB_TRX_WAITING.findall(text)) * 1000
+
+        # mysql tables in use 2, locked 2
+        for in_use, locked in INNODB_TABLES_IN_USE.findall(text):
+            results['Innodb_tables_in_use'] += long(in_use)
+            results['Innodb_locked_tables'] += long(locked)
+
+        # 23 lock struct(s), heap size 3024, undo log entries 27
+        # LOCK WAIT 12 lock struct(s), heap size 3024, undo log entries 5
+        # ROLLING BACK 127539 lock struct(s), heap size 15201832, 4411492 row lock(s), undo log entries 1042488
+        for state, lock_structs in INNODB_LOCK_STRUCTS.findall(text):
+            results['Innodb_lock_structs'] += long(lock_structs)
+            if state.startswith('LOCK WAIT'):
+                results['Innodb_locked_transactions'] += 1
+
+    def _parse_innodb_status_lines(self, lines, results):
         # Here we now parse InnoDB STATUS one line at a time
         # This is heavily inspired by the Percona monitoring plugins work
         txn_seen = False
         prev_line = ''
 
-        for line in innodb_status_text.splitlines():
+        for line in lines:
             line = line.strip()
             row = re.split(" +", line)
             row = [item.strip(',') for item in row]
@@ -1154,20 +1355,6 @@ class MySql(AgentCheck):
 
             prev_line = line
 
-        # We need to calculate this metric separately
-        try:
-            results['Innodb_checkpoint_age'] = results[
-                'Innodb_lsn_current'] - results['Innodb_lsn_last_checkpoint']
-        except KeyError as e:
-            self.log.error("Not all InnoDB LSN metrics available, unable to compute: {0}".format(e))
-
-        # Finally we change back the metrics values to string to make the values
-        # consistent with how they are reported by SHOW GLOBAL STATUS
-        for metric, value in results.iteritems():
-            results[metric] = str(value)
-
-        return results
-
     def _get_variable_enabled(self, results, var):
         enabled = self._collect_string(var, results)
         return (enabled and enabled.lower().strip() == 'on')
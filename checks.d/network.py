@@ -60,6 +60,21 @@ class Network(AgentCheck):
             "LISTEN": "listening",
             "CLOSING": "closing",
         },
+        # `st` column of /proc/net/tcp and tcp6, see include/net/tcp_states.h
+        "proc": {
+            "01": "established",
+            "02": "opening",
+            "03": "opening",
+            "04": "closing",
+            "05": "closing",
+            "06": "time_wait",
+            "07": "closing",
+            "08": "closing",
+            "09": "closing",
+            "0A": "listening",
+            "0B": "closing",
+            "0C": "opening",
+        },
         "psutil": {
             psutil.CONN_ESTABLISHED: "established",
             psutil.CONN_SYN_SENT: "opening",
@@ -170,7 +185,17 @@ class Network(AgentCheck):
 
     def _check_linux(self, instance):
         proc_location = self.agentConfig.get('procfs_path', '/proc').rstrip('/')
+        metrics = None
         if self._collect_cx_state:
+            try:
+                metrics = self._count_proc_cx_state(proc_location)
+            except IOError:
+                self.log.debug("Unable to read connections from %s/net, using `ss`", proc_location)
+            else:
+                for metric, value in metrics.iteritems():
+                    self.gauge(metric, value)
+
+        if self._collect_cx_state and metrics is None:
             try:
                 self.log.debug("Using `ss` to collect connection state")
                 # Try using `ss` for increased performance over `netstat`
@@ -302,6 +327,37 @@ class Network(AgentCheck):
             # On Openshift, /proc/net/snmp is only readable by root
             self.log.debug("Unable to read %s.", proc_snmp_path)
 
+    def _count_proc_cx_state(self, proc_location):
+        """
+        Count the sockets of each state in /proc/net/{tcp,tcp6,udp,udp6}, a line
+        at a time so that memory use doesn't grow with the number of sockets.
+        Returns a dict metric_name -> value, like `_parse_linux_cx_state`.
+        """
+        metrics = dict.fromkeys(self.CX_STATE_GAUGE.values(), 0)
+        tcp_states = self.TCP_STATES['proc']
+        for ip_version in ['4', '6']:
+            suffix = '' if ip_version == '4' else '6'
+
+            counts = defaultdict(int)
+            with open('{}/net/tcp{}'.format(proc_location, suffix), 'r') as proc_tcp:
+                next(proc_tcp, None)
+                #   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+                #    0: 0100007F:0019 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 15426 1 ...
+                for line in proc_tcp:
+                    counts[line.split(None, 4)[3]] += 1
+            for state, count in counts.iteritems():
+                if state in tcp_states:
+                    metrics[self.CX_STATE_GAUGE['tcp' + ip_version, tcp_states[state]]] += count
+
+            udp_count = 0
+            with open('{}/net/udp{}'.format(proc_location, suffix), 'r') as proc_udp:
+                next(proc_udp, None)
+                for _ in proc_udp:
+                    udp_count += 1
+            metrics[self.CX_STATE_GAUGE['udp' + ip_version, 'connections']] += udp_count
+
+        return metrics
+
     # Parse the output of the command that retrieves the connection state (either `ss` or `netstat`)
     # Returns a dict metric_name -> value
     def _parse_linux_cx_state(self, lines, tcp_states, state_col, ip_version=None):
@@ -1,5 +1,6 @@
 
 # stdlib
+from bisect import bisect_right
 from collections import defaultdict
 import time
 
@@ -42,6 +43,84 @@ ATTR_TO_METRIC_RATE = {
 }
 
 
+class ProcessSnapshot(object):
+    """
+    The process table, read once and shared by the instances of a check run:
+    the pids of each process name and the command lines of all processes,
+    joined in a single string so that matching a `search_string` is an
+    in-memory search instead of one /proc read per process.
+    """
+
+    def __init__(self):
+        self.pids = set()
+        self.pids_by_name = defaultdict(set)
+        # Pids whose name or cmdline couldn't be read
+        self.name_denied = set()
+        self.cmdline_denied = set()
+        # Instances which already used the snapshot
+        self.consumers = set()
+
+        self._cmdline_pids = []
+        self._cmdlines = []
+        self._cmdline_starts = None
+        self._cmdline_blob = None
+        self._matches = {}
+
+    def add(self, pid, name, cmdline):
+        self.pids.add(pid)
+        if name is None:
+            self.name_denied.add(pid)
+        else:
+            self.pids_by_name[name].add(pid)
+        if cmdline is None:
+            self.cmdline_denied.add(pid)
+        else:
+            self._cmdline_pids.append(pid)
+            self._cmdlines.append(cmdline)
+
+    def _search_cmdlines(self, string):
+        if not string:
+            return set(self._cmdline_pids)
+        # Arguments can't contain NUL bytes, so it separates command lines
+        if '\0' in string:
+            return set()
+        if self._cmdline_blob is None:
+            self._cmdline_starts = []
+            offset = 0
+            for cmdline in self._cmdlines:
+                self._cmdline_starts.append(offset)
+                offset += len(cmdline) + 1
+            self._cmdline_blob = '\0'.join(self._cmdlines)
+
+        pids = set()
+        starts = self._cmdline_starts
+        blob = self._cmdline_blob
+        position = blob.find(string)
+        while position != -1:
+            index = bisect_right(starts, position) - 1
+            pids.add(self._cmdline_pids[index])
+            # Look for the next match in the following command lines
+            if index + 1 == len(starts):
+                break
+            position = blob.find(string, starts[index + 1])
+        return pids
+
+    def find(self, string, exact_match):
+        """ Pids of the processes named `string`, or whose command line contains it """
+        key = (string, exact_match)
+        if key not in self._matches:
+            # FIXME 6.x: All has been deprecated from the doc, should be removed
+            if string == 'All':
+                denied = self.name_denied if exact_match else self.cmdline_denied
+                pids = self.pids - denied
+            elif exact_match:
+                pids = self.pids_by_name.get(string, set())
+            else:
+                pids = self._search_cmdlines(string)
+            self._matches[key] = pids
+        return self._matches[key]
+
+
 class ProcessCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
@@ -86,6 +165,12 @@ class ProcessCheck(AgentCheck):
         # Process cache, indexed by instance
         self.process_cache = defaultdict(dict)
 
+        # Process table shared by the instances of a run
+        self.process_snapshot = None
+        # pid -> (create_time, name, cmdline) of the processes of the last
+        # snapshot, which don't change during the life of a process
+        self.static_info_cache = {}
+
     def should_refresh_ad_cache(self, name):
         now = time.time()
         return now - self.last_ad_cache_ts.get(name, 0) > self.access_denied_cache_duration
@@ -94,6 +179,57 @@ class ProcessCheck(AgentCheck):
         now = time.time()
         return now - self.last_pid_cache_ts.get(name, 0) > self.pid_cache_duration
 
+    def _get_static_info(self, proc):
+        """
+        (name, cmdline) of a process, cached as long as the pid belongs to
+        the same process. None for the ones that can't be read.
+        """
+        pid = proc.pid
+        create_time = proc.create_time()
+        cached = self.static_info_cache.get(pid)
+        if cached is not None and cached[0] == create_time:
+            return cached[1], cached[2]
+
+        name = cmdline = None
+        try:
+            name = proc.name()
+        except psutil.AccessDenied:
+            pass
+        try:
+            cmdline = ' '.join(proc.cmdline())
+        except psutil.AccessDenied:
+            pass
+        # Access denied errors are retried with the next snapshot
+        if name is not None and cmdline is not None:
+            self.static_info_cache[pid] = (create_time, name, cmdline)
+        return name, cmdline
+
+    def get_process_snapshot(self, name):
+        """
+        Return the snapshot of the process table for the instance `name`.
+        A new one is taken when the instance already used the current one,
+        i.e. once per check run.
+        """
+        snapshot = self.process_snapshot
+        if snapshot is None or name in snapshot.consumers:
+            snapshot = ProcessSnapshot()
+            for proc in psutil.process_iter():
+                try:
+                    proc_name, cmdline = self._get_static_info(proc)
+                except psutil.NoSuchProcess:
+                    self.log.debug('Process %s disappeared while scanning', proc.pid)
+                    continue
+                except psutil.AccessDenied:
+                    proc_name = cmdline = None
+                snapshot.add(proc.pid, proc_name, cmdline)
+
+            for pid in set(self.static_info_cache) - snapshot.pids:
+                del self.static_info_cache[pid]
+            self.process_snapshot = snapshot
+
+        snapshot.consumers.add(name)
+        return snapshot
+
     def find_pids(self, name, search_string, exact_match, ignore_ad=True):
         """
         Create a set of pids of selected processes.
@@ -108,41 +244,18 @@ class ProcessCheck(AgentCheck):
 
         refresh_ad_cache = self.should_refresh_ad_cache(name)
 
-        matching_pids = set()
-
-        for proc in psutil.process_iter():
-            # Skip access denied processes
-            if not refresh_ad_cache and proc.pid in self.ad_cache:
-                continue
+        snapshot = self.get_process_snapshot(name)
+        if refresh_ad_cache:
+            denied = snapshot.name_denied if exact_match else snapshot.cmdline_denied
+            self.ad_cache = (self.ad_cache & snapshot.pids) | denied
+            if denied:
+                ad_error_logger('Access denied to processes with PIDs %s', ', '.join(str(pid) for pid in sorted(denied)))
+                if not ignore_ad:
+                    raise psutil.AccessDenied(min(denied))
 
-            found = False
-            for string in search_string:
-                try:
-                    # FIXME 6.x: All has been deprecated from the doc, should be removed
-                    if string == 'All':
-                        found = True
-                    if exact_match:
-                        if proc.name() == string:
-                            found = True
-                    else:
-                        cmdline = proc.cmdline()
-                        if string in ' '.join(cmdline):
-                            found = True
-                except psutil.NoSuchProcess:
-                    self.log.warning('Process disappeared while scanning')
-                except psutil.AccessDenied as e:
-                    ad_error_logger('Access denied to process with PID %s', proc.pid)
-                    ad_error_logger('Error: %s', e)
-                    if refresh_ad_cache:
-                        self.ad_cache.add(proc.pid)
-                    if not ignore_ad:
-                        raise
-                else:
-                    if refresh_ad_cache:
-                        self.ad_cache.discard(proc.pid)
-                    if found:
-                        matching_pids.add(proc.pid)
-                        break
+        matching_pids = set()
+        for string in search_string:
+            matching_pids.update(snapshot.find(string, exact_match))
 
         self.pid_cache[name] = matching_pids
         self.last_pid_cache_ts[name] = time.time()
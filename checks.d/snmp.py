@@ -1,14 +1,20 @@
 
 # std
-from collections import defaultdict
+import asyncore
+from collections import defaultdict, deque
 from functools import wraps
+from Queue import Empty, Queue
+import threading
+import time
 
 # 3rd party
 from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto import errind
 import pysnmp.proto.rfc1902 as snmp_type
 from pysnmp.smi import builder
 from pysnmp.smi.exval import noSuchInstance, noSuchObject
 from pysnmp.error import PySnmpError
+from pyasn1.type import univ
 
 # project
 from checks.network_checks import NetworkCheck, Status
@@ -36,6 +42,14 @@ SNMP_GAUGES = frozenset([
     snmp_type.Integer32.__name__])
 
 DEFAULT_OID_BATCH_SIZE = 10
+# Rows fetched by each GETBULK request of a table walk, 0 walks with GETNEXT
+DEFAULT_BULK_MAX_REPETITIONS = 0
+# Devices polled at the same time by the asynchronous poller
+DEFAULT_ASYNC_MAX_DEVICES = 256
+# Seconds the asynchronous poller waits on its sockets between timer ticks
+POLLER_POLL_INTERVAL = 0.1
+# Seconds the asynchronous poller waits for a device to poll when idle
+POLLER_IDLE_WAIT = 1
 
 
 def reply_invalid(oid):
@@ -43,6 +57,100 @@ def reply_invalid(oid):
         noSuchObject.isSameTypeWith(oid)
 
 
+class DevicePoll(object):
+    '''
+    State of the asynchronous poll of one device: the requests still in
+    flight and the variables collected so far, per lookup_names.
+    '''
+
+    def __init__(self, poller, instance, metrics, tags, transport_target, auth_data, enforce_constraints):
+        self.poller = poller
+        self.instance = instance
+        self.metrics = metrics
+        self.tags = tags
+        self.transport_target = transport_target
+        self.auth_data = auth_data
+        self.enforce_constraints = enforce_constraints
+        self.binds = {True: [], False: []}
+        # The groups of oids queried, and those whose requests failed
+        self.queried = set()
+        self.failed = set()
+        self.pending = 0
+        self.start_time = time.time()
+
+
+class SnmpPoller(object):
+    '''
+    Poll SNMP devices asynchronously from a single thread.
+
+    All the requests go through one asynchronous command generator, and its
+    asyncore dispatcher runs in the poller thread: up to `max_devices`
+    devices are polled at once, each with all its requests in flight.
+    Instances are submitted from the check and polled in order, the check
+    gets the results back on its `resultsq` like from its thread pool.
+    '''
+
+    def __init__(self, check, cmd_generator, max_devices=DEFAULT_ASYNC_MAX_DEVICES):
+        self.check = check
+        self.log = check.log
+        self.cmd_generator = cmd_generator
+        self.max_devices = max_devices
+        self.in_flight = 0
+        self._submitted = Queue()
+        self._backlog = deque()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='snmp-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._submitted.put(None)
+        if self._thread is not None:
+            self._thread.join(POLLER_IDLE_WAIT + 1)
+        dispatcher = self.cmd_generator.snmpEngine.transportDispatcher
+        if dispatcher is not None:
+            dispatcher.closeDispatcher()
+
+    def submit(self, instance):
+        self._submitted.put(instance)
+
+    def done(self):
+        self.in_flight -= 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._dequeue(block=not self.in_flight and not self._backlog)
+            while self._backlog and self.in_flight < self.max_devices and not self._stopped.is_set():
+                self.in_flight += 1
+                self.check.start_poll(self, self._backlog.popleft())
+            if self.in_flight:
+                self._poll()
+
+    def _dequeue(self, block):
+        try:
+            instance = self._submitted.get(block, POLLER_IDLE_WAIT)
+            while True:
+                if instance is not None:
+                    self._backlog.append(instance)
+                instance = self._submitted.get_nowait()
+        except Empty:
+            pass
+
+    def _poll(self):
+        dispatcher = self.cmd_generator.snmpEngine.transportDispatcher
+        if dispatcher is None:
+            return
+        try:
+            asyncore.loop(POLLER_POLL_INTERVAL, use_poll=True, map=dispatcher.getSocketMap(), count=1)
+            dispatcher.handleTimerTick(time.time())
+        except Exception:
+            self.log.exception("Error while polling SNMP devices")
+
+
 class SnmpCheck(NetworkCheck):
 
     SOURCE_TYPE_NAME = 'system'
@@ -62,6 +170,14 @@ class SnmpCheck(NetworkCheck):
         # Set OID batch size
         self.oid_batch_size = int(init_config.get("oid_batch_size", DEFAULT_OID_BATCH_SIZE))
 
+        # Walk tables with GETBULK requests of `bulk_max_repetitions` rows
+        self.bulk_max_repetitions = int(init_config.get("bulk_max_repetitions", DEFAULT_BULK_MAX_REPETITIONS))
+
+        # Poll all the devices from a single thread instead of the thread pool
+        self.async_polling = _is_affirmative(init_config.get("async_polling", False))
+        self.async_max_devices = int(init_config.get("async_max_devices", DEFAULT_ASYNC_MAX_DEVICES))
+        self.poller = None
+
         # Load Custom MIB directory
         self.mibs_path = None
         self.ignore_nonincreasing_oid = False
@@ -72,6 +188,46 @@ class SnmpCheck(NetworkCheck):
 
         NetworkCheck.__init__(self, name, init_config, agentConfig, instances)
 
+    def start_pool(self):
+        if not self.async_polling:
+            return NetworkCheck.start_pool(self)
+
+        self.log.info("Starting SNMP poller")
+        self.pool_size = self.async_max_devices
+        self.resultsq = Queue()
+        self.jobs_status = {}
+        self.jobs_results = {}
+        cmd_generator = self.create_command_generator(self.mibs_path, self.ignore_nonincreasing_oid,
+                                                      asynchronous=True)
+        self.poller = SnmpPoller(self, cmd_generator, self.async_max_devices)
+        self.poller.start()
+        self.pool_started = True
+
+    def stop_pool(self):
+        if not self.async_polling:
+            return NetworkCheck.stop_pool(self)
+
+        self.log.info("Stopping SNMP poller")
+        if self.pool_started:
+            self.poller.stop()
+            self.poller = None
+            self.jobs_status.clear()
+
+    def check(self, instance):
+        if not self.async_polling:
+            return NetworkCheck.check(self, instance)
+
+        if not self.pool_started:
+            self.start_pool()
+        self._process_results()
+        self._clean()
+        name = instance['name']
+        if name not in self.jobs_status:
+            self.jobs_status[name] = time.time()
+            self.poller.submit(instance)
+        else:
+            self.log.error("Instance: %s skipped because it's already running." % name)
+
     def _load_conf(self, instance):
         tags = instance.get("tags", [])
         ip_address = instance["ip_address"]
@@ -82,7 +238,8 @@ class SnmpCheck(NetworkCheck):
 
         instance_key = instance['name']
         cmd_generator = self.generators.get(instance_key, None)
-        if not cmd_generator:
+        # The asynchronous poller has its own command generator
+        if not cmd_generator and not self.async_polling:
             cmd_generator = self.create_command_generator(self.mibs_path, self.ignore_nonincreasing_oid)
             self.generators[instance_key] = cmd_generator
 
@@ -120,13 +277,18 @@ class SnmpCheck(NetworkCheck):
             return result
         return wrapper
 
-    def create_command_generator(self, mibs_path, ignore_nonincreasing_oid):
+    def create_command_generator(self, mibs_path, ignore_nonincreasing_oid, asynchronous=False):
         '''
         Create a command generator to perform all the snmp query.
         If mibs_path is not None, load the mibs present in the custom mibs
         folder. (Need to be in pysnmp format)
+        If asynchronous is True, create the command generator of the
+        asynchronous poller instead.
         '''
-        cmd_generator = cmdgen.CommandGenerator()
+        if asynchronous:
+            cmd_generator = cmdgen.AsynCommandGenerator()
+        else:
+            cmd_generator = cmdgen.CommandGenerator()
         cmd_generator.ignoreNonIncreasingOid = ignore_nonincreasing_oid
 
         if mibs_path is not None:
@@ -192,7 +354,19 @@ class SnmpCheck(NetworkCheck):
         port = int(instance.get("port", 161)) # Default SNMP port
         return cmdgen.UdpTransportTarget((ip_address, port), timeout=timeout, retries=retries)
 
+    def get_bulk_max_repetitions(self, instance):
+        '''
+        Number of rows each GETBULK request fetches when walking a table.
+        0 when tables should be walked with GETNEXT requests, which is always
+        the case for SNMP v1 devices as GETBULK was introduced with v2.
+        '''
+        if "community_string" in instance and int(instance.get("snmp_version", 2)) == 1:
+            return 0
+        return int(instance.get("bulk_max_repetitions", self.bulk_max_repetitions))
+
     def raise_on_error_indication(self, error_indication, instance):
+        if isinstance(error_indication, errind.RequestTimedOut):
+            instance["snmp_timeouts"] = instance.get("snmp_timeouts", 0) + 1
         if error_indication:
             message = "{0} for instance {1}".format(error_indication,
                                                     instance["ip_address"])
@@ -217,16 +391,18 @@ class SnmpCheck(NetworkCheck):
         # snmpgetnext -v2c -c public localhost:11111 1.36.1.2.1.25.4.2.1.7.222
         # iso.3.6.1.2.1.25.4.2.1.7.224 = INTEGER: 2
         # SOLUTION: perform a snmget command and fallback with snmpgetnext if not found
+        # Tables are walked with snmpgetbulk instead, if bulk_max_repetitions is set.
 
-        # Set aliases for snmpget and snmpgetnext with logging
+        # Set aliases for snmpget, snmpgetnext and snmpgetbulk with logging
         snmpget = self.snmp_logger(cmd_generator.getCmd)
         snmpgetnext = self.snmp_logger(cmd_generator.nextCmd)
+        snmpgetbulk = self.snmp_logger(cmd_generator.bulkCmd)
         transport_target = self.get_transport_target(instance, timeout, retries)
         auth_data = self.get_auth_data(instance)
+        max_repetitions = self.get_bulk_max_repetitions(instance)
 
         first_oid = 0
         all_binds = []
-        results = defaultdict(dict)
 
         while first_oid < len(oids):
             try:
@@ -241,26 +417,25 @@ class SnmpCheck(NetworkCheck):
                 # Raise on error_indication
                 self.raise_on_error_indication(error_indication, instance)
 
-                missing_results = []
-                complete_results = []
-
-                for var in var_binds:
-                    result_oid, value = var
-                    if reply_invalid(value):
-                        oid_tuple = result_oid.asTuple()
-                        oid = ".".join([str(i) for i in oid_tuple])
-                        missing_results.append(oid)
-                    else:
-                        complete_results.append(var)
+                missing_results, complete_results = self.split_missing_results(var_binds)
 
                 if missing_results:
                     # If we didn't catch the metric using snmpget, try snmpnext
-                    error_indication, error_status, error_index, var_binds_table = snmpgetnext(
-                        auth_data,
-                        transport_target,
-                        *missing_results,
-                        lookupValues=enforce_constraints,
-                        lookupNames=lookup_names)
+                    if max_repetitions:
+                        error_indication, error_status, error_index, var_binds_table = snmpgetbulk(
+                            auth_data,
+                            transport_target,
+                            0, max_repetitions,
+                            *missing_results,
+                            lookupValues=enforce_constraints,
+                            lookupNames=lookup_names)
+                    else:
+                        error_indication, error_status, error_index, var_binds_table = snmpgetnext(
+                            auth_data,
+                            transport_target,
+                            *missing_results,
+                            lookupValues=enforce_constraints,
+                            lookupNames=lookup_names)
 
                     # Raise on error_indication
                     self.raise_on_error_indication(error_indication, instance)
@@ -271,8 +446,7 @@ class SnmpCheck(NetworkCheck):
                         instance["service_check_error"] = message
                         self.warning(message)
 
-                    for table_row in var_binds_table:
-                        complete_results.extend(table_row)
+                    complete_results.extend(self.walked_binds(missing_results, var_binds_table))
 
                 all_binds.extend(complete_results)
 
@@ -290,6 +464,49 @@ class SnmpCheck(NetworkCheck):
         if "service_check_severity" in instance and len(all_binds):
             instance["service_check_severity"] = Status.WARNING
 
+        return self.build_results(all_binds, lookup_names)
+
+    def split_missing_results(self, var_binds):
+        '''
+        Split the variables returned by a snmpget between the oids that
+        aren't instances, and should be walked, and the complete results.
+        '''
+        missing_results = []
+        complete_results = []
+
+        for var in var_binds:
+            result_oid, value = var
+            if reply_invalid(value):
+                oid_tuple = result_oid.asTuple()
+                oid = ".".join([str(i) for i in oid_tuple])
+                missing_results.append(oid)
+            else:
+                complete_results.append(var)
+
+        return missing_results, complete_results
+
+    def walked_binds(self, walked_oids, var_binds_table):
+        '''
+        Flatten the rows returned by a walk of walked_oids, leaving out the
+        variables past the end of the walked subtrees: a snmpgetbulk response
+        can run over the end of a table, into the next columns.
+        '''
+        prefixes = [tuple(int(i) for i in oid.split('.')) for oid in walked_oids]
+        binds = []
+        for table_row in var_binds_table:
+            for prefix, var in zip(prefixes, table_row):
+                result_oid, value = var
+                if result_oid.asTuple()[:len(prefix)] == prefix and not isinstance(value, univ.Null):
+                    binds.append(var)
+        return binds
+
+    def build_results(self, all_binds, lookup_names):
+        '''
+        Returns a dictionary:
+        dict[oid/metric_name][row index] = value
+        In case of scalar objects, the row index is just 0
+        '''
+        results = defaultdict(dict)
         for result_oid, value in all_binds:
             if lookup_names:
                 _, metric, indexes = result_oid.getMibSymbol()
@@ -311,6 +528,37 @@ class SnmpCheck(NetworkCheck):
 
         tags += ['snmp_device:{0}'.format(ip_address)]
 
+        table_oids, raw_oids = self.get_oids(metrics)
+        # Timeouts are reported per poll
+        instance["snmp_timeouts"] = 0
+        start_time = time.time()
+        try:
+            if table_oids:
+                self.log.debug("Querying device %s for %s oids", ip_address, len(table_oids))
+                table_results = self.check_table(instance, cmd_generator, table_oids, True, timeout, retries,
+                                                 enforce_constraints=enforce_constraints)
+                self.report_table_metrics(metrics, table_results, tags)
+
+            if raw_oids:
+                self.log.debug("Querying device %s for %s oids", ip_address, len(raw_oids))
+                raw_results = self.check_table(instance, cmd_generator, raw_oids, False, timeout, retries,
+                                               enforce_constraints=False)
+                self.report_raw_metrics(metrics, raw_results, tags)
+        except Exception as e:
+            if "service_check_error" not in instance:
+                instance["service_check_error"] = "Fail to collect metrics for {0} - {1}".format(instance['name'], e)
+            self.warning(instance["service_check_error"])
+            return [(self.SC_STATUS, Status.CRITICAL, instance["service_check_error"])]
+        finally:
+            # Report service checks
+            self.report_poll_stats(instance, tags, start_time)
+            return self.get_service_check_statuses(instance)
+
+    def get_oids(self, metrics):
+        '''
+        Split the oids to query between those that have MIB associated, and
+        should be looked up, and those specified by oids
+        '''
         table_oids = []
         raw_oids = []
 
@@ -328,33 +576,166 @@ class SnmpCheck(NetworkCheck):
                 raw_oids.append(metric['OID'])
             else:
                 raise Exception('Unsupported metric in config file: %s' % metric)
+
+        return table_oids, raw_oids
+
+    def get_service_check_statuses(self, instance):
+        if "service_check_error" in instance:
+            status = Status.DOWN
+            if "service_check_severity" in instance:
+                status = instance["service_check_severity"]
+            return [(self.SC_STATUS, status, instance["service_check_error"])]
+
+        return [(self.SC_STATUS, Status.UP, None)]
+
+    def report_poll_stats(self, instance, tags, start_time):
+        '''
+        Report how long the device took to poll, and how many of the
+        requests sent to it timed out
+        '''
+        self.gauge('snmp.device.poll_time', time.time() - start_time, tags=tags)
+        self.gauge('snmp.device.timeouts', instance.get("snmp_timeouts", 0), tags=tags)
+
+    def start_poll(self, poller, instance):
+        '''
+        Send the snmpget requests of an asynchronous poll, from the poller
+        thread. The poll goes on in the callbacks of the requests, that send
+        the table walks, until the last response is received.
+        '''
         try:
-            if table_oids:
-                self.log.debug("Querying device %s for %s oids", ip_address, len(table_oids))
-                table_results = self.check_table(instance, cmd_generator, table_oids, True, timeout, retries,
-                                                 enforce_constraints=enforce_constraints)
-                self.report_table_metrics(metrics, table_results, tags)
+            _, ip_address, tags, metrics, timeout, retries, enforce_constraints = self._load_conf(instance)
+            tags += ['snmp_device:{0}'.format(ip_address)]
+            table_oids, raw_oids = self.get_oids(metrics)
+            instance["snmp_timeouts"] = 0
+            poll = DevicePoll(poller, instance, metrics, tags,
+                              self.get_transport_target(instance, timeout, retries),
+                              self.get_auth_data(instance), enforce_constraints)
+        except Exception as e:
+            if "service_check_error" not in instance:
+                instance["service_check_error"] = "Fail to collect metrics for {0} - {1}".format(instance['name'], e)
+            self.warning(instance["service_check_error"])
+            self.put_statuses(instance)
+            poller.done()
+            return
 
-            if raw_oids:
-                self.log.debug("Querying device %s for %s oids", ip_address, len(raw_oids))
-                raw_results = self.check_table(instance, cmd_generator, raw_oids, False, timeout, retries,
-                                               enforce_constraints=False)
-                self.report_raw_metrics(metrics, raw_results, tags)
+        # Hold the poll until all the requests are sent, in case they fail right away
+        poll.pending += 1
+        for lookup_names, oids in ((True, table_oids), (False, raw_oids)):
+            if oids:
+                self.log.debug("Querying device %s for %s oids", ip_address, len(oids))
+                poll.queried.add(lookup_names)
+            for first_oid in xrange(0, len(oids), self.oid_batch_size):
+                self._send_request(poll, lookup_names, oids[first_oid:first_oid + self.oid_batch_size],
+                                   poller.cmd_generator.getCmd, self._on_get)
+        self._request_done(poll)
+
+    def _send_request(self, poll, lookup_names, oids, command, callback, *args):
+        poll.pending += 1
+        try:
+            self.log.debug("Running SNMP command {0} on OIDS {1}".format(command.__name__, oids))
+            command(poll.auth_data, poll.transport_target, *(args + (oids, )),
+                    cbInfo=(callback, (poll, lookup_names, oids)),
+                    lookupNames=lookup_names,
+                    lookupValues=lookup_names and poll.enforce_constraints)
+        except Exception as e:
+            instance = poll.instance
+            if "service_check_error" not in instance:
+                instance["service_check_error"] = "Fail to collect some metrics: {0}".format(e)
+            if "service_check_severity" not in instance:
+                instance["service_check_severity"] = Status.CRITICAL
+            self.warning("Fail to collect some metrics: {0}".format(e))
+            self._request_done(poll)
+
+    def _on_error_indication(self, poll, lookup_names, error_indication):
+        try:
+            self.raise_on_error_indication(error_indication, poll.instance)
+        except Exception:
+            poll.failed.add(lookup_names)
+            return True
+        return False
+
+    def _on_get(self, send_request_handle, error_indication, error_status, error_index, var_binds, cb_ctx):
+        poll, lookup_names, oids = cb_ctx
+        try:
+            if self._on_error_indication(poll, lookup_names, error_indication):
+                return
+
+            missing_results, complete_results = self.split_missing_results(var_binds)
+            poll.binds[lookup_names].extend(complete_results)
+
+            if missing_results:
+                cmd_generator = poll.poller.cmd_generator
+                max_repetitions = self.get_bulk_max_repetitions(poll.instance)
+                if max_repetitions:
+                    self._send_request(poll, lookup_names, missing_results, cmd_generator.bulkCmd,
+                                       self._on_walk, 0, max_repetitions)
+                else:
+                    self._send_request(poll, lookup_names, missing_results, cmd_generator.nextCmd,
+                                       self._on_walk)
+        except Exception:
+            self.log.exception("Failed to process the SNMP response of %s", poll.instance["ip_address"])
+        finally:
+            self._request_done(poll)
+
+    def _on_walk(self, send_request_handle, error_indication, error_status, error_index, var_binds_table, cb_ctx):
+        '''
+        Collect the rows of a table walk, and return True to get the next ones
+        '''
+        poll, lookup_names, oids = cb_ctx
+        walking = False
+        try:
+            last_rows = False
+            if isinstance(error_indication, errind.OidNotIncreasing) and self.ignore_nonincreasing_oid:
+                error_indication = None
+                last_rows = True
+
+            if self._on_error_indication(poll, lookup_names, error_indication):
+                return False
+
+            if error_status:
+                instance = poll.instance
+                message = "{0} for instance {1}".format(error_status.prettyPrint(), instance["ip_address"])
+                instance["service_check_error"] = message
+                self.warning(message)
+                return False
+
+            poll.binds[lookup_names].extend(self.walked_binds(oids, var_binds_table))
+            walking = not last_rows and bool(self.walked_binds(oids, var_binds_table[-1:]))
+            return walking
+        except Exception:
+            self.log.exception("Failed to process the SNMP response of %s", poll.instance["ip_address"])
+            return False
+        finally:
+            if not walking:
+                self._request_done(poll)
+
+    def _request_done(self, poll):
+        poll.pending -= 1
+        if poll.pending:
+            return
+
+        instance = poll.instance
+        try:
+            for lookup_names, report in ((True, self.report_table_metrics), (False, self.report_raw_metrics)):
+                if lookup_names not in poll.queried or lookup_names in poll.failed:
+                    continue
+                binds = poll.binds[lookup_names]
+                # if we've collected some variables, it's not that bad.
+                if "service_check_severity" in instance and len(binds):
+                    instance["service_check_severity"] = Status.WARNING
+                report(poll.metrics, self.build_results(binds, lookup_names), poll.tags)
         except Exception as e:
             if "service_check_error" not in instance:
                 instance["service_check_error"] = "Fail to collect metrics for {0} - {1}".format(instance['name'], e)
             self.warning(instance["service_check_error"])
-            return [(self.SC_STATUS, Status.CRITICAL, instance["service_check_error"])]
         finally:
-            # Report service checks
-            tags = ["snmp_device:%s" % ip_address]
-            if "service_check_error" in instance:
-                status = Status.DOWN
-                if "service_check_severity" in instance:
-                    status = instance["service_check_severity"]
-                return [(self.SC_STATUS, status, instance["service_check_error"])]
-
-            return [(self.SC_STATUS, Status.UP, None)]
+            self.report_poll_stats(instance, poll.tags, poll.start_time)
+            self.put_statuses(instance)
+            poll.poller.done()
+
+    def put_statuses(self, instance):
+        for sc_name, status, msg in self.get_service_check_statuses(instance):
+            self.resultsq.put((status, msg, sc_name, instance))
 
     def report_as_service_check(self, sc_name, status, instance, msg=None):
         sc_tags = ['snmp_device:{0}'.format(instance["ip_address"])]
@@ -10,7 +10,7 @@ import traceback
 
 # 3p
 from pyVim import connect
-from pyVmomi import vim  # pylint: disable=E0611
+from pyVmomi import vim, vmodl  # pylint: disable=E0611
 
 # project
 from config import _is_affirmative
@@ -33,6 +33,8 @@ REFRESH_MORLIST_INTERVAL = 3 * 60
 REFRESH_METRICS_METADATA_INTERVAL = 10 * 60
 # The amount of jobs batched at the same time in the queue to query available metrics
 BATCH_MORLIST_SIZE = 50
+# The amount of MORs whose metrics are queried in a single QueryPerf call
+BATCH_QUERY_PERF_SIZE = 50
 
 # Time after which we reap the jobs that clog the queue
 # TODO: use it
@@ -286,6 +288,83 @@ class VSphereEvent(object):
         return self.payload
 
 
+class VSphereInventory(object):
+    """ The folders, datacenters, compute resources, hosts and virtual machines
+    of a vCenter, with the few properties the check needs, kept current by a
+    dedicated PropertyCollector.
+
+    The first `update` retrieves the whole inventory, the next ones only the
+    changes since the previous one (`WaitForUpdatesEx`), instead of walking the
+    whole tree again at each refresh.
+    """
+    ENTITY_TYPES = [vim.Folder, vim.Datacenter, vim.ComputeResource, vim.HostSystem, vim.VirtualMachine]
+    PROPERTIES = [
+        (vim.ManagedEntity, ['name', 'parent']),
+        (vim.VirtualMachine, ['runtime.powerState', 'runtime.host', 'customValue']),
+    ]
+
+    def __init__(self, content):
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateContainerView(content.rootFolder, self.ENTITY_TYPES, True)
+
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=self.view, skip=True, selectSet=[traversal])],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=paths) for t, paths in self.PROPERTIES]
+        )
+        # Report whole property values, e.g. the full `customValue` list when it changes
+        self.collector.CreateFilter(spec, partialUpdates=False)
+
+        self.version = ''
+        # str(mor) -> (mor, {property path: value})
+        self.entities = {}
+
+    def update(self):
+        """ Apply the changes made since the last update. Return the number of entities that changed. """
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        updated = 0
+        while True:
+            update_set = self.collector.WaitForUpdatesEx(self.version, options)
+            if update_set is None:
+                break
+
+            self.version = update_set.version
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    self._apply(object_update)
+                    updated += 1
+
+            if not update_set.truncated:
+                break
+
+        return updated
+
+    def _apply(self, object_update):
+        key = str(object_update.obj)
+        if object_update.kind == 'leave':
+            self.entities.pop(key, None)
+            return
+
+        properties = self.entities.setdefault(key, (object_update.obj, {}))[1]
+        for change in object_update.changeSet:
+            if change.op in ('remove', 'indirectRemove'):
+                properties.pop(change.name, None)
+            else:
+                properties[change.name] = change.val
+
+    def get(self, mor):
+        return self.entities.get(str(mor), (None, {}))
+
+    def destroy(self):
+        try:
+            self.collector.DestroyPropertyCollector()
+            self.view.Destroy()
+        except Exception:
+            # The session is probably gone with them
+            pass
+
+
 def atomic_method(method):
     """ Decorator to catch the exceptions that happen in detached thread atomic tasks
     and display them in the logs.
@@ -346,11 +425,16 @@ class VSphereCheck(AgentCheck):
         self.morlist = {}
         # Metrics metadata, basically perfCounterId -> {name, group, description}
         self.metrics_metadata = {}
+        # Hosts and VMs kept current by the PropertyCollector, by instance key
+        self.inventories = {}
 
         self.latest_event_query = {}
 
     def stop(self):
         self.stop_pool()
+        for inventory in self.inventories.itervalues():
+            inventory.destroy()
+        self.inventories.clear()
 
     def start_pool(self):
         self.log.info("Starting Thread Pool")
@@ -651,26 +735,39 @@ class VSphereCheck(AgentCheck):
         * Do not match the corresponding `*_include_only` regular expressions
         * Is "non-labeled" while `include_only_marked` is enabled (virtual machine only)
         """
-        # Host
         if isinstance(obj, vim.HostSystem):
+            return VSphereCheck._is_entity_excluded('host', obj.name, None, regexes, include_only_marked)
+        elif isinstance(obj, vim.VirtualMachine):
+            # Only fetch the custom values when needed
+            custom_values = obj.customValue if include_only_marked else []
+            return VSphereCheck._is_entity_excluded('vm', obj.name, custom_values, regexes, include_only_marked)
+        return False
+
+    @staticmethod
+    def _is_entity_excluded(mor_type, name, custom_values, regexes, include_only_marked):
+        """
+        Same as `_is_excluded`, from the type, name and custom values of the entity.
+        """
+        # Host
+        if mor_type == 'host':
             # Based on `host_include_only_regex`
             if regexes and regexes.get('host_include') is not None:
-                match = re.search(regexes['host_include'], obj.name)
+                match = re.search(regexes['host_include'], name)
                 if not match:
                     return True
 
         # VirtualMachine
-        elif isinstance(obj, vim.VirtualMachine):
+        elif mor_type == 'vm':
             # Based on `vm_include_only_regex`
             if regexes and regexes.get('vm_include') is not None:
-                match = re.search(regexes['vm_include'], obj.name)
+                match = re.search(regexes['vm_include'], name)
                 if not match:
                     return True
 
             # Based on `include_only_marked`
             if include_only_marked:
                 monitored = False
-                for field in obj.customValue:
+                for field in custom_values or []:
                     if field.value == VM_MONITORING_FLAG:
                         monitored = True
                         break  # we shall monitor
@@ -679,6 +776,64 @@ class VSphereCheck(AgentCheck):
 
         return False
 
+    def _discover_inventory_mor(self, instance_key, inventory, tags, regexes=None, include_only_marked=False):
+        """
+        Same as `_discover_mor`, from the PropertyCollector inventory: hosts and
+        their powered on virtual machines are queued in `self.morlist_raw`,
+        with the same tags.
+        """
+        def parent_tags(props):
+            """ Tags of the ancestors of an entity, top-down """
+            parent_tags = []
+            parent = props.get('parent')
+            while parent is not None:
+                obj, obj_props = inventory.get(parent)
+                if obj is None:
+                    break
+                grand_parent = obj_props.get('parent')
+                if isinstance(obj, vim.ClusterComputeResource):
+                    parent_tags.append(u"vsphere_cluster:{0}".format(obj_props.get('name')))
+                elif isinstance(obj, vim.Datacenter):
+                    parent_tags.append(u"vsphere_datacenter:{0}".format(obj_props.get('name')))
+                # Neither the root folder nor the datacenters' own folders are tagged
+                elif isinstance(obj, vim.Folder) and grand_parent is not None \
+                        and not isinstance(inventory.get(grand_parent)[0], vim.Datacenter):
+                    parent_tags.append(obj_props.get('name'))
+                parent = grand_parent
+            parent_tags.reverse()
+            return parent_tags
+
+        # Host tags, by host
+        host_tags = {}
+        for key, (obj, props) in inventory.entities.items():
+            if not isinstance(obj, vim.HostSystem):
+                continue
+            if self._is_entity_excluded('host', props.get('name'), None, regexes, include_only_marked):
+                self.log.debug(u"Filtered out host '%s'.", props.get('name'))
+                continue
+
+            h_tags = tags + parent_tags(props)
+            self.morlist_raw[instance_key].append(dict(
+                mor_type='host', mor=obj, hostname=props.get('name'), tags=h_tags + [u"vsphere_type:host"]
+            ))
+            host_tags[key] = h_tags + [u"vsphere_host:{}".format(props.get('name'))]
+
+        for obj, props in inventory.entities.values():
+            if not isinstance(obj, vim.VirtualMachine) or props.get('runtime.powerState') != 'poweredOn':
+                continue
+            vm_host = str(props.get('runtime.host'))
+            # VMs of filtered out hosts are filtered out too
+            if vm_host not in host_tags:
+                continue
+            if self._is_entity_excluded('vm', props.get('name'), props.get('customValue'),
+                                        regexes, include_only_marked):
+                self.log.debug(u"Filtered out VM '%s'.", props.get('name'))
+                continue
+
+            self.morlist_raw[instance_key].append(dict(
+                mor_type='vm', mor=obj, hostname=props.get('name'), tags=host_tags[vm_host] + ['vsphere_type:vm']
+            ))
+
     def _cache_morlist_raw(self, instance):
         """
         Initiate the first layer to refresh the list of MORs (`self.morlist`).
@@ -699,7 +854,6 @@ class VSphereCheck(AgentCheck):
         self.morlist_raw[i_key] = []
 
         server_instance = self._get_server_instance(instance)
-        root_folder = server_instance.content.rootFolder
 
         instance_tag = "vcenter_server:%s" % instance.get('name')
         regexes = {
@@ -709,7 +863,23 @@ class VSphereCheck(AgentCheck):
         include_only_marked = _is_affirmative(instance.get('include_only_marked', False))
 
         # Discover hosts and virtual machines
-        self._discover_mor(i_key, root_folder, [instance_tag], regexes, include_only_marked)
+        if _is_affirmative(instance.get('incremental_discovery', True)):
+            inventory = self.inventories.get(i_key)
+            try:
+                if inventory is None:
+                    inventory = self.inventories[i_key] = VSphereInventory(server_instance.content)
+                updated = inventory.update()
+            except Exception:
+                # Start over from a full retrieval next time
+                self.inventories.pop(i_key, None)
+                if inventory is not None:
+                    inventory.destroy()
+                raise
+            self.log.debug("%s entities changed in vCenter instance %s since the last refresh", updated, i_key)
+            self._discover_inventory_mor(i_key, inventory, [instance_tag], regexes, include_only_marked)
+        else:
+            root_folder = server_instance.content.rootFolder
+            self._discover_mor(i_key, root_folder, [instance_tag], regexes, include_only_marked)
 
         self.cache_times[i_key][MORLIST][LAST] = time.time()
 
@@ -824,8 +994,9 @@ class VSphereCheck(AgentCheck):
         return value
 
     @atomic_method
-    def _collect_metrics_atomic(self, instance, mor):
-        """ Task that collects the metrics listed in the morlist for one MOR
+    def _collect_metrics_atomic(self, instance, mors):
+        """ Task that collects the metrics listed in the morlist for a batch of MORs,
+        in a single QueryPerf call
         """
         ### <TEST-INSTRUMENTATION>
         t = Timer()
@@ -834,14 +1005,23 @@ class VSphereCheck(AgentCheck):
         i_key = self._instance_key(instance)
         server_instance = self._get_server_instance(instance)
         perfManager = server_instance.content.perfManager
-        query = vim.PerformanceManager.QuerySpec(maxSample=1,
-                                                 entity=mor['mor'],
-                                                 metricId=mor['metrics'],
-                                                 intervalId=20,
-                                                 format='normal')
-        results = perfManager.QueryPerf(querySpec=[query])
-        if results:
-            for result in results[0].value:
+        queries = [
+            vim.PerformanceManager.QuerySpec(maxSample=1,
+                                             entity=mor['mor'],
+                                             metricId=mor['metrics'],
+                                             intervalId=20,
+                                             format='normal')
+            for mor in mors
+        ]
+        mor_by_name = dict((str(mor['mor']), mor) for mor in mors)
+
+        for entity_metric in perfManager.QueryPerf(querySpec=queries) or []:
+            mor = mor_by_name.get(str(entity_metric.entity))
+            if mor is None:
+                self.log.debug(u"Skipping values of unexpected entity %s", entity_metric.entity)
+                continue
+
+            for result in entity_metric.value:
                 if result.id.counterId not in self.metrics_metadata[i_key]:
                     self.log.debug("Skipping this metric value, because there is no metadata about it")
                     continue
@@ -869,10 +1049,11 @@ class VSphereCheck(AgentCheck):
 
         ### <TEST-INSTRUMENTATION>
         self.histogram('stackstate.agent.vsphere.metric_colection.time', t.total())
+        self.histogram('stackstate.agent.vsphere.query_perf.batch_size', len(mors))
         ### </TEST-INSTRUMENTATION>
 
     def collect_metrics(self, instance):
-        """ Calls asynchronously _collect_metrics_atomic on all MORs, as the
+        """ Calls asynchronously _collect_metrics_atomic on batches of MORs, as the
         job queue is processed the Aggregator will receive the metrics.
         """
         i_key = self._instance_key(instance)
@@ -884,6 +1065,9 @@ class VSphereCheck(AgentCheck):
         self.log.debug("Collecting metrics of %d mors" % len(mors))
 
         vm_count = 0
+        batch_size = int(self.init_config.get('batch_query_perf_size', BATCH_QUERY_PERF_SIZE))
+        batch = []
+        batch_count = 0
 
         for mor_name, mor in mors:
             if mor['mor_type'] == 'vm':
@@ -892,9 +1076,21 @@ class VSphereCheck(AgentCheck):
                 # self.log.debug("Skipping entity %s collection because we didn't cache its metrics yet" % mor['hostname'])
                 continue
 
-            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, mor))
+            batch.append(mor)
+            if len(batch) >= batch_size:
+                self.pool.apply_async(self._collect_metrics_atomic, args=(instance, batch))
+                batch = []
+                batch_count += 1
+
+        if batch:
+            self.pool.apply_async(self._collect_metrics_atomic, args=(instance, batch))
+            batch_count += 1
 
         self.gauge('vsphere.vm.count', vm_count, tags=["vcenter_server:%s" % instance.get('name')])
+        ### <TEST-INSTRUMENTATION>
+        self.gauge('stackstate.agent.vsphere.query_perf.batches', batch_count,
+                   tags=["vcenter_server:%s" % instance.get('name')])
+        ### </TEST-INSTRUMENTATION>
 
     def check(self, instance):
         if not self.pool_started:
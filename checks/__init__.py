@@ -399,7 +399,9 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend'),
+            histogram_relative_accuracy=agentConfig.get('histogram_relative_accuracy')
         )
 
         self.events = []
@@ -7,11 +7,15 @@ of checks.
 from collections import defaultdict
 import cPickle as pickle
 import datetime
+import json
 import logging
 import os
 import platform
+import socket
+import SocketServer
 import sys
 import tempfile
+import threading
 import time
 
 # 3p
@@ -37,6 +41,11 @@ STATUS_WARNING = 'WARNING'
 
 NTP_OFFSET_THRESHOLD = 60
 
+# A status served live by its daemon is only written to disk that often (seconds)
+STATUS_SNAPSHOT_INTERVAL = 60
+STATUS_SOCKET_TIMEOUT = 2  # seconds
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 
 log = logging.getLogger(__name__)
 
@@ -136,13 +145,65 @@ def validate_api_key(config):
 
     return "API Key is valid"
 
+class StatusRequestHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        status = self.server.status
+        if status is None:
+            return
+        try:
+            self.request.sendall(status_to_json(status))
+        except Exception:
+            log.exception("Error serving status")
+
+
+class StatusServer(SocketServer.TCPServer):
+    """
+    Serve the latest status of a daemon as JSON, from memory, to every
+    connection to its Unix socket.
+    """
+    # Not SocketServer.UnixStreamServer, which isn't defined on Windows
+    address_family = getattr(socket, 'AF_UNIX', None)
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            # Left over by a previous run
+            os.remove(path)
+        SocketServer.TCPServer.__init__(self, path, StatusRequestHandler)
+        self.path = path
+        self.status = None
+        self._thread = threading.Thread(target=self.serve_forever, name="StatusServer")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
 class AgentStatus(object):
     """
     A small class used to load and save status messages to the filesystem.
+
+    A daemon calling `serve_status` keeps its latest status in memory and
+    serves it on a Unix socket, `load_latest_status` then gets it from there.
+    It is only written to disk every STATUS_SNAPSHOT_INTERVAL seconds, for
+    the readers that can't use the socket.
     """
 
     NAME = None
 
+    # Status key -> StatusServer serving it from this process
+    _servers = {}
+    # Status key -> time of its last snapshot on disk
+    _snapshot_times = {}
+
     def __init__(self):
         self.created_at = datetime.datetime.now()
         self.created_by_pid = os.getpid()
@@ -150,7 +211,18 @@ class AgentStatus(object):
     def has_error(self):
         raise NotImplementedError
 
+    @classmethod
+    def _status_key(cls, prefix=""):
+        return prefix + cls.__name__
+
     def persist(self, prefix=""):
+        key = self._status_key(prefix)
+        server = AgentStatus._servers.get(key)
+        if server is not None:
+            server.status = self
+            if time.time() - AgentStatus._snapshot_times.get(key, 0) < STATUS_SNAPSHOT_INTERVAL:
+                return
+
         try:
             path = self._get_pickle_path(prefix)
             log.debug("Persisting status to %s" % path)
@@ -159,9 +231,26 @@ class AgentStatus(object):
                 pickle.dump(self, f)
             finally:
                 f.close()
+            AgentStatus._snapshot_times[key] = time.time()
         except Exception:
             log.exception("Error persisting status")
 
+    @classmethod
+    def serve_status(cls, prefix=""):
+        """ Serve the statuses persisted by this process on a Unix socket. """
+        key = cls._status_key(prefix)
+        if key in AgentStatus._servers or not hasattr(socket, 'AF_UNIX'):
+            return
+        path = cls._get_socket_path(prefix)
+        try:
+            server = StatusServer(path)
+            server.start()
+        except Exception:
+            log.warning("Cannot serve the status on %s, it will only be persisted to disk", path, exc_info=True)
+            return
+        log.debug("Serving status on %s" % path)
+        AgentStatus._servers[key] = server
+
     def created_seconds_ago(self):
         td = datetime.datetime.now() - self.created_at
         return td.seconds
@@ -239,13 +328,54 @@ class AgentStatus(object):
     @classmethod
     def remove_latest_status(cls, prefix=""):
         log.debug("Removing latest status")
+        key = cls._status_key(prefix)
+        server = AgentStatus._servers.pop(key, None)
+        if server is not None:
+            server.stop()
+        AgentStatus._snapshot_times.pop(key, None)
         try:
             os.remove(cls._get_pickle_path(prefix))
         except OSError:
             pass
 
+    @classmethod
+    def load_live_status(cls, prefix=""):
+        """ Return the status served by the running daemon, None if it isn't served. """
+        path = cls._get_socket_path(prefix)
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+            return None
+
+        chunks = []
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(STATUS_SOCKET_TIMEOUT)
+        try:
+            sock.connect(path)
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        except socket.error as e:
+            log.debug("Cannot get the status from %s: %s", path, e)
+            return None
+        finally:
+            sock.close()
+
+        if not chunks:
+            return None
+        try:
+            status = status_from_json(''.join(chunks))
+        except (ValueError, KeyError, TypeError):
+            log.debug("Cannot decode the status from %s", path, exc_info=True)
+            return None
+        return status if isinstance(status, cls) else None
+
     @classmethod
     def load_latest_status(cls, prefix=""):
+        status = cls.load_live_status(prefix)
+        if status is not None:
+            return status
+
         try:
             path = cls._get_pickle_path(prefix)
             f = open(path)
@@ -285,7 +415,7 @@ class AgentStatus(object):
         return exit_code
 
     @classmethod
-    def _get_pickle_path(cls, prefix=""):
+    def _get_status_dir(cls):
         if Platform.is_win32():
             path = os.path.join(_windows_commondata_path(), 'StackState')
             if not os.path.isdir(path):
@@ -294,7 +424,15 @@ class AgentStatus(object):
             path = PidFile.get_dir()
         else:
             path = tempfile.gettempdir()
-        return os.path.join(path, prefix + cls.__name__ + '.pickle')
+        return path
+
+    @classmethod
+    def _get_pickle_path(cls, prefix=""):
+        return os.path.join(cls._get_status_dir(), prefix + cls.__name__ + '.pickle')
+
+    @classmethod
+    def _get_socket_path(cls, prefix=""):
+        return os.path.join(cls._get_status_dir(), prefix + cls.__name__ + '.sock')
 
 
 class InstanceStatus(object):
@@ -327,7 +465,7 @@ class CheckStatus(object):
                  service_metadata=[],
                  init_failed_error=None, init_failed_traceback=None,
                  library_versions=None, source_type_name=None,
-                 check_stats=None):
+                 check_stats=None, scheduling_stats=None):
         self.name = check_name
         self.source_type_name = source_type_name
         self.instance_statuses = instance_statuses
@@ -340,6 +478,8 @@ class CheckStatus(object):
         self.library_versions = library_versions
         self.check_stats = check_stats
         self.service_metadata = service_metadata
+        # Set when the checks run concurrently, see checks.scheduler
+        self.scheduling_stats = scheduling_stats
 
     @property
     def status(self):
@@ -354,6 +494,19 @@ class CheckStatus(object):
         return self.status == STATUS_ERROR
 
 
+def scheduling_lines(stats):
+    if not stats:
+        return []
+    line = "    - Scheduling: %s overrun%s, %s timeout%s" % (
+        stats['overruns'], plural(stats['overruns']),
+        stats['timeouts'], plural(stats['timeouts']))
+    if stats['run_time'] is not None:
+        line += ", last queue wait %.2fs, last run time %.2fs" % (stats['queue_wait'], stats['run_time'])
+    if stats.get('running'):
+        line += " (%s)" % style("running", 'yellow')
+    return [line]
+
+
 class EmitterStatus(object):
 
     def __init__(self, name, error=None):
@@ -451,6 +604,8 @@ class CollectorStatus(AgentStatus):
                     "    - Stats: %s" % pretty_statistics(cs.check_stats)
                 ]
 
+            check_lines += scheduling_lines(cs.scheduling_stats)
+
             if cs.library_versions is not None:
                 check_lines += [
                     "    - Dependencies:"]
@@ -596,6 +751,8 @@ class CollectorStatus(AgentStatus):
                             "    - Stats: %s" % pretty_statistics(cs.check_stats)
                         ]
 
+                    check_lines += scheduling_lines(cs.scheduling_stats)
+
                     if cs.library_versions is not None:
                         check_lines += [
                             "    - Dependencies:"]
@@ -689,7 +846,7 @@ class CollectorStatus(AgentStatus):
             if cs.init_failed_error:
                 status_info['checks'][cs.name]['init_failed'] = True
                 status_info['checks'][cs.name]['traceback'] = \
-                    cs.init_failed_traceback or cs.init_failed_error
+                    cs.init_failed_traceback or str(cs.init_failed_error)
             else:
                 status_info['checks'][cs.name] = {'instances': {}}
                 status_info['checks'][cs.name]['init_failed'] = False
@@ -706,6 +863,8 @@ class CollectorStatus(AgentStatus):
                 status_info['checks'][cs.name]['metric_count'] = cs.metric_count
                 status_info['checks'][cs.name]['event_count'] = cs.event_count
                 status_info['checks'][cs.name]['service_check_count'] = cs.service_check_count
+                if cs.scheduling_stats:
+                    status_info['checks'][cs.name]['scheduling'] = cs.scheduling_stats
 
         # Emitter status
         status_info['emitter'] = []
@@ -751,7 +910,9 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'StsStatsD'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-                 metric_count=0, event_count=0, service_check_count=0):
+                 metric_count=0, event_count=0, service_check_count=0,
+                 udp_rx_queue=None, udp_drops=None, context_count=0, context_memory=0,
+                 context_overflow_count=0, top_metric_contexts=None, top_tag_key_contexts=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -759,6 +920,17 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        # Kernel-side counters of the UDP socket, None when unavailable
+        self.udp_rx_queue = udp_rx_queue
+        self.udp_drops = udp_drops
+        # Live contexts before the flush, and approximate bytes used by each
+        self.context_count = context_count
+        self.context_memory = context_memory
+        # Samples folded into overflow series by the context limits, and the
+        # [(name, count)] of the metric names and tag keys creating the most contexts
+        self.context_overflow_count = context_overflow_count
+        self.top_metric_contexts = top_metric_contexts or []
+        self.top_tag_key_contexts = top_tag_key_contexts or []
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -771,7 +943,21 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
+            "Context count: %s" % self.context_count,
+            "Memory per context: %s bytes" % self.context_memory,
+            "Samples over the context limits: %s" % self.context_overflow_count,
         ]
+        if self.top_metric_contexts:
+            lines.append("Top metrics by contexts: %s" % ', '.join(
+                "%s (%s)" % (name, count) for name, count in self.top_metric_contexts))
+        if self.top_tag_key_contexts:
+            lines.append("Top tag keys by contexts: %s" % ', '.join(
+                "%s (%s)" % (key, count) for key, count in self.top_tag_key_contexts))
+        if self.udp_drops is not None:
+            lines += [
+                "UDP receive queue: %s bytes" % self.udp_rx_queue,
+                "UDP packets dropped: %s" % self.udp_drops,
+            ]
         return lines
 
     def to_dict(self):
@@ -783,6 +969,13 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'udp_rx_queue': self.udp_rx_queue,
+            'udp_drops': self.udp_drops,
+            'context_count': self.context_count,
+            'context_memory': self.context_memory,
+            'context_overflow_count': self.context_overflow_count,
+            'top_metric_contexts': self.top_metric_contexts,
+            'top_tag_key_contexts': self.top_tag_key_contexts,
         })
         return status_info
 
@@ -792,7 +985,8 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-                 transactions_flushed=0, transactions_rejected=0):
+                 transactions_flushed=0, transactions_rejected=0, spill_queue_length=None,
+                 spill_queue_size=None, spill_replay_rate=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
@@ -802,6 +996,10 @@ class ForwarderStatus(AgentStatus):
         self.hidden_username = None
         self.hidden_password = None
         self.transactions_rejected = transactions_rejected
+        # Transactions spilled to disk, None when spilling is disabled
+        self.spill_queue_length = spill_queue_length
+        self.spill_queue_size = spill_queue_size
+        self.spill_replay_rate = spill_replay_rate
 
     def body_lines(self):
         lines = [
@@ -811,6 +1009,13 @@ class ForwarderStatus(AgentStatus):
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
             "Transactions rejected: %s" % self.transactions_rejected,
+        ]
+        if self.spill_queue_length is not None:
+            lines += [
+                "Spilled to disk: %s transactions, %s bytes" % (self.spill_queue_length, self.spill_queue_size),
+                "Replayed from disk: %s transactions/s" % self.spill_replay_rate,
+            ]
+        lines += [
             "API Key Status: %s" % validate_api_key(config=get_config()),
             "",
         ]
@@ -828,7 +1033,10 @@ class ForwarderStatus(AgentStatus):
             'queue_size': self.queue_size,
             'transactions_rejected': self.transactions_rejected,
             'transactions_received': self.transactions_received,
-            'transactions_flushed': self.transactions_flushed
+            'transactions_flushed': self.transactions_flushed,
+            'spill_queue_length': self.spill_queue_length,
+            'spill_queue_size': self.spill_queue_size,
+            'spill_replay_rate': self.spill_replay_rate,
         })
         return status_info
 
@@ -857,6 +1065,73 @@ class CheckData(AgentStatus):
         return status_info
 
 
+class ObjectRepr(object):
+    """
+    Stands for a value of a status that can't be serialized to JSON, e.g. the
+    exception of a check that failed to initialize, and renders like it.
+    """
+
+    def __init__(self, text, str_text=None):
+        self.text = text
+        self.str_text = text if str_text is None else str_text
+
+    def __repr__(self):
+        return self.text
+
+    def __str__(self):
+        return self.str_text
+
+
+def _status_classes():
+    return dict((status_class.__name__, status_class) for status_class in (
+        InstanceStatus, CheckStatus, EmitterStatus,
+        CollectorStatus, DogstatsdStatus, ForwarderStatus, CheckData,
+    ))
+
+
+def _encode_status_object(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.strftime(DATETIME_FORMAT)}
+    if type(obj).__name__ in _status_classes():
+        return {'__status_class__': type(obj).__name__, '__dict__': obj.__dict__}
+    return {'__repr__': repr(obj), '__str__': str(obj)}
+
+
+def _decode_status_value(value, status_classes):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_decode_status_value(v, status_classes) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    if '__repr__' in value:
+        str_text = value.get('__str__')
+        return ObjectRepr(value['__repr__'].encode('utf-8'),
+                          str_text.encode('utf-8') if str_text is not None else None)
+    if '__datetime__' in value:
+        return datetime.datetime.strptime(value['__datetime__'], DATETIME_FORMAT)
+    if '__status_class__' in value:
+        status_class = status_classes[value['__status_class__']]
+        obj = status_class.__new__(status_class)
+        obj.__dict__.update(_decode_status_value(value['__dict__'], status_classes))
+        return obj
+    return dict(
+        (_decode_status_value(k, status_classes), _decode_status_value(v, status_classes))
+        for k, v in value.iteritems()
+    )
+
+
+def status_to_json(status):
+    """ Serialize a status, and the statuses it contains, to JSON. """
+    return json.dumps(status, default=_encode_status_object)
+
+
+def status_from_json(data):
+    """ Rebuild a status serialized by `status_to_json`. """
+    return _decode_status_value(json.loads(data), _status_classes())
+
+
 def get_jmx_instance_status(instance_name, status, message, metric_count):
     if status == STATUS_ERROR:
         instance_status = InstanceStatus(instance_name, STATUS_ERROR, error=message, metric_count=metric_count)
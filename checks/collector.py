@@ -27,6 +27,7 @@ from checks.check_status import (
 )
 from checks.datadog import Dogstreams
 from checks.ganglia import Ganglia
+from checks.scheduler import CheckScheduler, DEFAULT_CHECK_RUNNERS, DEFAULT_CHECK_TIMEOUT
 from config import get_system_stats, get_version
 import checks.system.unix as u
 import checks.system.win32 as w32
@@ -48,6 +49,10 @@ FLUSH_LOGGING_PERIOD = 10
 FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
 
+# Data collected from a checks.d check run
+CheckRunResult = collections.namedtuple(
+    'CheckRunResult', ['check', 'status', 'metrics', 'events', 'service_checks', 'topologies'])
+
 
 class AgentPayload(collections.MutableMapping):
     """
@@ -191,6 +196,16 @@ class Collector(object):
         self.hostname_metadata_cache = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        # Latest status of each checks.d check
+        self._check_statuses = {}
+
+        # With more than one check runner, checks.d checks run concurrently
+        self._scheduler = None
+        check_runners = int(agentConfig.get('check_runners', DEFAULT_CHECK_RUNNERS))
+        if check_runners > 1:
+            self._scheduler = CheckScheduler(
+                self._run_check, check_runners,
+                timeout=float(agentConfig.get('check_timeout', DEFAULT_CHECK_TIMEOUT)))
 
         if Platform.is_linux() and psutil is not None:
             procfs_path = agentConfig.get('procfs_path', '/proc').rstrip('/')
@@ -247,6 +262,8 @@ class Collector(object):
         # in which case we'll get a misleading error in the logs.
         # Best to not even try.
         self.continue_running = False
+        if self._scheduler is not None:
+            self._scheduler.stop()
         for check in self.initialized_checks_d:
             check.stop()
 
@@ -391,87 +408,42 @@ class Collector(object):
             if res:
                 metrics.extend(res)
 
-        # Use `info` log level for some messages on the first run only, then `debug`
-        log_at_first_run = log.info if self._is_first_run() else log.debug
-
         # checks.d checks
         check_statuses = []
-        for check in self.initialized_checks_d:
+        if self._scheduler is None:
+            results = []
+            for check in self.initialized_checks_d:
+                if not self.continue_running:
+                    return
+                results.append(self._run_check(check))
+        else:
+            self._scheduler.schedule(self.initialized_checks_d)
+            self._scheduler.wait()
             if not self.continue_running:
                 return
-            log_at_first_run("Running check %s", check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
-
-            try:
-                # Run the check.
-                instance_statuses = check.run()
-
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                current_check_topology_instances = check.get_topology_instances()
-                check_stats = check._get_internal_profiling_stats()
-
-                topologies += current_check_topology_instances
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
-
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
-
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
-
-            except Exception:
-                log.exception("Error running check %s" % check.name)
-
-            check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
-                library_versions=check.get_library_info(),
-                source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats
-            )
-
-            # Service check for Agent checks failures
-            service_check_tags = ["check:%s" % check.name]
-            if check_status.status == STATUS_OK:
-                status = AgentCheck.OK
-            elif check_status.status == STATUS_ERROR:
-                status = AgentCheck.CRITICAL
-            check.service_check('stackstate.agent.check_status', status, tags=service_check_tags)
-
-            # Collect the service checks and save them in the payload
-            current_check_service_checks = check.get_service_checks()
-            if current_check_service_checks:
-                service_checks.extend(current_check_service_checks)
-            # -1 because the user doesn't care about the service check for check failure
-            service_check_count = len(current_check_service_checks) - 1
-
-            # Update the check status with the correct service_check_count
-            check_status.service_check_count = service_check_count
-            check_statuses.append(check_status)
-
-            check_run_time = time.time() - check_start_time
-            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+            # Checks finishing after the timeout are sent with the next payload
+            results = self._scheduler.pop_results()
+
+        for result in results:
+            metrics.extend(result.metrics)
+            service_checks.extend(result.service_checks)
+            topologies += result.topologies
+            if result.events:
+                if result.check.name not in events:
+                    events[result.check.name] = result.events
+                else:
+                    events[result.check.name] += result.events
+            self._check_statuses[result.check.name] = result.status
 
-            # Intrument check run timings if enabled.
-            if self.check_timings:
-                metric = 'stackstate.agent.check_run_time'
-                meta = {'tags': ["check:%s" % check.name]}
-                metrics.append((metric, time.time(), check_run_time, meta))
+        if self._scheduler is None:
+            check_statuses = [result.status for result in results]
+        else:
+            # Keep reporting the latest status of the checks still running
+            for check in self.initialized_checks_d:
+                check_status = self._check_statuses.get(check.name)
+                if check_status is not None:
+                    check_status.scheduling_stats = self._scheduler.get_stats(check.name)
+                    check_statuses.append(check_status)
 
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
@@ -524,7 +496,7 @@ class Collector(object):
         emit_success = all(emitter_status.error is None for emitter_status in emitter_statuses)
         continue_immediately = False
         try:
-            for check in self.initialized_checks_d:
+            for check in [result.check for result in results]:
                 if emit_success:
                     continue_immediately = continue_immediately or check.commit_success()
                 else:
@@ -551,6 +523,69 @@ class Collector(object):
 
         return payload, continue_immediately
 
+    def _run_check(self, check):
+        """
+        Run a checks.d check and collect its data and status.
+        """
+        # Use `info` log level for some messages on the first run only, then `debug`
+        log_at_first_run = log.info if self._is_first_run() else log.debug
+        log_at_first_run("Running check %s", check.name)
+        instance_statuses = []
+        current_check_metrics = []
+        current_check_events = []
+        current_check_topology_instances = []
+        current_check_metadata = []
+        check_start_time = time.time()
+        check_stats = None
+
+        try:
+            # Run the check.
+            instance_statuses = check.run()
+
+            # Collect the metrics and events.
+            current_check_metrics = check.get_metrics()
+            current_check_events = check.get_events()
+            current_check_topology_instances = check.get_topology_instances()
+            check_stats = check._get_internal_profiling_stats()
+
+            # Collect metadata
+            current_check_metadata = check.get_service_metadata()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+
+        check_status = CheckStatus(
+            check.name, instance_statuses, len(current_check_metrics),
+            len(current_check_events), 0, service_metadata=current_check_metadata,
+            library_versions=check.get_library_info(),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_stats=check_stats
+        )
+
+        # Service check for Agent checks failures
+        service_check_tags = ["check:%s" % check.name]
+        if check_status.status == STATUS_OK:
+            status = AgentCheck.OK
+        elif check_status.status == STATUS_ERROR:
+            status = AgentCheck.CRITICAL
+        check.service_check('stackstate.agent.check_status', status, tags=service_check_tags)
+
+        # Collect the service checks
+        current_check_service_checks = check.get_service_checks()
+        # -1 because the user doesn't care about the service check for check failure
+        check_status.service_check_count = len(current_check_service_checks) - 1
+
+        check_run_time = time.time() - check_start_time
+        log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+
+        # Intrument check run timings if enabled.
+        if self.check_timings:
+            metric = 'stackstate.agent.check_run_time'
+            meta = {'tags': ["check:%s" % check.name]}
+            current_check_metrics.append((metric, time.time(), check_run_time, meta))
+
+        return CheckRunResult(check, check_status, current_check_metrics, current_check_events,
+                              current_check_service_checks, current_check_topology_instances)
+
     @staticmethod
     def run_single_check(check, verbose=True):
         log.info("Running check %s" % check.name)
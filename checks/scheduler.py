@@ -0,0 +1,120 @@
+"""
+Run the checks.d checks concurrently, so that a slow check doesn't delay
+the others nor the collection cycle.
+"""
+# stdlib
+import logging
+import threading
+import time
+
+# project
+from checks.libs.thread_pool import Pool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHECK_RUNNERS = 1
+DEFAULT_CHECK_TIMEOUT = 10  # seconds
+
+
+class CheckScheduler(object):
+    """
+    Run checks in a bounded pool of worker threads.
+
+    Each collection, `schedule` queues the checks that are not running
+    anymore: a check still running since a previous collection is skipped
+    and counted as an overrun. `wait` then gives them up to `timeout`
+    seconds to finish; the ones that take longer are counted as timed out
+    and their results are collected whenever they finish, with `pop_results`.
+
+    `run_check(check)` is called in the worker threads and its return value
+    is the check's result.
+    """
+
+    def __init__(self, run_check, workers, timeout=DEFAULT_CHECK_TIMEOUT):
+        self._run_check = run_check
+        self.timeout = timeout
+        self._pool = Pool(workers, name="CheckScheduler")
+        self._cond = threading.Condition()
+        # check -> queue time of the checks queued or running
+        self._pending = {}
+        self._timed_out = set()
+        self._results = []
+        # check name -> scheduling stats
+        self._stats = {}
+
+    def _get_stats(self, name):
+        if name not in self._stats:
+            self._stats[name] = {
+                'queue_wait': None,
+                'run_time': None,
+                'overruns': 0,
+                'timeouts': 0,
+            }
+        return self._stats[name]
+
+    def schedule(self, checks):
+        now = time.time()
+        with self._cond:
+            for check in checks:
+                if check in self._pending:
+                    log.warning("Check %s is still running since %.1fs, skipping it",
+                                check.name, now - self._pending[check])
+                    self._get_stats(check.name)['overruns'] += 1
+                    continue
+                self._pending[check] = now
+                self._pool.apply_async(self._run, args=(check, now))
+
+    def _run(self, check, queued_at):
+        start = time.time()
+        result = None
+        try:
+            result = self._run_check(check)
+        except Exception:
+            log.exception("Error running check %s", check.name)
+        finally:
+            with self._cond:
+                stats = self._get_stats(check.name)
+                stats['queue_wait'] = start - queued_at
+                stats['run_time'] = time.time() - start
+                self._pending.pop(check, None)
+                self._timed_out.discard(check)
+                if result is not None:
+                    self._results.append(result)
+                self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Wait until no check is queued nor running, at most `timeout` seconds.
+        Returns whether all of them finished.
+        """
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        with self._cond:
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            for check in self._pending:
+                if check not in self._timed_out:
+                    log.warning("Check %s didn't finish in %ss, its data will be sent after it does",
+                                check.name, self.timeout)
+                    self._timed_out.add(check)
+                    self._get_stats(check.name)['timeouts'] += 1
+            return not self._pending
+
+    def pop_results(self):
+        """ Return the results of the checks that finished since the last call. """
+        with self._cond:
+            results, self._results = self._results, []
+        return results
+
+    def get_stats(self, name):
+        """ Scheduling stats of a check, with whether it is currently running. """
+        with self._cond:
+            stats = dict(self._get_stats(name))
+            stats['running'] = any(check.name == name for check in self._pending)
+        return stats
+
+    def stop(self):
+        self._pool.terminate()
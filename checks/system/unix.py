@@ -4,6 +4,7 @@ Unix system checks.
 """
 # stdlib
 import operator
+import os
 import platform
 import re
 import sys
@@ -26,6 +27,14 @@ from utils.subprocess_output import get_subprocess_output
 # locale-resilient float converter
 to_float = lambda s: float(s.replace(",", "."))
 
+# Counters of a /proc/diskstats line used by IO, after the device name
+DISKSTATS_FIELDS = ('rd_ios', 'rd_merges', 'rd_sectors', 'rd_ticks',
+                    'wr_ios', 'wr_merges', 'wr_sectors', 'wr_ticks',
+                    'ios_in_progress', 'io_ticks', 'rq_ticks')
+# Columns of the cpu line of /proc/stat
+PROC_STAT_CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait',
+                        'irq', 'softirq', 'steal', 'guest', 'guest_nice')
+
 
 class IO(Check):
 
@@ -34,6 +43,76 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([\-a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        # Last /proc/diskstats sample: (timestamp, {device: counters})
+        self._last_diskstats = None
+
+    def _read_diskstats(self, proc_location):
+        """
+        Counters of the disks of /proc/diskstats. Like iostat, partitions and
+        devices which never did any IO are left out.
+        """
+        sys_block = '/sys/block'
+        check_disks = os.path.isdir(sys_block)
+        field_count = len(DISKSTATS_FIELDS)
+        diskstats = {}
+        with open('{}/diskstats'.format(proc_location), 'r') as proc_diskstats:
+            for line in proc_diskstats:
+                cols = line.split()
+                # Partitions of old kernels have less counters
+                if len(cols) < 3 + field_count:
+                    continue
+                device = cols[2]
+                if check_disks and not os.path.exists(os.path.join(sys_block, device.replace('/', '!'))):
+                    continue
+                counters = [int(c) for c in cols[3:3 + field_count]]
+                if counters[0] or counters[4]:
+                    diskstats[device] = counters
+        return diskstats
+
+    def _compute_diskstats(self, previous, current, interval):
+        """
+        Compute the `iostat -d -x -k` columns of every device from two samples
+        of /proc/diskstats counters taken `interval` seconds apart.
+        """
+        io = {}
+        for device, counters in current.iteritems():
+            if device not in previous:
+                continue
+            rd_ios, rd_merges, rd_sectors, rd_ticks, wr_ios, wr_merges, wr_sectors, wr_ticks, \
+                _, io_ticks, rq_ticks = [c - p for c, p in zip(counters, previous[device])]
+            ios = rd_ios + wr_ios
+            if min(ios, rd_ios, wr_ios, rd_sectors, wr_sectors, io_ticks, rq_ticks) < 0:
+                # Counters wrapped or were reset, skip this sample
+                continue
+
+            stats = {
+                'rrqm/s': rd_merges / interval,
+                'wrqm/s': wr_merges / interval,
+                'r/s': rd_ios / interval,
+                'w/s': wr_ios / interval,
+                # Sectors are 512 bytes
+                'rkB/s': rd_sectors / 2.0 / interval,
+                'wkB/s': wr_sectors / 2.0 / interval,
+                'avgrq-sz': float(rd_sectors + wr_sectors) / ios if ios else 0.0,
+                'avgqu-sz': rq_ticks / 1000.0 / interval,
+                'await': float(rd_ticks + wr_ticks) / ios if ios else 0.0,
+                'r_await': float(rd_ticks) / rd_ios if rd_ios else 0.0,
+                'w_await': float(wr_ticks) / wr_ios if wr_ios else 0.0,
+                'svctm': float(io_ticks) / ios if ios else 0.0,
+                '%util': min(io_ticks / 10.0 / interval, 100.0),
+            }
+            # Same format as the iostat output
+            io[device] = dict((name, '%.2f' % value) for name, value in stats.iteritems())
+        return io
+
+    def _sample_diskstats(self, proc_location):
+        """ IO stats since the last sample of /proc/diskstats, nothing on the first one """
+        now = time.time()
+        current = self._read_diskstats(proc_location)
+        previous, self._last_diskstats = self._last_diskstats, (now, current)
+        if previous is None or now <= previous[0]:
+            return {}
+        return self._compute_diskstats(previous[1], current, now - previous[0])
 
     def _parse_linux2(self, output):
         recentStats = output.split('Device:')[2].split('\n')
@@ -107,6 +186,17 @@ class IO(Check):
         # translate if possible
         return names.get(metric_name, metric_name)
 
+    def _filter_devices(self, io, agentConfig):
+        device_blacklist_re = agentConfig.get('device_blacklist_re', None)
+        if device_blacklist_re:
+            filtered_io = {}
+            for device, stats in io.iteritems():
+                if not device_blacklist_re.match(device):
+                    filtered_io[device] = stats
+        else:
+            filtered_io = io
+        return filtered_io
+
     def check(self, agentConfig):
         """Capture io stats.
 
@@ -116,6 +206,13 @@ class IO(Check):
         io = {}
         try:
             if Platform.is_linux():
+                proc_location = agentConfig.get('procfs_path', '/proc').rstrip('/')
+                try:
+                    io.update(self._sample_diskstats(proc_location))
+                    return self._filter_devices(io, agentConfig)
+                except IOError:
+                    self.logger.debug("Cannot read %s/diskstats, falling back to iostat", proc_location)
+
                 stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
 
                 #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
@@ -202,16 +299,7 @@ class IO(Check):
             else:
                 return False
 
-            # If we filter devices, do it know.
-            device_blacklist_re = agentConfig.get('device_blacklist_re', None)
-            if device_blacklist_re:
-                filtered_io = {}
-                for device, stats in io.iteritems():
-                    if not device_blacklist_re.match(device):
-                        filtered_io[device] = stats
-            else:
-                filtered_io = io
-            return filtered_io
+            return self._filter_devices(io, agentConfig)
 
         except Exception:
             self.logger.exception("Cannot extract IO statistics")
@@ -576,6 +664,96 @@ class Processes(Check):
 
 class Cpu(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        # Aggregated cpu times of the last /proc/stat sample
+        self._last_cpu_times = None
+
+    def _sample_proc_stat(self, proc_location):
+        """
+        Percentages of cpu time spent in each state since the last sample,
+        named after mpstat columns. None on the first sample.
+        """
+        times = None
+        with open('{}/stat'.format(proc_location), 'r') as proc_stat:
+            for line in proc_stat:
+                if line.startswith('cpu '):
+                    times = [int(t) for t in line.split()[1:len(PROC_STAT_CPU_FIELDS) + 1]]
+                    break
+        if times is None:
+            return None
+        # Older kernels don't report steal, guest and guest_nice
+        times += [0] * (len(PROC_STAT_CPU_FIELDS) - len(times))
+
+        previous, self._last_cpu_times = self._last_cpu_times, times
+        if previous is None:
+            return None
+
+        # idle and iowait may go backwards on tickless kernels
+        user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice = \
+            [max(t - p, 0) for t, p in zip(times, previous)]
+        # guest and guest_nice are already accounted in user and nice
+        total = float(user + nice + system + idle + iowait + irq + softirq + steal)
+        if not total:
+            return None
+
+        def pct(value):
+            return round(100 * value / total, 2)
+
+        return {
+            "%usr": pct(max(user - guest, 0)), "%user": 0.0, "%nice": pct(max(nice - guest_nice, 0)),
+            "%iowait": pct(iowait), "%idle": pct(idle), "%sys": pct(system),
+            "%irq": pct(irq), "%soft": pct(softirq), "%steal": pct(steal),
+            "%guest": pct(guest)
+        }
+
+    def _mpstat_metrics(self, get_value):
+        """ mpstat based `_sample_proc_stat`, when /proc/stat can't be read """
+        output, _, _ = get_subprocess_output(['mpstat', '1', '3'], self.logger)
+        mpstat = output.splitlines()
+        # topdog@ip:~$ mpstat 1 3
+        # Linux 2.6.32-341-ec2 (ip)   01/19/2012  _x86_64_  (2 CPU)
+        #
+        # 04:22:41 PM  CPU    %usr   %nice    %sys %iowait    %irq   %soft  %steal  %guest   %idle
+        # 04:22:42 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
+        # 04:22:43 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
+        # 04:22:44 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
+        # Average:     all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
+        #
+        # OR
+        #
+        # Thanks to Mart Visser to spotting this one.
+        # blah:/etc/dd-agent# mpstat
+        # Linux 2.6.26-2-xen-amd64 (atira)  02/17/2012  _x86_64_
+        #
+        # 05:27:03 PM  CPU    %user   %nice   %sys %iowait    %irq   %soft  %steal  %idle   intr/s
+        # 05:27:03 PM  all    3.59    0.00    0.68    0.69    0.00   0.00    0.01   95.03    43.65
+        #
+        legend = [l for l in mpstat if "%usr" in l or "%user" in l]
+        avg = [l for l in mpstat if "Average" in l]
+        if len(legend) == 1 and len(avg) == 1:
+            headers = [h for h in legend[0].split() if h not in ("AM", "PM")]
+            data = avg[0].split()
+
+            # Userland
+            # Debian lenny says %user so we look for both
+            # One of them will be 0
+            cpu_metrics = {
+                "%usr": None, "%user": None, "%nice": None,
+                "%iowait": None, "%idle": None, "%sys": None,
+                "%irq": None, "%soft": None, "%steal": None,
+                "%guest": None
+            }
+
+            for cpu_m in cpu_metrics:
+                cpu_metrics[cpu_m] = get_value(headers, data, cpu_m, filter_value=110)
+
+            if any([v is None for v in cpu_metrics.values()]):
+                self.logger.warning("Invalid mpstat data: %s" % data)
+
+            return cpu_metrics
+        return None
+
     def check(self, agentConfig):
         """Return an aggregate of CPU stats across all CPUs
         When figures are not available, False is sent back.
@@ -599,64 +777,29 @@ class Cpu(Check):
                 return 0.0
         try:
             if Platform.is_linux():
-                output, _, _ = get_subprocess_output(['mpstat', '1', '3'], self.logger)
-                mpstat = output.splitlines()
-                # topdog@ip:~$ mpstat 1 3
-                # Linux 2.6.32-341-ec2 (ip)   01/19/2012  _x86_64_  (2 CPU)
-                #
-                # 04:22:41 PM  CPU    %usr   %nice    %sys %iowait    %irq   %soft  %steal  %guest   %idle
-                # 04:22:42 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:43 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:44 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # Average:     all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                #
-                # OR
-                #
-                # Thanks to Mart Visser to spotting this one.
-                # blah:/etc/dd-agent# mpstat
-                # Linux 2.6.26-2-xen-amd64 (atira)  02/17/2012  _x86_64_
-                #
-                # 05:27:03 PM  CPU    %user   %nice   %sys %iowait    %irq   %soft  %steal  %idle   intr/s
-                # 05:27:03 PM  all    3.59    0.00    0.68    0.69    0.00   0.00    0.01   95.03    43.65
-                #
-                legend = [l for l in mpstat if "%usr" in l or "%user" in l]
-                avg = [l for l in mpstat if "Average" in l]
-                if len(legend) == 1 and len(avg) == 1:
-                    headers = [h for h in legend[0].split() if h not in ("AM", "PM")]
-                    data = avg[0].split()
-
-                    # Userland
-                    # Debian lenny says %user so we look for both
-                    # One of them will be 0
-                    cpu_metrics = {
-                        "%usr": None, "%user": None, "%nice": None,
-                        "%iowait": None, "%idle": None, "%sys": None,
-                        "%irq": None, "%soft": None, "%steal": None,
-                        "%guest": None
-                    }
-
-                    for cpu_m in cpu_metrics:
-                        cpu_metrics[cpu_m] = get_value(headers, data, cpu_m, filter_value=110)
-
-                    if any([v is None for v in cpu_metrics.values()]):
-                        self.logger.warning("Invalid mpstat data: %s" % data)
-
-                    cpu_user = cpu_metrics["%usr"] + cpu_metrics["%user"] + cpu_metrics["%nice"]
-                    cpu_system = cpu_metrics["%sys"] + cpu_metrics["%irq"] + cpu_metrics["%soft"]
-                    cpu_wait = cpu_metrics["%iowait"]
-                    cpu_idle = cpu_metrics["%idle"]
-                    cpu_stolen = cpu_metrics["%steal"]
-                    cpu_guest = cpu_metrics["%guest"]
-
-                    return format_results(cpu_user,
-                                          cpu_system,
-                                          cpu_wait,
-                                          cpu_idle,
-                                          cpu_stolen,
-                                          cpu_guest)
-                else:
+                proc_location = agentConfig.get('procfs_path', '/proc').rstrip('/')
+                try:
+                    cpu_metrics = self._sample_proc_stat(proc_location)
+                except IOError:
+                    self.logger.debug("Cannot read %s/stat, falling back to mpstat", proc_location)
+                    cpu_metrics = self._mpstat_metrics(get_value)
+                if not cpu_metrics:
                     return False
 
+                cpu_user = cpu_metrics["%usr"] + cpu_metrics["%user"] + cpu_metrics["%nice"]
+                cpu_system = cpu_metrics["%sys"] + cpu_metrics["%irq"] + cpu_metrics["%soft"]
+                cpu_wait = cpu_metrics["%iowait"]
+                cpu_idle = cpu_metrics["%idle"]
+                cpu_stolen = cpu_metrics["%steal"]
+                cpu_guest = cpu_metrics["%guest"]
+
+                return format_results(cpu_user,
+                                      cpu_system,
+                                      cpu_wait,
+                                      cpu_idle,
+                                      cpu_stolen,
+                                      cpu_guest)
+
             elif sys.platform == 'darwin':
                 # generate 3 seconds of data
                 # ['          disk0           disk1       cpu     load average', '    KB/t tps  MB/s     KB/t tps  MB/s  us sy id   1m   5m   15m', '   21.23  13  0.27    17.85   7  0.13  14  7 79  1.04 1.27 1.31', '    4.00   3  0.01     5.00   8  0.04  12 10 78  1.04 1.27 1.31', '']
@@ -1,11 +1,14 @@
 
 # stdlib
 import ConfigParser
+import copy
 from cStringIO import StringIO
 import glob
+import hashlib
 import imp
 import inspect
 import itertools
+import json
 import logging
 import logging.config
 import logging.handlers
@@ -16,8 +19,10 @@ import re
 from socket import gaierror, gethostbyname
 import string
 import sys
+import time
 import traceback
 #from urlparse import urlparse
+import weakref
 
 # project
 from util import check_yaml
@@ -64,6 +69,16 @@ NAGIOS_OLD_CONF_KEYS = [
     'nagios_perf_cfg'
 ]
 
+# Caches of the parsed check configs and of the imported check modules,
+# so that reloading the checks only parses and imports the files that changed:
+# key -> (mtime, size, time of the load, sha1 of the content, parsed config or module)
+_check_configs_cache = {}
+_check_modules_cache = {}
+# Initialized check -> (check class, signature of its config), to keep the
+# checks whose code and config didn't change across reloads
+_check_signatures = weakref.WeakKeyDictionary()
+
+
 class PathNotFound(Exception):
     pass
 
@@ -271,6 +286,34 @@ def get_histogram_aggregates(configstr=None):
     return result
 
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    val = configstr.strip().lower()
+    if val not in ('samples', 'sketch'):
+        log.warning("Ignored histogram backend {0}, must be samples or sketch".format(val))
+        return None
+
+    return val
+
+
+def get_histogram_relative_accuracy(configstr=None):
+    if configstr is None:
+        return None
+
+    try:
+        val = float(configstr)
+        if val <= 0 or val >= 1:
+            raise ValueError
+    except ValueError:
+        log.warning("Bad histogram relative accuracy {0}, must be float in ]0;1[, skipping"
+                    .format(configstr))
+        return None
+
+    return val
+
+
 def get_histogram_percentiles(configstr=None):
     if configstr is None:
         return None
@@ -409,6 +452,19 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'forwarder_timeout'):
             agentConfig['forwarder_timeout'] = int(config.get('Main', 'forwarder_timeout'))
 
+        # Forwarder spill queue, disabled unless a directory is set
+        agentConfig['forwarder_spill_dir'] = None
+        if config.has_option('Main', 'forwarder_spill_dir'):
+            agentConfig['forwarder_spill_dir'] = config.get('Main', 'forwarder_spill_dir') or None
+        agentConfig['forwarder_spill_max_size'] = 1024 * 1024 * 1024
+        if config.has_option('Main', 'forwarder_spill_max_size'):
+            agentConfig['forwarder_spill_max_size'] = int(config.get('Main', 'forwarder_spill_max_size'))
+
+        # Window in seconds over which the forwarder coalesces small payloads
+        agentConfig['forwarder_coalesce_window'] = 0
+        if config.has_option('Main', 'forwarder_coalesce_window'):
+            agentConfig['forwarder_coalesce_window'] = float(config.get('Main', 'forwarder_coalesce_window'))
+
 
         # Extra checks.d path
         # the linux directory is set by default
@@ -456,6 +512,18 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             except Exception:
                 pass
 
+        # Concurrent checks.d checks
+        if config.has_option('Main', 'check_runners'):
+            try:
+                agentConfig['check_runners'] = int(config.get('Main', 'check_runners'))
+            except Exception:
+                pass
+        if config.has_option('Main', 'check_timeout'):
+            try:
+                agentConfig['check_timeout'] = float(config.get('Main', 'check_timeout'))
+            except Exception:
+                pass
+
         # Custom histogram aggregate/percentile metrics
         if config.has_option('Main', 'histogram_aggregates'):
             agentConfig['histogram_aggregates'] = get_histogram_aggregates(config.get('Main', 'histogram_aggregates'))
@@ -463,6 +531,14 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        # Histogram storage: every sample (default) or a bounded-memory sketch
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
+        if config.has_option('Main', 'histogram_relative_accuracy'):
+            agentConfig['histogram_relative_accuracy'] = get_histogram_relative_accuracy(
+                config.get('Main', 'histogram_relative_accuracy'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -474,6 +550,9 @@ def get_config(parse_args=True, cfg_path=None, options=None):
                 int(config.get('Main', 'graphite_listen_port'))
         else:
             agentConfig['graphite_listen_port'] = None
+        agentConfig['graphite_aggregation'] = 'avg'
+        if config.has_option('Main', 'graphite_aggregation'):
+            agentConfig['graphite_aggregation'] = config.get('Main', 'graphite_aggregation').lower()
 
         # Dogstatsd config
         dogstatsd_defaults = {
@@ -496,6 +575,27 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             if config.has_option('Main', 'statsd_forward_port'):
                 agentConfig['statsd_forward_port'] = int(config.get('Main', 'statsd_forward_port'))
 
+        # StsStatsD socket receive buffer and ingestion batch size
+        if config.has_option('Main', 'dogstatsd_so_rcvbuf'):
+            agentConfig['dogstatsd_so_rcvbuf'] = int(config.get('Main', 'dogstatsd_so_rcvbuf'))
+        if config.has_option('Main', 'dogstatsd_recv_batch_size'):
+            agentConfig['dogstatsd_recv_batch_size'] = int(config.get('Main', 'dogstatsd_recv_batch_size'))
+        if config.has_option('Main', 'dogstatsd_workers'):
+            agentConfig['dogstatsd_workers'] = int(config.get('Main', 'dogstatsd_workers'))
+
+        # StsStatsD payload size and concurrent uploads
+        if config.has_option('Main', 'dogstatsd_max_payload_size'):
+            agentConfig['dogstatsd_max_payload_size'] = int(config.get('Main', 'dogstatsd_max_payload_size'))
+        if config.has_option('Main', 'dogstatsd_upload_workers'):
+            agentConfig['dogstatsd_upload_workers'] = int(config.get('Main', 'dogstatsd_upload_workers'))
+
+        # StsStatsD context budgets
+        if config.has_option('Main', 'dogstatsd_context_limit'):
+            agentConfig['dogstatsd_context_limit'] = int(config.get('Main', 'dogstatsd_context_limit'))
+        if config.has_option('Main', 'dogstatsd_context_limit_per_metric'):
+            agentConfig['dogstatsd_context_limit_per_metric'] = int(
+                config.get('Main', 'dogstatsd_context_limit_per_metric'))
+
         # Optional config
         # FIXME not the prettiest code ever...
         if config.has_option('Main', 'use_mount'):
@@ -775,12 +875,43 @@ def get_ssl_certificate(osname, filename):
     return None
 
 
+def _load_cached_file(cache, key, path, load):
+    '''Return `load(path)`, from the cache if the file didn't change since
+    its last load: same mtime and size, or else same content.'''
+    stat = os.stat(path)
+    entry = cache.get(key)
+    # A file modified during the second it was loaded may have changed
+    # without its mtime changing
+    if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size) \
+            and stat.st_mtime < entry[2] - 1:
+        return entry[4]
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    if entry is not None and entry[3] == digest:
+        value = entry[4]
+    else:
+        value = load(path)
+    cache[key] = (stat.st_mtime, stat.st_size, time.time(), digest, value)
+    return value
+
+
+def _config_signature(check_config):
+    '''Return a digest of a check config, None if it can't be computed.'''
+    try:
+        return hashlib.sha1(json.dumps(check_config, sort_keys=True, default=repr)).hexdigest()
+    except (TypeError, ValueError):
+        return None
+
+
 def _get_check_class(check_name, check_path):
     '''Return the corresponding check class for a check name if available.'''
     from checks import AgentCheck
-    check_class = None
     try:
-        check_module = imp.load_source('checksd_%s' % check_name, check_path)
+        check_module = _load_cached_file(
+            _check_modules_cache, (check_name, check_path), check_path,
+            lambda path: _import_check_module(check_name, path)
+        )
     except Exception as e:
         traceback_message = traceback.format_exc()
         # There is a configuration file for that check but the module can't be imported
@@ -802,6 +933,14 @@ def _get_check_class(check_name, check_path):
     return check_class
 
 
+def _import_check_module(check_name, check_path):
+    # Import it in a new module object, so that the classes loaded from the
+    # previous version of the file keep their own globals
+    module_name = 'checksd_%s' % check_name
+    sys.modules.pop(module_name, None)
+    return imp.load_source(module_name, check_path)
+
+
 def _deprecated_configs(agentConfig):
     """ Warn about deprecated configs
     """
@@ -893,7 +1032,10 @@ def _load_file_config(config_path, check_name, agentConfig):
         return True, check_config, {}
 
     try:
-        check_config = check_yaml(config_path)
+        # The parsed configs are cached, copy them so that the checks can't modify them
+        check_config = copy.deepcopy(
+            _load_cached_file(_check_configs_cache, config_path, config_path, check_yaml)
+        )
     except Exception as e:
         log.exception("Unable to parse yaml config in %s" % config_path)
         traceback_message = traceback.format_exc()
@@ -944,10 +1086,12 @@ def _update_python_path(check_config):
         sys.path.extend(pythonpath)
 
 
-def load_check_from_places(check_config, check_name, checks_places, agentConfig):
+def load_check_from_places(check_config, check_name, checks_places, agentConfig, previous_check=None):
     '''Find a check named check_name in the given checks_places and try to initialize it with the given check_config.
-    A failure (`load_failure`) can happen when the check class can't be validated or when the check can't be initialized. '''
+    A failure (`load_failure`) can happen when the check class can't be validated or when the check can't be initialized.
+    `previous_check` is returned as is, with its state, if neither its code nor its config changed. '''
     load_success, load_failure = {}, {}
+    signature = _config_signature(check_config)
     for check_path_builder in checks_places:
         check_path = check_path_builder(check_name)
         if not os.path.exists(check_path):
@@ -957,9 +1101,16 @@ def load_check_from_places(check_config, check_name, checks_places, agentConfig)
         if not check_is_valid:
             continue
 
+        if previous_check is not None and signature is not None \
+                and _check_signatures.get(previous_check) == (check_class, signature):
+            log.debug('%s is unchanged, keeping it' % check_path)
+            return {check_name: previous_check}, {}
+
         load_success, load_failure = _initialize_check(
             check_config, check_name, check_class, agentConfig
         )
+        if check_name in load_success:
+            _check_signatures[load_success[check_name]] = (check_class, signature)
 
         _update_python_path(check_config)
 
@@ -969,12 +1120,16 @@ def load_check_from_places(check_config, check_name, checks_places, agentConfig)
     return load_success, load_failure
 
 
-def load_check_directory(agentConfig, hostname):
+def load_check_directory(agentConfig, hostname, previous_checks=None):
     ''' Return the initialized checks from checks.d, and a mapping of checks that failed to
     initialize. Only checks that have a configuration
-    file in conf.d will be returned. '''
+    file in conf.d will be returned.
+    The checks of `previous_checks` whose code and config didn't change are
+    returned instead of new instances, the caller stops the other ones. '''
     from checks import AGENT_METRICS_CHECK_NAME
 
+    previous_checks = dict((check.name, check) for check in previous_checks or [])
+
     initialized_checks = {}
     init_failed_checks = {}
     deprecated_checks = {}
@@ -1005,7 +1160,8 @@ def load_check_directory(agentConfig, hostname):
             configs_and_sources[check_name] = (CONFIG_FROM_FILE, check_config)
 
         # load the check
-        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+        load_success, load_failure = load_check_from_places(
+            check_config, check_name, checks_places, agentConfig, previous_checks.get(check_name))
 
         initialized_checks.update(load_success)
         init_failed_checks.update(load_failure)
@@ -1029,7 +1185,8 @@ def load_check_directory(agentConfig, hostname):
         check_config = {'init_config': sd_init_config, 'instances': sd_instances}
 
         # load the check
-        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+        load_success, load_failure = load_check_from_places(
+            check_config, check_name, checks_places, agentConfig, previous_checks.get(check_name))
 
         initialized_checks.update(load_success)
         init_failed_checks.update(load_failure)
@@ -1046,7 +1203,7 @@ def load_check_directory(agentConfig, hostname):
             }
 
 
-def load_check(agentConfig, hostname, checkname):
+def load_check(agentConfig, hostname, checkname, previous_check=None):
     """Same logic as load_check_directory except it loads one specific check"""
     agentConfig['checksd_hostname'] = hostname
     osname = get_os()
@@ -1060,7 +1217,7 @@ def load_check(agentConfig, hostname, checkname):
                 return invalid_check
 
             # try to load the check and return the result
-            load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+            load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig, previous_check)
             return load_success.values()[0] or load_failure
 
     # the check was not found, try with service discovery
@@ -1070,7 +1227,7 @@ def load_check(agentConfig, hostname, checkname):
             check_config = {'init_config': sd_init_config, 'instances': sd_instances}
 
             # try to load the check and return the result
-            load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+            load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig, previous_check)
             return load_success.values()[0] or load_failure
 
     return None
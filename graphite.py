@@ -1,8 +1,8 @@
-
 # stdlib
 import cPickle as pickle
 import logging
 import struct
+import time
 
 # 3p
 from tornado.ioloop import IOLoop
@@ -13,31 +13,159 @@ from utils.hostname import get_hostname
 
 log = logging.getLogger(__name__)
 
+# How the points received for a metric between two flushes are combined
+AGGREGATION_METHODS = ('avg', 'sum', 'min', 'max', 'last')
+DEFAULT_AGGREGATION = 'avg'
+# Plaintext lines longer than that are dropped
+MAX_LINE_LENGTH = 64 * 1024
+# Prefix of the metrics reporting the activity of the listener
+STATS_PREFIX = 'stackstate.agent.graphite.'
+
+
+def parse_plaintext(data):
+    """
+    Parse a batch of plaintext protocol lines: `<metric path> <value> <timestamp>`.
+    Returns the list of (metric, (timestamp, value)) points, and the number
+    of lines that couldn't be parsed.
+    """
+    points = []
+    errors = 0
+    for line in data.splitlines():
+        if not line:
+            continue
+        try:
+            metric, value, ts = line.split()
+            points.append((metric, (float(ts), float(value))))
+        except ValueError:
+            errors += 1
+    return points, errors
+
+
+class GraphiteAggregator(object):
+    """
+    Aggregate the graphite points received per (metric, host, device) until
+    they are flushed, so that only one point per metric and flush interval
+    is forwarded. Also counts the points received and the parse errors.
+    """
+
+    def __init__(self, method=DEFAULT_AGGREGATION):
+        if method not in AGGREGATION_METHODS:
+            log.warning("Unknown graphite aggregation %s, using %s", method, DEFAULT_AGGREGATION)
+            method = DEFAULT_AGGREGATION
+        self.method = method
+        # (metric, host, device) -> [last ts, last value, count, sum, min, max]
+        self.points = {}
+        self.points_received = 0
+        self.parse_errors = 0
+
+    def add(self, metric, host, device, ts, value):
+        self.points_received += 1
+        key = (metric, host, device)
+        point = self.points.get(key)
+        if point is None:
+            self.points[key] = [ts, value, 1, value, value, value]
+            return
+
+        if ts >= point[0]:
+            point[0] = ts
+            point[1] = value
+        point[2] += 1
+        point[3] += value
+        if value < point[4]:
+            point[4] = value
+        if value > point[5]:
+            point[5] = value
+
+    def _value(self, point):
+        last_ts, last, count, total, minimum, maximum = point
+        if self.method == 'avg':
+            return float(total) / count
+        elif self.method == 'sum':
+            return total
+        elif self.method == 'min':
+            return minimum
+        elif self.method == 'max':
+            return maximum
+        return last
+
+    def flush(self):
+        """
+        Return the aggregated (metric, host, device, ts, value) points and
+        the (points received, parse errors) counters, and reset them all.
+        """
+        points = [(metric, host, device, point[0], self._value(point))
+                  for (metric, host, device), point in self.points.iteritems()]
+        counters = (self.points_received, self.parse_errors)
+        self.points = {}
+        self.points_received = 0
+        self.parse_errors = 0
+        return points, counters
+
 
 class GraphiteServer(TCPServer):
 
-    def __init__(self, app, hostname, io_loop=None, ssl_options=None, **kwargs):
+    def __init__(self, app, hostname, io_loop=None, ssl_options=None, aggregation=DEFAULT_AGGREGATION, **kwargs):
         log.warn('Graphite listener is started -- if you do not need graphite, turn it off in stackstate.conf.')
         log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
         log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
         self.app = app
         self.hostname = hostname
+        self.aggregator = GraphiteAggregator(aggregation)
+        self._last_flush = time.time()
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address):
-        GraphiteConnection(stream, address, self.app, self.hostname)
+        GraphiteConnection(stream, address, self.aggregator, self.hostname)
+
+    def flush(self):
+        """
+        Post the points aggregated since the last flush to the application,
+        with the throughput and the parse errors of the listener.
+        """
+        points, (received, errors) = self.aggregator.flush()
+        now = time.time()
+        interval = max(now - self._last_flush, 1e-3)
+        self._last_flush = now
+        if received or errors:
+            log.debug("Graphite listener received %s points (%.2f/s) with %s parse errors, posting %s points",
+                      received, received / interval, errors, len(points))
+
+        if self.app is None or not (points or errors):
+            return
+        for metric, host, device, ts, value in points:
+            self.app.appendMetric("graphite", metric, host, device, ts, value)
+        for name, value in (('points_received', received), ('points_per_second', received / interval),
+                            ('points_posted', len(points)), ('parse_errors', errors)):
+            self.app.appendMetric("graphite", STATS_PREFIX + name, self.hostname, "N/A", now, value)
 
 
 class GraphiteConnection(object):
+    """
+    Read the points sent on a connection, either with the pickle protocol,
+    as batches of pickled points each preceded by its 4 bytes size, or with
+    the plaintext protocol, one point per line.
+    """
 
-    def __init__(self, stream, address, app, hostname):
+    def __init__(self, stream, address, aggregator, hostname):
         log.debug('received a new connection from %s', address)
-        self.app = app
+        self.aggregator = aggregator
         self.stream = stream
         self.address = address
         self.hostname = hostname
+        self._buffer = ''
         self.stream.set_close_callback(self._on_close)
-        self.stream.read_bytes(4, self._on_read_header)
+        self.stream.read_bytes(4, self._on_read_first_bytes)
+
+    def _on_read_first_bytes(self, data):
+        # Pickled batches are less than 16MB, so their size starts with a null byte,
+        # unlike a metric path
+        if data.startswith('\x00'):
+            log.debug('receiving pickled points from %s', self.address)
+            self._on_read_header(data)
+        else:
+            log.debug('receiving plaintext points from %s', self.address)
+            self._buffer = data
+            self.stream.read_until_close(self._on_read_last_chunk, streaming_callback=self._on_read_chunk)
 
     def _on_read_header(self, data):
         try:
@@ -51,6 +179,21 @@ class GraphiteConnection(object):
         log.debug('read a new line from %s', self.address)
         self._decode(data)
 
+    def _on_read_chunk(self, data):
+        data = self._buffer + data
+        end = data.rfind('\n') + 1
+        self._buffer = data[end:]
+        if len(self._buffer) > MAX_LINE_LENGTH:
+            self.aggregator.parse_errors += 1
+            self._buffer = ''
+        if end:
+            self._decode_plaintext(data[:end])
+
+    def _on_read_last_chunk(self, data):
+        self._on_read_chunk(data)
+        self._decode_plaintext(self._buffer)
+        self._buffer = ''
+
     def _on_close(self):
         log.debug('client quit %s', self.address)
 
@@ -79,18 +222,21 @@ class GraphiteConnection(object):
 
         ts = datapoint[0]
         value = datapoint[1]
-        if self.app is not None:
-            self.app.appendMetric("graphite", name, host, device, ts, value)
+        self.aggregator.add(name, host, device, ts, value)
 
     def _processMetric(self, metric, datapoint):
         """Parse the metric name to fetch (host, metric, device) and
-            send the datapoint to stackstate"""
+            aggregate the datapoint until the next flush"""
 
-        log.debug("New metric: %s, values: %s" % (metric, datapoint))
         (metric, host, device) = self._parseMetric(metric)
         if metric is not None:
             self._postMetric(metric, host, device, datapoint)
-            log.info("Posted metric: %s, host: %s, device: %s" % (metric, host, device))
+
+    def _decode_plaintext(self, data):
+        datapoints, errors = parse_plaintext(data)
+        self.aggregator.parse_errors += errors
+        for metric, datapoint in datapoints:
+            self._processMetric(metric, datapoint)
 
     def _decode(self, data):
 
@@ -98,13 +244,14 @@ class GraphiteConnection(object):
             datapoints = pickle.loads(data)
         except Exception:
             log.exception("Cannot decode grapite points")
+            self.aggregator.parse_errors += 1
             return
 
         for (metric, datapoint) in datapoints:
             try:
                 datapoint = (float(datapoint[0]), float(datapoint[1]))
-            except Exception as e:
-                log.error(e)
+            except Exception:
+                self.aggregator.parse_errors += 1
                 continue
 
             self._processMetric(metric, datapoint)
@@ -13,6 +13,7 @@ from Queue import Full, Queue
 from socket import error as socket_error, gaierror
 import sys
 import threading
+import time
 import zlib
 
 # For pickle & PID files, see issue 293
@@ -49,6 +50,7 @@ from util import (
 
 from utils.hostname import get_hostname
 from utils.logger import RedactedLogRecord
+from utils.spill_queue import DEFAULT_MAX_SIZE as DEFAULT_SPILL_MAX_SIZE, SpillQueue
 
 
 logging.LogRecord = RedactedLogRecord
@@ -82,6 +84,12 @@ RESPONSES_TO_REJECT = [413, 400]
 
 THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)  # 2 msg/second
 
+# Payloads received during this many seconds are coalesced in one transaction,
+# disabled by default
+DEFAULT_COALESCE_WINDOW = 0
+# Maximum uncompressed size of a coalesced payload
+MAX_COALESCED_SIZE = 2 * 1024 * 1024
+
 
 class EmitterThread(threading.Thread):
 
@@ -134,12 +142,15 @@ class EmitterManager(object):
                 logging.error('Unable to start thread for emitter: %r', emitter_spec, exc_info=True)
         logging.info('Done with custom emitters')
 
-    def send(self, data, headers=None):
+    def send(self, data, headers=None, decoded_data=None):
         if not self.emitterThreads:
             return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
+        if decoded_data is not None:
+            data = decoded_data
+        else:
+            if headers and headers.get('Content-Encoding') == 'deflate':
+                data = zlib.decompress(data)
+            data = json_decode(data)
         for emitterThread in self.emitterThreads:
             logging.info('Queueing for emitter %r', emitterThread.name)
             emitterThread.enqueue(data, headers)
@@ -174,7 +185,7 @@ class AgentTransaction(Transaction):
     def get_tr_manager(cls):
         return cls._trManager
 
-    def __init__(self, data, headers, msg_type=""):
+    def __init__(self, data, headers, msg_type="", decoded_data=None):
         self._data = data
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
@@ -185,7 +196,7 @@ class AgentTransaction(Transaction):
 
         # Emitters operate outside the regular transaction framework
         if self._emitter_manager is not None:
-            self._emitter_manager.send(data, headers)
+            self._emitter_manager.send(data, headers, decoded_data)
 
         # Insert the transaction(s) in the Manager
         for endpoint in self._endpoints:
@@ -200,6 +211,40 @@ class AgentTransaction(Transaction):
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def get_spill_record(self):
+        return {
+            'type': self.__class__.__name__,
+            'data': self._data,
+            'headers': dict(self._headers),
+            'msg_type': self._msg_type,
+            'endpoint': self._endpoint,
+            'api_key': self._api_key,
+            'error_count': self._error_count,
+        }
+
+    @classmethod
+    def from_spill_record(cls, record):
+        """ Rebuild a transaction from `get_spill_record`, without queueing it again """
+        tr = cls.__new__(cls)
+        tr._data = record['data']
+        tr._headers = record['headers']
+        tr._msg_type = record['msg_type']
+        Transaction.__init__(tr)
+        tr._endpoint = record['endpoint']
+        tr._api_key = record['api_key']
+        tr._error_count = record['error_count']
+        return tr
+
+    @classmethod
+    def split_payload(cls, payload):
+        """ Items of a decoded payload to coalesce, None if it can't be coalesced """
+        return None
+
+    @classmethod
+    def join_payload(cls, items):
+        """ Build a payload from the items of coalesced payloads """
+        raise NotImplementedError("To be implemented in a subclass")
+
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
         return "{0}/intake/{1}?api_key={2}".format(endpoint_base_url, self._msg_type, api_key)
@@ -290,6 +335,16 @@ class APIMetricTransaction(MetricTransaction):
     def get_data(self):
         return self._data
 
+    @classmethod
+    def split_payload(cls, payload):
+        if isinstance(payload, dict) and payload.keys() == ['series'] and isinstance(payload['series'], list):
+            return payload['series']
+        return None
+
+    @classmethod
+    def join_payload(cls, items):
+        return {'series': items}
+
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
@@ -298,6 +353,95 @@ class APIServiceCheckTransaction(AgentTransaction):
         endpoint_base_url = get_url_endpoint(endpoint)
         return "{0}/api/v1/check_run/?api_key={1}".format(endpoint_base_url, api_key)
 
+    @classmethod
+    def split_payload(cls, payload):
+        return payload if isinstance(payload, list) else None
+
+    @classmethod
+    def join_payload(cls, items):
+        return items
+
+
+TRANSACTION_TYPES = dict(
+    (cls.__name__, cls) for cls in [MetricTransaction, APIMetricTransaction, APIServiceCheckTransaction]
+)
+
+
+def restore_transaction(record):
+    """ Rebuild a spilled transaction, unless its endpoint isn't configured anymore """
+    if record['api_key'] not in AgentTransaction._endpoints.get(record['endpoint'], []):
+        log.info("Dropping a spilled transaction for %s, which is no longer configured", record['endpoint'])
+        return None
+    return TRANSACTION_TYPES[record['type']].from_spill_record(record)
+
+
+class PayloadCoalescer(object):
+    """
+    Merge the small payloads of a transaction type received during `window`
+    seconds, and compress them once into a single transaction: bursts of
+    payloads (e.g. dogstatsd flushes) then make one request per endpoint
+    instead of one each.
+    """
+
+    def __init__(self, window, max_size=MAX_COALESCED_SIZE):
+        self._window = window
+        self._max_size = max_size
+        # Transaction class -> (items, uncompressed size, headers)
+        self._batches = {}
+        self._timeout = None
+
+    def add(self, tr_class, data, headers):
+        """ Queue a payload, return False if it can't be coalesced and must be sent as is """
+        if not self._window or len(data) >= self._max_size:
+            return False
+        encoding = headers.get('Content-Encoding')
+        try:
+            if encoding == 'deflate':
+                # Stop decompressing as soon as the payload is too big to be coalesced
+                decompressor = zlib.decompressobj()
+                data = decompressor.decompress(data, self._max_size)
+                if decompressor.unconsumed_tail:
+                    return False
+            elif encoding:
+                return False
+            items = tr_class.split_payload(json.loads(data))
+        except (zlib.error, ValueError):
+            return False
+        if items is None or len(data) >= self._max_size:
+            return False
+
+        if tr_class in self._batches and self._batches[tr_class][1] + len(data) > self._max_size:
+            self.flush_batch(tr_class)
+        if tr_class not in self._batches:
+            batch_headers = dict(headers)
+            batch_headers.pop('Content-Length', None)
+            batch_headers['Content-Type'] = 'application/json'
+            batch_headers['Content-Encoding'] = 'deflate'
+            self._batches[tr_class] = ([], 0, batch_headers)
+        batch_items, size, batch_headers = self._batches[tr_class]
+        batch_items.extend(items)
+        self._batches[tr_class] = (batch_items, size + len(data), batch_headers)
+
+        if self._timeout is None:
+            tornado_ioloop = tornado.ioloop.IOLoop.current()
+            self._timeout = tornado_ioloop.add_timeout(time.time() + self._window, self.flush)
+        return True
+
+    def flush_batch(self, tr_class):
+        items, size, headers = self._batches.pop(tr_class)
+        payload = tr_class.join_payload(items)
+        data = zlib.compress(json.dumps(payload))
+        log.debug("Coalesced %s items (%s bytes, %s compressed) in a %s",
+                  len(items), size, len(data), tr_class.__name__)
+        tr_class(data, headers, decoded_data=payload)
+
+    def flush(self):
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        for tr_class in self._batches.keys():
+            self.flush_batch(tr_class)
+
 
 class StatusHandler(tornado.web.RequestHandler):
 
@@ -356,8 +500,9 @@ class ApiInputHandler(tornado.web.RequestHandler):
         headers = self.request.headers
 
         if msg is not None:
-            # Setup a transaction for this message
-            APIMetricTransaction(msg, headers)
+            # Setup a transaction for this message, unless it's coalesced with others
+            if not self.application.coalescer.add(APIMetricTransaction, msg, headers):
+                APIMetricTransaction(msg, headers)
         else:
             raise tornado.web.HTTPError(500)
 
@@ -372,7 +517,9 @@ class ApiCheckRunHandler(tornado.web.RequestHandler):
         headers = self.request.headers
 
         if msg is not None:
-            # Setup a transaction for this message
+            # Setup a transaction for this message, unless it's coalesced with others
+            if self.application.coalescer.add(APIServiceCheckTransaction, msg, headers):
+                return
             tr = APIServiceCheckTransaction(msg, headers)
         else:
             raise tornado.web.HTTPError(500)
@@ -390,6 +537,8 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        # Optional Graphite listener, started with the application
+        self._graphite = None
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints(agentConfig['endpoints'])
         if agentConfig['endpoints'] == {}:
@@ -401,10 +550,19 @@ class Application(tornado.web.Application):
         if len(agentConfig['endpoints']) > 1:
             max_parallelism = self.DEFAULT_PARALLELISM
 
+        # Transactions that don't fit in MAX_QUEUE_SIZE are spilled to disk
+        spill_queue = None
+        if agentConfig.get('forwarder_spill_dir'):
+            spill_queue = SpillQueue(agentConfig['forwarder_spill_dir'],
+                                     max_size=agentConfig.get('forwarder_spill_max_size', DEFAULT_SPILL_MAX_SIZE))
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
                                               MAX_QUEUE_SIZE, THROTTLING_DELAY,
-                                              max_parallelism=max_parallelism)
+                                              max_parallelism=max_parallelism,
+                                              spill_queue=spill_queue,
+                                              restore_transaction=restore_transaction)
         AgentTransaction.set_tr_manager(self._tr_manager)
+        self.coalescer = PayloadCoalescer(agentConfig.get('forwarder_coalesce_window', DEFAULT_COALESCE_WINDOW))
 
         self._watchdog = None
         self.skip_ssl_validation = skip_ssl_validation or agentConfig.get('skip_ssl_validation', False)
@@ -454,6 +612,9 @@ class Application(tornado.web.Application):
 
     def _postMetrics(self):
 
+        if self._graphite is not None:
+            self._graphite.flush()
+
         if len(self._metrics) > 0:
             self._metrics['uuid'] = get_uuid()
             self._metrics['internalHostname'] = get_hostname(self._agentConfig)
@@ -510,6 +671,9 @@ class Application(tornado.web.Application):
 
         log.info("Listening on port %d" % self._port)
 
+        # Serve the forwarder status from memory
+        ForwarderStatus.serve_status()
+
         # Register callbacks
         self.mloop = tornado.ioloop.IOLoop.current()
 
@@ -529,11 +693,12 @@ class Application(tornado.web.Application):
         if gport is not None:
             log.info("Starting graphite listener on port %s" % gport)
             from graphite import GraphiteServer
-            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
+            self._graphite = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop,
+                                            aggregation=self._agentConfig.get('graphite_aggregation', 'avg'))
             if non_local_traffic is True:
-                gs.listen(gport)
+                self._graphite.listen(gport)
             else:
-                gs.listen(gport, address="localhost")
+                self._graphite.listen(gport, address="localhost")
 
         # Start everything
         if self._watchdog:
@@ -541,6 +706,8 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        self.coalescer.flush()
+        self._tr_manager.close()
         log.info("Stopped")
 
     def stop(self):
@@ -13,9 +13,13 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+import errno
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import optparse
 import os
+import Queue
 import select
 import signal
 import socket
@@ -30,6 +34,7 @@ os.umask(022)
 
 # 3rd party
 import requests
+from requests.adapters import HTTPAdapter
 import simplejson as json
 
 # project
@@ -41,8 +46,9 @@ from daemon import AgentSupervisor, Daemon
 from util import chunks, get_uuid, plural
 from utils.hostname import get_hostname
 from utils.pidfile import PidFile
-from utils.net import inet_pton
-from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils.net import get_udp_socket_stats, inet_pton
+from utils.net import IPV6_V6ONLY, IPPROTO_IPV6, SO_REUSEPORT
+from utils.platform import Platform
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -61,6 +67,11 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Errors raised by a non-blocking recv once the socket has been drained
+UDP_RECV_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# How often sharded workers ship their partial aggregates to the parent
+WORKER_EXPORT_INTERVAL = 1
+WORKER_STOP_TIMEOUT = 5
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -68,6 +79,14 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Series are posted in payloads of at most this many bytes, several at once,
+# and each payload is retried a few times (with a linear backoff in seconds)
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+UPLOAD_WORKERS = 4
+PAYLOAD_RETRIES = 2
+PAYLOAD_RETRY_DELAY = 1
+# Metrics serialized in one go, the granularity of the payload size limit
+SERIALIZATION_BATCH_SIZE = 100
 
 
 def add_serialization_status_metric(status, hostname):
@@ -103,27 +122,129 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
-    try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
-    except UnicodeDecodeError as e:
-        log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
-        try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
-        except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
-
-    if len(serialized) > COMPRESS_THRESHOLD:
+class SeriesPayloadWriter(object):
+    """
+    Builds one `{"series": [...]}` payload out of already serialized series,
+    compressing it on the fly with a zlib.compressobj once it gets past
+    COMPRESS_THRESHOLD bytes. `add` refuses a series that would take the
+    payload past `max_size` bytes, unless the payload is still empty.
+    """
+    PREFIX = '{"series": ['
+    SEPARATOR = ', '
+    SUFFIX = ']}'
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.series_count = 0
+        # Uncompressed payload, until it gets past COMPRESS_THRESHOLD
+        self.parts = [self.PREFIX]
+        self.size = len(self.PREFIX)
+        self.compressor = None
+        # Compressed output, and uncompressed bytes not flushed into it yet
+        self.compressed_parts = []
+        self.compressed_size = 0
+        self.pending_size = 0
+
+    def add(self, serialized):
+        if self.series_count:
+            serialized = self.SEPARATOR + serialized
+
+        if self.compressor is None:
+            if self.size + len(serialized) + len(self.SUFFIX) <= COMPRESS_THRESHOLD:
+                self.parts.append(serialized)
+                self.size += len(serialized)
+                self.series_count += 1
+                return True
+            if self.max_size and self.series_count and self.size + len(serialized) > self.max_size:
+                return False
+            self.compressor = zlib.compressobj()
+            self._write(''.join(self.parts))
+            self.parts = None
+        elif self.max_size and self.series_count and \
+                self.compressed_size + self.pending_size + len(serialized) > self.max_size:
+            # Pending bytes are an upper bound of their compressed size, get the actual one
+            self._flush(zlib.Z_SYNC_FLUSH)
+            if self.compressed_size + len(serialized) > self.max_size:
+                return False
+
+        self._write(serialized)
+        self.series_count += 1
+        return True
+
+    def _write(self, data):
+        self.pending_size += len(data)
+        output = self.compressor.compress(data)
+        if output:
+            self.compressed_parts.append(output)
+            self.compressed_size += len(output)
+
+    def _flush(self, mode):
+        output = self.compressor.flush(mode)
+        self.compressed_parts.append(output)
+        self.compressed_size += len(output)
+        self.pending_size = 0
+
+    def close(self):
+        """ Return the payload and its headers. """
+        if self.compressor is None:
+            self.parts.append(self.SUFFIX)
+            return ''.join(self.parts), {'Content-Type': 'application/json'}
+
+        self._write(self.SUFFIX)
+        self._flush(zlib.Z_FINISH)
         headers = {'Content-Type': 'application/json',
                    'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+        return ''.join(self.compressed_parts), headers
+
+
+def serialize_series(metrics, hostname):
+    """
+    Serialize metrics SERIALIZATION_BATCH_SIZE at a time into comma-separated
+    JSON series, followed by a serialization status metric.
+    Metrics that can't be serialized, even after replacing their bad
+    characters, are dropped.
+    """
+    status = "success"
+    for batch in chunks(metrics, SERIALIZATION_BATCH_SIZE):
+        try:
+            yield json.dumps(batch)[1:-1]
+            continue
+        except UnicodeDecodeError as e:
+            log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
+
+        for metric in batch:
+            try:
+                yield json.dumps(metric)
+            except UnicodeDecodeError:
+                log.error(metric)
+                try:
+                    yield json.dumps(unicode_metrics([metric])[0])
+                    if status == "success":
+                        status = "failure"
+                except Exception as e:
+                    log.exception("Unable to serialize metric. Giving up. %s", e)
+                    status = "permanent_failure"
+
+    yield json.dumps(add_serialization_status_metric(status, hostname))
+
+
+def serialize_metrics_chunks(metrics, hostname, max_size=None):
+    """
+    Serialize metrics into payloads of at most `max_size` bytes each, built
+    as they are sent so only one payload is held in memory at a time.
+    Yield (payload, headers) tuples.
+    """
+    writer = SeriesPayloadWriter(max_size)
+    for serialized in serialize_series(metrics, hostname):
+        if not writer.add(serialized):
+            yield writer.close()
+            writer = SeriesPayloadWriter(max_size)
+            writer.add(serialized)
+    yield writer.close()
+
+
+def serialize_metrics(metrics, hostname):
+    return next(serialize_metrics_chunks(metrics, hostname))
 
 
 def serialize_event(event):
@@ -186,7 +307,8 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, udp_port=None,
+                 max_payload_size=None, upload_workers=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
@@ -203,23 +325,37 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        # Port of the server socket, used to report kernel-side backlog and drops
+        self.udp_port = udp_port
+        self.max_payload_size = max_payload_size or MAX_PAYLOAD_SIZE
+        self.upload_workers = upload_workers or UPLOAD_WORKERS
+
+        # Keep-alive connections, enough for all the upload workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.upload_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Started on the first flush needing more than one payload
+        self.upload_pool = None
 
     def stop(self):
         log.info("Stopping reporter")
         self.finished.set()
+        if self.upload_pool is not None:
+            self.upload_pool.terminate()
 
     def run(self):
 
         log.info("Reporting to %s every %ss" % (self.api_host, self.interval))
         log.debug("Watchdog enabled: %s" % bool(self.watchdog))
 
-        # Persist a start-up message.
+        # Serve the status from memory, and persist a start-up message.
+        DogstatsdStatus.serve_status()
         DogstatsdStatus().persist()
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
-            self.metrics_aggregator.send_packet_count('stackstate.stsstatsd.packet.count')
-            self.flush()
+            self.report()
             if self.watchdog:
                 self.watchdog.reset()
 
@@ -227,12 +363,24 @@ class Reporter(threading.Thread):
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
-    def flush(self):
+    def report(self):
+        """ Submit the stats of stsstatsd itself, then flush everything. """
+        self.metrics_aggregator.send_packet_count('stackstate.stsstatsd.packet.count')
+        top_contexts = self.metrics_aggregator.send_context_stats('stackstate.stsstatsd')
+        self.flush(top_contexts)
+
+    def flush(self, top_contexts=None):
+        """
+        Submit the aggregated data and persist a status, reporting the
+        `top_contexts` returned by `send_context_stats`, if any.
+        """
+        top_metric_contexts, top_tag_key_contexts = top_contexts or ([], [])
         try:
             self.flush_count += 1
             self.log_count += 1
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
+            context_count, context_memory = self.metrics_aggregator.context_stats()
 
             metrics = self.metrics_aggregator.flush()
             count = len(metrics)
@@ -259,6 +407,10 @@ class Reporter(threading.Thread):
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
+            udp_stats = None
+            if self.udp_port:
+                udp_stats = get_udp_socket_stats(self.udp_port)
+
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
             DogstatsdStatus(
@@ -268,6 +420,13 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                udp_rx_queue=udp_stats['rx_queue'] if udp_stats else None,
+                udp_drops=udp_stats['drops'] if udp_stats else None,
+                context_count=context_count,
+                context_memory=context_memory,
+                context_overflow_count=self.metrics_aggregator.contexts.overflow_count,
+                top_metric_contexts=top_metric_contexts,
+                top_tag_key_contexts=top_tag_key_contexts,
             ).persist()
 
         except Exception:
@@ -277,12 +436,41 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+
+        # Payloads are serialized while the previous ones get posted, with at
+        # most `upload_workers` of them in memory
+        payloads = serialize_metrics_chunks(metrics, self.hostname, self.max_payload_size)
+        body, headers = next(payloads)
+        next_payload = next(payloads, None)
+        if next_payload is None:
+            self.submit_payload(url, body, headers)
+            return
+
+        if self.upload_pool is None:
+            self.upload_pool = ThreadPool(self.upload_workers)
+        uploads = [self.upload_pool.apply_async(self.submit_payload, (url, body, headers))]
+        while next_payload is not None:
+            if len(uploads) >= self.upload_workers:
+                uploads.pop(0).wait()
+            body, headers = next_payload
+            uploads.append(self.upload_pool.apply_async(self.submit_payload, (url, body, headers)))
+            next_payload = next(payloads, None)
+        for upload in uploads:
+            upload.wait()
+
+    def submit_payload(self, url, body, headers):
+        """ Post a series payload, retrying on connection and server errors. """
+        for attempt in xrange(PAYLOAD_RETRIES + 1):
+            if attempt:
+                sleep(PAYLOAD_RETRY_DELAY * attempt)
+            status = self.submit_http(url, body, dict(headers))
+            if status is not None and status < 500:
+                return
+        log.error("Dropping a %s bytes payload after %s attempts", len(body), PAYLOAD_RETRIES + 1)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -305,11 +493,13 @@ class Reporter(threading.Thread):
             self.submit_http(url, json.dumps(payload), headers)
 
     def submit_http(self, url, data, headers):
+        """ Post the data, return the response status code or None if there is none """
         headers["DD-Dogstatsd-Version"] = get_version()
         log.debug("Posting payload to %s" % url)
+        r = None
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
+            r = self.session.post(url, data=data, timeout=5, headers=headers)
             r.raise_for_status()
 
             if r.status_code >= 200 and r.status_code < 205:
@@ -325,6 +515,10 @@ class Reporter(threading.Thread):
             except Exception:
                 pass
 
+        if r is not None:
+            return r.status_code
+        return None
+
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
 
@@ -339,14 +533,24 @@ class Reporter(threading.Thread):
 class Server(object):
     """
     A statsd udp server.
+
+    With `recv_batch_size` > 1, every wake-up of the select loop drains the
+    socket with non-blocking reads (up to `recv_batch_size` datagrams) and
+    hands the whole burst to the aggregator in one call.
     """
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 so_rcvbuf=None, recv_batch_size=None, reuse_port=False):
         self.sockaddr = None
         self.socket = None
         self.metrics_aggregator = metrics_aggregator
         self.host = host
         self.port = port
         self.buffer_size = 1024 * 8
+        self.so_rcvbuf = so_rcvbuf
+        self.recv_batch_size = max(int(recv_batch_size or 1), 1)
+        self.reuse_port = reuse_port
+        # Optional (interval, callback) run from the receive loop thread, see ShardWorker
+        self.periodic_task = None
 
         self.running = False
 
@@ -383,6 +587,17 @@ class Server(object):
 
         self.socket.setblocking(0)
 
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        if self.so_rcvbuf:
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+                log.info('Socket receive buffer set to %s bytes (requested %s)',
+                         self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), self.so_rcvbuf)
+            except socket.error:
+                log.exception('Unable to set the socket receive buffer to %s bytes', self.so_rcvbuf)
+
         #let's get the sockaddr
         self.sockaddr = get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only)
 
@@ -394,6 +609,13 @@ class Server(object):
 
         log.info('Listening on socket address: %s', str(self.sockaddr))
 
+        if self.recv_batch_size > 1 or self.periodic_task:
+            log.info('Batched ingestion enabled, draining up to %s datagrams per wake-up', self.recv_batch_size)
+            self._run_batched()
+        else:
+            self._run()
+
+    def _run(self):
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
         aggregator_submit = self.metrics_aggregator.submit_packets
@@ -427,6 +649,155 @@ class Server(object):
             except Exception:
                 log.exception('Error receiving datagram `%s`', message)
 
+    def _run_batched(self):
+        # Inline variables for quick look-up.
+        buffer_size = self.buffer_size
+        recv_batch_size = self.recv_batch_size
+        aggregator_submit_batch = self.metrics_aggregator.submit_packets_batch
+        sock = [self.socket]
+        socket_recv = self.socket.recv
+        socket_error = socket.error
+        select_select = select.select
+        select_error = select.error
+        timeout = UDP_SOCKET_TIMEOUT
+        should_forward = self.should_forward
+        forward_udp_sock = self.forward_udp_sock
+
+        periodic_interval, periodic_callback = self.periodic_task or (None, None)
+        if periodic_callback:
+            timeout = min(timeout, periodic_interval)
+            next_periodic_run = time() + periodic_interval
+
+        # Run our select loop.
+        self.running = True
+        while self.running:
+            try:
+                ready = select_select(sock, [], [], timeout)
+                if ready[0]:
+                    # Drain the socket until it would block, the batch is full
+                    # or a real error comes up.
+                    messages = []
+                    try:
+                        while len(messages) < recv_batch_size:
+                            messages.append(socket_recv(buffer_size))
+                    except socket_error as e:
+                        if e.errno not in UDP_RECV_WOULD_BLOCK:
+                            log.warning('Error receiving datagram: %s', e)
+
+                    if messages:
+                        aggregator_submit_batch(messages)
+
+                        if should_forward:
+                            for message in messages:
+                                forward_udp_sock.send(message)
+
+                if periodic_callback and time() >= next_periodic_run:
+                    next_periodic_run = time() + periodic_interval
+                    periodic_callback()
+            except select_error as se:
+                # Ignore interrupted system calls from sigterm.
+                if se[0] != errno.EINTR:
+                    raise
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                log.exception('Error receiving datagrams')
+
+    def stop(self):
+        self.running = False
+
+
+class ShardWorker(multiprocessing.Process):
+    """
+    A StsStatsD worker process: it receives on its own socket bound with
+    SO_REUSEPORT, aggregates its share of the traffic and ships the partial
+    aggregates to the parent every `WORKER_EXPORT_INTERVAL` seconds.
+    """
+
+    def __init__(self, worker_id, partials_queue, aggregator_factory, server_kwargs):
+        multiprocessing.Process.__init__(self, name='stsstatsd-worker-%s' % worker_id)
+        self.daemon = True
+        self.partials_queue = partials_queue
+        self.aggregator_factory = aggregator_factory
+        self.server_kwargs = server_kwargs
+        self.server = None
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def export(self):
+        self.partials_queue.put(self.server.metrics_aggregator.export_partials())
+
+    def run(self):
+        self.server = Server(self.aggregator_factory(), reuse_port=True, **self.server_kwargs)
+        # Exports happen in the receive loop thread, no locking needed
+        self.server.periodic_task = (WORKER_EXPORT_INTERVAL, self.export)
+
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        signal.signal(signal.SIGINT, self._handle_sigterm)
+
+        self.server.start()
+
+
+class ShardedServer(object):
+    """
+    Runs `workers` ShardWorker processes on the same UDP port and merges the
+    partial aggregates they ship into `metrics_aggregator`, which the Reporter
+    flushes as usual. Exposes the same interface as `Server`.
+    """
+
+    def __init__(self, metrics_aggregator, aggregator_factory, workers, host, port, **server_kwargs):
+        self.metrics_aggregator = metrics_aggregator
+        self.aggregator_factory = aggregator_factory
+        self.worker_count = int(workers)
+        self.server_kwargs = dict(server_kwargs, host=host, port=port)
+        self.sockaddr = None
+        self.partials_queue = None
+        self.workers = []
+        self.running = False
+
+    def _start_worker(self, worker_id):
+        worker = ShardWorker(worker_id, self.partials_queue, self.aggregator_factory, self.server_kwargs)
+        worker.start()
+        return worker
+
+    def start(self):
+        self.partials_queue = multiprocessing.Queue()
+        self.workers = [self._start_worker(i) for i in range(self.worker_count)]
+        log.info('Started %s StsStatsD workers on port %s', self.worker_count, self.server_kwargs['port'])
+
+        merge_partials = self.metrics_aggregator.merge_partials
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    partials = self.partials_queue.get(True, UDP_SOCKET_TIMEOUT)
+                    merge_partials(partials)
+                except Queue.Empty:
+                    pass
+                except (KeyboardInterrupt, SystemExit):
+                    break
+                except IOError as e:
+                    # Ignore interrupted system calls from sigterm.
+                    if e.errno != errno.EINTR:
+                        raise
+                except Exception:
+                    log.exception('Error merging partial aggregates')
+
+                for i, worker in enumerate(self.workers):
+                    if self.running and not worker.is_alive():
+                        log.warning('StsStatsD worker %s exited with code %s, restarting it', i, worker.exitcode)
+                        self.workers[i] = self._start_worker(i)
+        finally:
+            self._stop_workers()
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+
     def stop(self):
         self.running = False
 
@@ -499,6 +870,9 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf')
+    recv_batch_size = c.get('dogstatsd_recv_batch_size')
+    workers = c.get('dogstatsd_workers') or 1
     server_host = c['bind_host']
 
     target = c['dd_url']
@@ -511,18 +885,27 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
+    def aggregator_factory():
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(c),
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            utf8_decoding=c['utf8_decoding'],
+            histogram_backend=c.get('histogram_backend'),
+            histogram_relative_accuracy=c.get('histogram_relative_accuracy'),
+            context_limit=c.get('dogstatsd_context_limit'),
+            context_limit_per_metric=c.get('dogstatsd_context_limit_per_metric')
+        )
+
+    aggregator = aggregator_factory()
 
     # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        udp_port=port, max_payload_size=c.get('dogstatsd_max_payload_size'),
+                        upload_workers=c.get('dogstatsd_upload_workers'))
 
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
@@ -533,7 +916,17 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    if workers > 1 and not Platform.is_linux():
+        log.warning("dogstatsd_workers requires SO_REUSEPORT load balancing (Linux), running a single StsStatsD process")
+        workers = 1
+
+    if workers > 1:
+        server = ShardedServer(aggregator, aggregator_factory, workers, server_host, port,
+                               forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                               so_rcvbuf=so_rcvbuf, recv_batch_size=recv_batch_size)
+    else:
+        server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                        so_rcvbuf=so_rcvbuf, recv_batch_size=recv_batch_size)
 
     return reporter, server, c
 
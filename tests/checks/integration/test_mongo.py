@@ -9,7 +9,9 @@ import pymongo
 
 # project
 from checks import AgentCheck
-from tests.checks.common import AgentCheckTest, load_check
+from tests.checks.common import AgentCheckTest, load_check, load_class
+
+StaggeredRefresh = load_class('mongo', 'StaggeredRefresh')
 
 PORT1 = 37017
 PORT2 = 37018
@@ -152,6 +154,64 @@ class TestMongoUnit(AgentCheckTest):
         unknown_desc = self.check.get_state_description(500)
         self.assertTrue(unknown_desc.find('500') != -1)
 
+    def test_client_reuse(self):
+        """
+        Clients are created once per server and parameters, and reused.
+        """
+        config = {
+            'instances': [self.MONGODB_CONFIG]
+        }
+        self.load_check(config)
+        server = self.MONGODB_CONFIG['server']
+
+        cli, key = self.check._get_client(server, 1000, {})
+        self.assertTrue(self.check._get_client(server, 1000, {})[0] is cli)
+        self.assertFalse(self.check._get_client(server, 1000, {'ssl': True})[0] is cli)
+        replset_cli, replset_key = self.check._get_client(
+            server, 1000, {}, replicaset='foo', read_preference=pymongo.ReadPreference.NEAREST)
+        self.assertFalse(replset_cli is cli)
+        self.assertEquals(len(self.check._clients), 3)
+
+        # Authenticated once, dropped when the authentication fails
+        self.check._authenticate = Mock(return_value=True)
+        self.assertTrue(self.check._authenticate_client(key, cli['test'], 'user', 'pass', False))
+        self.assertTrue(self.check._authenticate_client(key, cli['test'], 'user', 'pass', False))
+        self.assertEquals(self.check._authenticate.call_count, 1)
+
+        self.check._authenticate = Mock(return_value=False)
+        self.assertFalse(self.check._authenticate_client(replset_key, replset_cli['test'], 'user', 'pass', False))
+        self.assertFalse(replset_key in self.check._clients)
+
+        self.check.stop()
+        self.assertEquals(self.check._clients, {})
+
+    def test_staggered_refresh(self):
+        """
+        Refreshes are spread over the interval, each item refreshed once per interval.
+        """
+        # Everything, at every run, by default
+        refresh = StaggeredRefresh()
+        self.assertEquals(refresh.due(['a', 'b']), ['a', 'b'])
+        self.assertEquals(refresh.due(['a', 'b']), ['a', 'b'])
+
+        refresh = StaggeredRefresh(60)
+        items = ['db%s' % i for i in range(4)]
+        refreshed = []
+        for now in range(0, 120, 15):
+            due = refresh.due(items, now=now)
+            self.assertEquals(len(due), 1)
+            refreshed.extend(due)
+        self.assertEquals(refreshed, items * 2)
+
+        # Removed items are forgotten, new ones are spread too
+        self.assertEquals(refresh.due(['db1', 'new1', 'new2'], now=120), ['new1'])
+        self.assertEquals(refresh.due(['db1', 'new1', 'new2'], now=135), ['db1'])
+        self.assertEquals(refresh.due(['db1', 'new1', 'new2'], now=160), ['new2'])
+
+        # Missed runs don't make items due several times
+        self.assertEquals(refresh.due(['db1', 'new1', 'new2'], now=600), ['db1', 'new1', 'new2'])
+        self.assertEquals(refresh.due(['db1', 'new1', 'new2'], now=601), [])
+
 
 @attr(requires='mongo')
 class TestMongo(AgentCheckTest):
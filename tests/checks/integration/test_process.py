@@ -37,6 +37,27 @@ class MockProcess(object):
     def is_running(self):
         return True
 
+class MockSnapshotProcess(object):
+    def __init__(self, pid, name, cmdline, create_time=1):
+        self.pid = pid
+        self._name = name
+        self._cmdline = cmdline
+        self._create_time = create_time
+        self.cmdline_calls = 0
+
+    def create_time(self):
+        return self._create_time
+
+    def name(self):
+        return self._name
+
+    def cmdline(self):
+        self.cmdline_calls += 1
+        if self._cmdline is None:
+            raise psutil.AccessDenied(self.pid)
+        return self._cmdline
+
+
 def noop_get_pagefault_stats(pid):
     return None
 
@@ -249,6 +270,32 @@ class ProcessCheckTest(AgentCheckTest):
         # Shouldn't throw an exception
         self.run_check(config, mocks={'get_pagefault_stats': noop_get_pagefault_stats})
 
+    def test_process_snapshot(self):
+        self.run_check({}, mocks={'get_pagefault_stats': noop_get_pagefault_stats})
+        procs = [
+            MockSnapshotProcess(1, 'java', ['java', '-jar', 'app.jar']),
+            MockSnapshotProcess(2, 'python', ['python', 'agent.py']),
+            MockSnapshotProcess(3, 'python', ['python', 'java_wrapper.py']),
+            MockSnapshotProcess(4, 'secret', None),
+        ]
+
+        with patch('psutil.process_iter', return_value=procs):
+            self.assertEquals(self.check.find_pids('a', ['python'], True), set([2, 3]))
+            self.assertEquals(self.check.find_pids('b', ['java'], False), set([1, 3]))
+            self.assertEquals(self.check.find_pids('c', ['agent.py', 'app.jar'], False), set([1, 2]))
+            self.assertEquals(self.check.find_pids('d', ['ja', 'nothing'], False), set([1, 3]))
+            self.assertEquals(self.check.ad_cache, set([4]))
+            self.assertRaises(psutil.AccessDenied, self.check.find_pids, 'e', ['java'], False, ignore_ad=False)
+            # A single snapshot was taken for all the instances
+            self.assertEquals([p.cmdline_calls for p in procs], [1, 1, 1, 1])
+
+            # Next run: command lines of the same processes are not read again,
+            # a new process reusing a pid is
+            procs[2] = MockSnapshotProcess(3, 'python', ['python', 'other.py'], create_time=2)
+            self.check.last_pid_cache_ts = {}
+            self.assertEquals(self.check.find_pids('b', ['java'], False), set([1]))
+            self.assertEquals([p.cmdline_calls for p in procs], [1, 1, 1, 2])
+
     def mock_find_pids(self, name, search_string, exact_match=True, ignore_ad=True,
                        refresh_ad_cache=True):
         if search_string is not None:
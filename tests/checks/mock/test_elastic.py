@@ -0,0 +1,143 @@
+# stdlib
+import json
+import urlparse
+
+# 3p
+import mock
+
+# project
+from tests.checks.common import AgentCheckTest, load_class
+
+ESCheck = load_class('elastic', 'ESCheck')
+NodeStatsStream = load_class('elastic', 'NodeStatsStream')
+
+
+def _node_stats(name, docs):
+    return {
+        'name': name,
+        'host': '%s.example.com' % name,
+        'indices': {'docs': {'count': docs, 'deleted': 0}},
+        'thread_pool': {'bulk': {'queue': 2, 'active': 1, 'threads': 4, 'rejected': 0}},
+        'jvm': {'mem': {'heap_used_in_bytes': 1024, 'heap_committed_in_bytes': 2048}},
+        'transport': {'server_open': 12},
+        'tags': [u'\xe9t\xe9', '{"not": "a node"}'],
+    }
+
+
+NODE_STATS = {
+    '_nodes': {'total': 3, 'successful': 3, 'failed': 0},
+    'cluster_name': 'stats_cluster',
+    'nodes': dict(('node%s' % i, _node_stats('node%s' % i, i * 10)) for i in range(3)),
+}
+
+RESPONSES = {
+    '/': {'version': {'number': '2.4.1'}},
+    '/_cluster/health': {
+        'cluster_name': 'stats_cluster', 'status': 'green', 'timed_out': False,
+        'number_of_nodes': 3, 'number_of_data_nodes': 3, 'active_primary_shards': 5,
+        'active_shards': 10, 'relocating_shards': 0, 'initializing_shards': 0, 'unassigned_shards': 0,
+    },
+    '/_cluster/pending_tasks': {'tasks': [{'priority': 'high'}, {'priority': 'urgent'}]},
+}
+
+
+def _get_data_mock(url, config, send_sc=True):
+    path = urlparse.urlparse(url).path
+    if path.endswith('/stats'):
+        return json.loads(json.dumps(NODE_STATS))
+    return json.loads(json.dumps(RESPONSES[path or '/']))
+
+
+def _get_chunks_mock(url, config, send_sc=True):
+    body = json.dumps(NODE_STATS, indent=2)
+    return (body[i:i + 7] for i in xrange(0, len(body), 7))
+
+
+class TestNodeStatsStream(AgentCheckTest):
+    CHECK_NAME = 'elastic'
+
+    def _chunks(self, data, size):
+        # Raw UTF-8, so that some characters are split between chunks
+        body = json.dumps(data, indent=1, ensure_ascii=False).encode('utf-8')
+        return [body[i:i + size] for i in xrange(0, len(body), size)]
+
+    def test_stream(self):
+        for size in (1, 5, 64, 100000):
+            stream = NodeStatsStream(self._chunks(NODE_STATS, size))
+            header = stream.read_header()
+            self.assertEquals(header['cluster_name'], 'stats_cluster')
+            self.assertEquals(dict(stream.iter_nodes()), NODE_STATS['nodes'])
+
+    def test_header_after_nodes(self):
+        body = '{"nodes": {"a": {"name": "a"}, "b": {}},\n "cluster_name": "late"}'
+        stream = NodeStatsStream([body[:10], body[10:]])
+        self.assertEquals(stream.read_header(), {})
+        self.assertEquals(list(stream.iter_nodes()), [('a', {'name': 'a'}), ('b', {})])
+        self.assertEquals(stream.header, {'cluster_name': 'late'})
+
+    def test_empty_nodes(self):
+        stream = NodeStatsStream(['{"cluster_name": "c", "nodes": { }}'])
+        self.assertEquals(stream.read_header(), {'cluster_name': 'c'})
+        self.assertEquals(list(stream.iter_nodes()), [])
+
+    def test_malformed(self):
+        stream = NodeStatsStream(['{"cluster_name": "c", "nodes": {"a": {"name": '])
+        stream.read_header()
+        self.assertRaises(ValueError, list, stream.iter_nodes())
+
+        stream = NodeStatsStream(['["cluster_name"]'])
+        self.assertRaises(ValueError, stream.read_header)
+
+    def test_truncated(self):
+        # The response ends right before a value
+        stream = NodeStatsStream(iter(['{"cluster_name": "x", "nodes": {"a": ']))
+        stream.read_header()
+        self.assertRaises(ValueError, list, stream.iter_nodes())
+
+        stream = NodeStatsStream(iter(['{"cluster_name": ', '']))
+        self.assertRaises(ValueError, stream.read_header)
+
+
+class TestElasticMock(AgentCheckTest):
+    CHECK_NAME = 'elastic'
+
+    MOCKS = {
+        '_get_data': _get_data_mock,
+        '_get_chunks': _get_chunks_mock,
+    }
+
+    def _metrics(self, stream_node_stats):
+        config = {'instances': [{
+            'url': 'http://localhost:9200',
+            'cluster_stats': True,
+            'stream_node_stats': stream_node_stats,
+        }]}
+        self.run_check(config, mocks=self.MOCKS, force_reload=True)
+        return sorted((name, value, sorted(opts['tags']), opts['hostname'])
+                      for name, _, value, opts in self.metrics)
+
+    def test_stream_node_stats(self):
+        metrics = self._metrics(False)
+        self.assertEquals(self._metrics(True), metrics)
+
+        self.assertMetric('elasticsearch.docs.count', value=20, hostname='node2.example.com',
+                          tags=['url:http://localhost:9200', 'cluster_name:stats_cluster', 'node_name:node2'])
+        self.assertMetric('elasticsearch.pending_tasks_total', value=2)
+
+    def test_params_cache(self):
+        self._metrics(False)
+        params = self.check._get_params([2, 4, 1], True)
+        self.assertTrue(self.check._get_params([2, 4, 1], True) is params)
+        stats_metrics = params[4]
+        self.assertEquals(stats_metrics['elasticsearch.thread_pool.bulk.queue'][:2],
+                          ('gauge', ('thread_pool', 'bulk', 'queue')))
+        self.assertEquals(len(stats_metrics), len(self.check._define_params([2, 4, 1], True)[4]))
+
+    def test_stop(self):
+        self._metrics(False)
+        config = self.check.get_instance_config({'url': 'http://localhost:9200'})
+        session = self.check._get_session(config)
+        session.close = mock.Mock()
+        self.check.stop()
+        session.close.assert_called_once_with()
+        self.assertEquals(self.check._sessions, {})
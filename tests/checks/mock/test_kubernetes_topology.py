@@ -4,7 +4,7 @@ import requests
 
 
 # project
-from utils.kubernetes import KubeUtil
+from utils.kubernetes import KubeListCache, KubeUtil
 from tests.checks.common import Fixtures, AgentCheckTest
 
 import mock
@@ -38,6 +38,10 @@ class TestKubernetesTopology(AgentCheckTest):
 
     CHECK_NAME = 'kubernetes_topology'
 
+    def setUp(self):
+        KubeListCache().clear()
+        TestKubernetesTopologyMocks.json_auth_urls = []
+
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_json_auth')
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_machine_info')
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_nodes_list',
@@ -63,7 +67,7 @@ class TestKubernetesTopology(AgentCheckTest):
             'url': 'http://kubernetes'
         })
 
-        self.assertEqual(len(instances[0]['relations']), 99)
+        self.assertEqual(len(instances[0]['relations']), 96)
 
         pod_name_client = 'client-3129927420-r90fc'
         pod_name_service = 'raboof1-1475403310-kc380'
@@ -102,7 +106,8 @@ class TestKubernetesTopology(AgentCheckTest):
         self.assertEqual(podToReplicaSet['sourceId'], 'client-3129927420')
         self.assertEqual(podToReplicaSet['targetId'], pod_name_client)
 
-        first_created = len(instances[0]['relations']) - 4
+        # Only the nginxapp deployment matches the labels of the replicaset
+        first_created = len(instances[0]['relations']) - 1
         created = instances[0]['relations'][first_created]
         self.assertEqual(created['type'], {'name': 'CREATED'})
         self.assertEqual(created['sourceId'], deployment_nginx)
@@ -244,9 +249,9 @@ class TestKubernetesTopology(AgentCheckTest):
             'url': 'http://bar'
         })
 
-        self.assertEqual(len(instances[0]['relations']), 99)
+        self.assertEqual(len(instances[0]['relations']), 96)
         self.assertEqual(len(instances[0]['components']), 72)
-        self.assertEqual(len(instances[1]['relations']), 99)
+        self.assertEqual(len(instances[1]['relations']), 96)
         self.assertEqual(len(instances[1]['components']), 72)
 
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_json_auth',side_effect=TestKubernetesTopologyMocks.assure_retrieve_json_auth_called,autospec=True)
@@ -262,13 +267,30 @@ class TestKubernetesTopology(AgentCheckTest):
             "https://kubernetes:443/api/v1/pods/",
             "https://kubernetes:443/api/v1/endpoints/",
             "https://kubernetes:443/apis/extensions/v1beta1/deployments/",
-            "https://kubernetes:443/apis/extensions/v1beta1/namespaces/default/replicasets/?labelSelector=app%3Dnginxapp",
-            "https://kubernetes:443/apis/extensions/v1beta1/namespaces/kube-system/replicasets/?labelSelector=k8s-app%3Dheapster,version%3Dv1.2.0",
-            "https://kubernetes:443/apis/extensions/v1beta1/namespaces/kube-system/replicasets/?labelSelector=k8s-app%3Dkube-dns",
-            "https://kubernetes:443/apis/extensions/v1beta1/namespaces/kube-system/replicasets/?labelSelector=k8s-app%3Dkube-dns-autoscaler"
+            "https://kubernetes:443/apis/extensions/v1beta1/replicasets/"
         ])
 
         self.assertEquals(len(self.service_checks), 0, "no check errors expected")
+        self.assertMetric('kubernetes.api.requests', value=6, tags=['check:kubernetes_topology'])
+        self.assertMetric('kubernetes.api.cache_hit_ratio', value=0, tags=['check:kubernetes_topology'])
+
+    @mock.patch('utils.kubernetes.KubeUtil.retrieve_json_auth', side_effect=TestKubernetesTopologyMocks.assure_retrieve_json_auth_called, autospec=True)
+    @mock.patch('utils.kubernetes.KubeUtil.get_auth_token', side_effect=lambda: "DummyToken")
+    def test_kube_api_cache(self, *args):
+        instance = {'use_kube_auth': True, 'host': 'foo'}
+        self.run_check({'instances': [instance]})
+        self.run_check({'instances': [instance]}, force_reload=True)
+
+        # The second check is served from the cache shared by all the KubeUtil
+        self.assertEqual(len(TestKubernetesTopologyMocks.json_auth_urls), 6)
+        self.assertEqual(len(self.check.get_topology_instances()[0]['relations']), 96)
+        self.assertMetric('kubernetes.api.requests', value=0, tags=['check:kubernetes_topology'])
+        self.assertMetric('kubernetes.api.cache_hits', value=6, tags=['check:kubernetes_topology'])
+        self.assertMetric('kubernetes.api.cache_hit_ratio', value=1, tags=['check:kubernetes_topology'])
+
+        # Once expired, the lists are requested again
+        self.run_check({'instances': [dict(instance, api_cache_ttl=0)]}, force_reload=True)
+        self.assertEqual(len(TestKubernetesTopologyMocks.json_auth_urls), 12)
 
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_json_auth')
     @mock.patch('utils.kubernetes.KubeUtil.retrieve_machine_info')
@@ -0,0 +1,205 @@
+# 3p
+import mock
+
+# project
+from checks import AgentCheck
+from tests.checks.common import AgentCheckTest, Fixtures
+
+
+QUERY_RESULTS = {
+    'SHOW /*!50002 GLOBAL */ STATUS;': [('Connections', '10'), ('Threads_connected', '2')],
+    'SHOW GLOBAL VARIABLES;': [('max_connections', '151'), ('log_bin', 'OFF'), ('performance_schema', 'OFF')],
+    'SELECT VERSION()': [('5.7.10-log',)],
+}
+SCHEMA_SIZE_QUERY = 'information_schema.tables'
+INNODB_STATUS_QUERY = 'SHOW /*!50000 ENGINE*/ INNODB STATUS'
+
+
+class MockCursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    @property
+    def rowcount(self):
+        return len(self.rows)
+
+    def execute(self, query):
+        self.db.queries.append(query)
+        if SCHEMA_SIZE_QUERY in query:
+            self.rows = [('testdb', 12)]
+        else:
+            self.rows = QUERY_RESULTS.get(query, [])
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class MockConnection(object):
+    port = 3306
+
+    def __init__(self, queries):
+        self.queries = queries
+        self.closed = False
+        self.alive = True
+
+    def cursor(self, cursor_class=None):
+        return MockCursor(self)
+
+    def ping(self, reconnect=True):
+        if not self.alive:
+            raise Exception("MySQL server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class TestMySqlConnection(AgentCheckTest):
+    CHECK_NAME = 'mysql'
+
+    INSTANCE = {
+        'server': '10.0.0.1',
+        'user': 'stackstate',
+        'pass': 'secret',
+        'options': {'schema_size_metrics': True},
+    }
+
+    def setUp(self):
+        self.queries = []
+        self.connections = []
+
+    def connect(self, **kwargs):
+        db = MockConnection(self.queries)
+        self.connections.append(db)
+        return db
+
+    def run_mysql(self, instance=None, **kwargs):
+        with mock.patch('pymysql.connect', side_effect=self.connect):
+            self.run_check({'instances': [instance or self.INSTANCE]}, **kwargs)
+
+    def count(self, query):
+        return len([q for q in self.queries if query in q])
+
+    def test_persistent_connection(self):
+        self.run_mysql(force_reload=True)
+        self.run_mysql()
+        self.run_mysql()
+
+        self.assertEquals(len(self.connections), 1)
+        self.assertFalse(self.connections[0].closed)
+        self.assertServiceCheck('mysql.can_connect', status=AgentCheck.OK, count=1)
+        self.assertMetric('mysql.net.max_connections_available', value=151)
+
+        # Slow-changing results are cached
+        self.assertEquals(self.count('SHOW /*!50002 GLOBAL */ STATUS;'), 3)
+        self.assertEquals(self.count('SHOW GLOBAL VARIABLES;'), 1)
+        self.assertEquals(self.count('SELECT VERSION()'), 1)
+        self.assertEquals(self.count('information_schema.ENGINES'), 1)
+
+        self.check.stop()
+        self.assertTrue(self.connections[0].closed)
+
+    def test_no_persistent_connection(self):
+        instance = dict(self.INSTANCE, persistent_connection=False)
+        self.run_mysql(instance, force_reload=True)
+        self.run_mysql(instance)
+
+        self.assertEquals(len(self.connections), 2)
+        self.assertTrue(all(db.closed for db in self.connections))
+
+    def test_reconnect(self):
+        self.run_mysql(force_reload=True)
+        self.connections[0].alive = False
+        self.run_mysql()
+
+        self.assertEquals(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+        self.assertFalse(self.connections[1].closed)
+        # The server may have been restarted, cached results are queried again
+        self.assertEquals(self.count('SHOW GLOBAL VARIABLES;'), 2)
+
+    def test_reconnect_backoff(self):
+        def fail(**kwargs):
+            self.connections.append(None)
+            raise Exception("Can't connect to MySQL server")
+
+        with mock.patch('pymysql.connect', side_effect=fail):
+            self.assertRaises(Exception, lambda: self.run_check({'instances': [self.INSTANCE]}, force_reload=True))
+            self.assertRaises(Exception, lambda: self.run_check({'instances': [self.INSTANCE]}))
+        # The second run didn't try to connect
+        self.assertEquals(len(self.connections), 1)
+        self.assertServiceCheck('mysql.can_connect', status=AgentCheck.CRITICAL, count=1)
+
+        failures, retry_ts = self.check._reconnect_backoff['10.0.0.1']
+        self.assertEquals(failures, 1)
+        self.check._reconnect_backoff['10.0.0.1'] = (failures, 0)
+        self.run_mysql()
+        self.assertEquals(len(self.connections), 2)
+        self.assertFalse('10.0.0.1' in self.check._reconnect_backoff)
+
+    def test_heavy_queries_interval(self):
+        self.run_mysql(force_reload=True)
+        self.run_mysql()
+        self.assertEquals(self.count(SCHEMA_SIZE_QUERY), 2)
+        self.assertMetric('mysql.info.schema.size', tags=['schema:testdb'], count=1)
+
+        self.queries[:] = []
+        instance = dict(self.INSTANCE, options={'schema_size_metrics': True, 'heavy_queries_interval': 60})
+        self.run_mysql(instance, force_reload=True)
+        self.run_mysql(instance)
+        self.assertEquals(self.count(SCHEMA_SIZE_QUERY), 1)
+        self.assertMetric('mysql.info.schema.size', count=0)
+
+
+class TestInnoDBStatus(AgentCheckTest):
+    CHECK_NAME = 'mysql'
+
+    def get_stats(self, status_text):
+        self.load_check({'instances': [TestMySqlConnection.INSTANCE]})
+        with mock.patch.dict(QUERY_RESULTS, {INNODB_STATUS_QUERY: [('InnoDB', '', status_text)]}):
+            return self.check._get_stats_from_innodb_status(MockConnection([]))
+
+    def test_sections(self):
+        results = self.get_stats(Fixtures.read_file('innodb_status_5.6', string_escape=False))
+
+        self.assertEquals(results['Innodb_mutex_spin_waits'], '289398')
+        self.assertEquals(results['Innodb_x_lock_os_waits'], '2605')
+        self.assertEquals(results['Innodb_semaphore_waits'], '2')
+        self.assertEquals(results['Innodb_semaphore_wait_time'], '3000')
+        self.assertEquals(results['Innodb_history_list_length'], '1130')
+        self.assertEquals(results['Innodb_current_transactions'], '4')
+        self.assertEquals(results['Innodb_active_transactions'], '3')
+        self.assertEquals(results['Innodb_locked_transactions'], '1')
+        self.assertEquals(results['Innodb_lock_structs'], '10')
+        self.assertEquals(results['Innodb_row_lock_time'], '32000')
+        self.assertEquals(results['Innodb_read_views'], '2')
+        self.assertEquals(results['Innodb_os_file_reads'], '8782182')
+        self.assertEquals(results['Innodb_ibuf_merged'], '1054081')
+        self.assertEquals(results['Innodb_checkpoint_age'], '18624')
+        self.assertEquals(results['Innodb_rows_read'], '454561562')
+
+        # The latest deadlock isn't counted with the current transactions
+        self.assertEquals(results['Innodb_tables_in_use'], '2')
+        self.assertEquals(results['Innodb_locked_tables'], '2')
+        # Totals of all the buffer pools, not the last one's
+        self.assertEquals(results['Innodb_buffer_pool_pages_total'], '1769471')
+        self.assertEquals(results['Innodb_buffer_pool_pages_free'], '1024')
+        self.assertEquals(results['Innodb_pages_read'], '15240822')
+
+    def test_no_sections(self):
+        # Every line is parsed when the section headers can't be found
+        results = self.get_stats("Trx id counter 58312\n"
+                                 "History list length 12\n"
+                                 "---TRANSACTION 58311, ACTIVE 12 sec inserting\n"
+                                 "Log sequence number 1200\n"
+                                 "Last checkpoint at  1000\n")
+
+        self.assertEquals(results['Innodb_history_list_length'], '12')
+        self.assertEquals(results['Innodb_active_transactions'], '1')
+        self.assertEquals(results['Innodb_checkpoint_age'], '200')
@@ -50,24 +50,30 @@ class TestCheckNetwork(AgentCheckTest):
         'system.net.tcp6.time_wait': 1,
     }
 
+    @mock.patch('network.Network._count_proc_cx_state', side_effect=IOError)
     @mock.patch('network.get_subprocess_output', side_effect=ss_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
-    def test_cx_state_linux_ss(self, mock_subprocess, mock_platform):
+    def test_cx_state_linux_ss(self, mock_subprocess, mock_platform, mock_proc):
         self.run_check({})
 
         # Assert metrics
         for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
             self.assertMetric(metric, value=value)
 
+    @mock.patch('network.Network._count_proc_cx_state', side_effect=IOError)
     @mock.patch('network.get_subprocess_output', side_effect=netstat_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
-    def test_cx_state_linux_netstat(self, mock_subprocess, mock_platform):
+    def test_cx_state_linux_netstat(self, mock_subprocess, mock_platform, mock_proc):
         self.run_check({})
 
         # Assert metrics
         for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
             self.assertMetric(metric, value=value)
 
+    def test_cx_state_linux_proc(self):
+        metrics = self.check._count_proc_cx_state(Fixtures.file('proc'))
+        self.assertEqual(metrics, self.CX_STATE_GAUGES_VALUES)
+
     @mock.patch('network.Platform.is_linux', return_value=False)
     @mock.patch('network.Platform.is_bsd', return_value=False)
     @mock.patch('network.Platform.is_solaris', return_value=False)
@@ -0,0 +1,201 @@
+# stdlib
+from bisect import bisect_right
+from collections import defaultdict
+import socket
+import threading
+import time
+
+# 3p
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1902, rfc1905
+
+# project
+from checks import AgentCheck
+from tests.checks.common import AgentCheckTest
+
+RESULTS_TIMEOUT = 10
+
+pMod = api.protoModules[api.protoVersion2c]
+
+# ifInOctets column of a 30 interfaces ifTable, and a couple of scalars
+IF_IN_OCTETS = '1.3.6.1.2.1.2.2.1.10'
+MIB_VARIABLES = dict(
+    [('%s.%s' % (IF_IN_OCTETS, i), rfc1902.Counter32(1000 + i)) for i in xrange(1, 31)] +
+    [('1.3.6.1.2.1.2.2.1.16.1', rfc1902.Counter32(42)),
+     ('1.3.6.1.2.1.6.9.0', rfc1902.Gauge32(12)),
+     ('1.3.6.1.2.1.7.1.0', rfc1902.Counter32(7))]
+)
+
+
+def oid_tuple(oid):
+    return tuple(int(i) for i in oid.split('.'))
+
+
+class SnmpAgent(object):
+    """
+    A minimal SNMP v2c agent, serving MIB_VARIABLES to get, getnext and
+    getbulk requests and counting them
+    """
+
+    def __init__(self, variables=MIB_VARIABLES):
+        self.variables = dict((oid_tuple(oid), value) for oid, value in variables.iteritems())
+        self.oids = sorted(self.variables)
+        self.requests = defaultdict(int)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+            self.sock.sendto(self.respond(data), address)
+
+    def get_next(self, oid):
+        idx = bisect_right(self.oids, tuple(oid))
+        if idx == len(self.oids):
+            return oid, rfc1905.endOfMibView
+        return self.oids[idx], self.variables[self.oids[idx]]
+
+    def respond(self, data):
+        req_msg, _ = decoder.decode(data, asn1Spec=pMod.Message())
+        req_pdu = pMod.apiMessage.getPDU(req_msg)
+        rsp_msg = pMod.apiMessage.getResponse(req_msg)
+        rsp_pdu = pMod.apiMessage.getPDU(rsp_msg)
+        oids = [oid for oid, _value in pMod.apiPDU.getVarBinds(req_pdu)]
+
+        var_binds = []
+        if req_pdu.isSameTypeWith(pMod.GetRequestPDU()):
+            self.requests['get'] += 1
+            for oid in oids:
+                var_binds.append((oid, self.variables.get(tuple(oid), rfc1905.noSuchInstance)))
+        elif req_pdu.isSameTypeWith(pMod.GetNextRequestPDU()):
+            self.requests['getnext'] += 1
+            for oid in oids:
+                var_binds.append(self.get_next(oid))
+        else:
+            self.requests['getbulk'] += 1
+            for _ in xrange(pMod.apiBulkPDU.getMaxRepetitions(req_pdu)):
+                row = [self.get_next(oid) for oid in oids]
+                var_binds.extend(row)
+                oids = [oid for oid, _value in row]
+
+        pMod.apiPDU.setVarBinds(rsp_pdu, var_binds)
+        return encoder.encode(rsp_msg)
+
+
+class TestSnmp(AgentCheckTest):
+    CHECK_NAME = 'snmp'
+
+    METRICS = [
+        {'OID': IF_IN_OCTETS, 'name': 'ifInOctets'},
+        {'OID': '1.3.6.1.2.1.6.9.0', 'name': 'tcpCurrEstab'},
+        {'OID': '1.3.6.1.2.1.7.1', 'name': 'udpInDatagrams', 'forced_type': 'gauge'},
+    ]
+
+    def setUp(self):
+        self.agent = SnmpAgent()
+
+    def tearDown(self):
+        self.agent.stop()
+        if self.check:
+            self.check.stop()
+
+    def get_instance(self, name='device', port=None, **kwargs):
+        instance = {
+            'name': name,
+            'ip_address': '127.0.0.1',
+            'port': port or self.agent.port,
+            'community_string': 'public',
+            'timeout': 1,
+            'retries': 0,
+            'metrics': self.METRICS,
+            'tags': ['device:%s' % name],
+        }
+        instance.update(kwargs)
+        return instance
+
+    def walk(self, instance):
+        cmd_generator = self.check.create_command_generator(None, False)
+        return self.check.check_table(instance, cmd_generator, [IF_IN_OCTETS, '1.3.6.1.2.1.7.1'], False, 1, 0)
+
+    def wait_for_service_checks(self, count):
+        for _ in xrange(RESULTS_TIMEOUT * 10):
+            self.check._process_results()
+            if len(self.check.service_checks) >= count:
+                break
+            time.sleep(0.1)
+        self.metrics = self.check.get_metrics()
+        self.service_checks = self.check.get_service_checks()
+
+    def test_bulk_walk(self):
+        self.load_check({'init_config': {}, 'instances': [self.get_instance()]})
+
+        results = self.walk(self.get_instance())
+        self.assertEquals(self.agent.requests, {'get': 1, 'getnext': 31})
+        self.assertEquals(len(results), 31)
+        self.assertEquals(results['%s.30' % IF_IN_OCTETS], 1030)
+        self.assertEquals(results['1.3.6.1.2.1.7.1.0'], 7)
+
+        self.agent.requests.clear()
+        bulk_results = self.walk(self.get_instance(bulk_max_repetitions=8))
+        self.assertEquals(self.agent.requests, {'get': 1, 'getbulk': 4})
+        # The rows past the end of the column are left out
+        self.assertEquals(bulk_results, results)
+
+        # SNMP v1 doesn't support GETBULK
+        self.assertEquals(self.check.get_bulk_max_repetitions(self.get_instance(bulk_max_repetitions=8)), 8)
+        self.assertEquals(
+            self.check.get_bulk_max_repetitions(self.get_instance(bulk_max_repetitions=8, snmp_version=1)), 0)
+
+    def test_async_polling(self):
+        config = {
+            'init_config': {'async_polling': True, 'bulk_max_repetitions': 10},
+            'instances': [self.get_instance('device%s' % i) for i in xrange(20)]
+        }
+        self.run_check(config)
+        self.wait_for_service_checks(20)
+
+        self.assertEquals(self.check.pool_size, 256)
+        self.assertEquals(self.agent.requests['getbulk'], 20 * 4)
+        tags = ['device:device3', 'snmp_device:127.0.0.1']
+        self.assertMetric('snmp.tcpCurrEstab', value=12, tags=tags, count=1)
+        self.assertMetric('snmp.tcpCurrEstab', value=12, count=20)
+        self.assertMetric('snmp.udpInDatagrams', value=7, count=20)
+        self.assertMetric('snmp.device.poll_time', count=20)
+        self.assertMetric('snmp.device.timeouts', value=0, count=20)
+        self.assertServiceCheck('snmp.can_check', status=AgentCheck.OK, count=20)
+        self.assertFalse(self.check.jobs_status)
+
+    def test_async_timeout(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        config = {
+            'init_config': {'async_polling': True},
+            'instances': [self.get_instance(), self.get_instance('silent', port=sock.getsockname()[1])]
+        }
+        try:
+            self.run_check(config)
+            self.wait_for_service_checks(2)
+            self.assertMetric('snmp.device.timeouts', value=0, count=1)
+            self.assertMetric('snmp.device.timeouts', value=1, count=1)
+
+            # Each poll only reports its own timeouts
+            self.run_check(config)
+            self.wait_for_service_checks(2)
+        finally:
+            sock.close()
+
+        self.assertMetric('snmp.device.timeouts', value=0, count=1)
+        self.assertMetric('snmp.device.timeouts', value=1, count=1)
+        self.assertServiceCheck('snmp.can_check', status=AgentCheck.OK, count=1)
+        self.assertServiceCheck('snmp.can_check', status=AgentCheck.CRITICAL, count=1)
+        self.assertMetric('snmp.tcpCurrEstab', count=1)
@@ -1,10 +1,17 @@
 # stdlib
 import logging
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
+# 3p
+import mock
+
 # project
 from checks.system.unix import (
+    Cpu,
     IO,
     Load,
     Memory,
@@ -141,6 +148,54 @@ dm-1              0.00     0.00    0.00    0.00     0.00     0.00     0.00     0
         results = checker._parse_linux2(linux_output_dashes)
         self.assertTrue(sorted(results.keys()) == ['dm-0', 'dm-1', 'sda'])
 
+    def testDiskStats(self):
+        procfs_path = tempfile.mkdtemp()
+        diskstats_path = os.path.join(procfs_path, 'diskstats')
+        try:
+            with open(diskstats_path, 'w') as f:
+                f.write("   8       0 sda 1000 10 8000 500 2000 200 16000 3000 0 1500 3500 0 0 0 0\n"
+                        "   8       1 sda1 40 3 12 8\n"
+                        "   7       0 loop0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+            checker = IO(logger)
+            with mock.patch('os.path.isdir', return_value=False):
+                # No sample to compare to yet
+                self.assertEqual(checker.check({'procfs_path': procfs_path}), {})
+                self.assertEqual(checker._read_diskstats(procfs_path).keys(), ['sda'])
+
+                previous = checker._read_diskstats(procfs_path)
+                with open(diskstats_path, 'w') as f:
+                    f.write("   8       0 sda 1100 20 8800 600 2300 300 18400 3600 1 2000 4200 0 0 0 0\n")
+                current = checker._read_diskstats(procfs_path)
+        finally:
+            shutil.rmtree(procfs_path)
+
+        results = checker._compute_diskstats(previous, current, 2.0)
+        self.assertEqual(results, {'sda': {
+            'rrqm/s': '5.00', 'wrqm/s': '50.00', 'r/s': '50.00', 'w/s': '150.00',
+            'rkB/s': '200.00', 'wkB/s': '600.00', 'avgrq-sz': '8.00', 'avgqu-sz': '0.35',
+            'await': '1.75', 'r_await': '1.00', 'w_await': '2.00', 'svctm': '1.25', '%util': '25.00',
+        }})
+
+    def testCpuStat(self):
+        procfs_path = tempfile.mkdtemp()
+        stat_path = os.path.join(procfs_path, 'stat')
+        try:
+            checker = Cpu(logger)
+            with open(stat_path, 'w') as f:
+                f.write("cpu  1000 100 500 8000 200 0 100 100 0 0\n"
+                        "cpu0 1000 100 500 8000 200 0 100 100 0 0\n")
+            # No sample to compare to yet
+            self.assertFalse(checker.check({'procfs_path': procfs_path}))
+            with open(stat_path, 'w') as f:
+                f.write("cpu  1300 100 600 8450 100 20 130 100 100 0\n")
+            results = checker.check({'procfs_path': procfs_path})
+        finally:
+            shutil.rmtree(procfs_path)
+
+        # iowait went backwards and counts as 0, guest time is part of user time
+        self.assertEqual(results, {'cpuUser': 22.22, 'cpuSystem': 16.66, 'cpuWait': 0.0,
+                                   'cpuIdle': 50.0, 'cpuStolen': 0.0, 'cpuGuest': 11.11})
+
     def testNetwork(self):
         # FIXME: cx_state to true, but needs sysstat installed
         config = """
@@ -1,5 +1,5 @@
 # stdlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 # 3p
 from mock import Mock
@@ -7,7 +7,11 @@ from pyVmomi import vim  # pylint: disable=E0611
 import simplejson as json
 
 # datadog
-from tests.checks.common import AgentCheckTest, Fixtures
+from tests.checks.common import AgentCheckTest, Fixtures, load_class
+
+ObjectUpdate = namedtuple('ObjectUpdate', ['kind', 'obj', 'changeSet'])
+PropertyChange = namedtuple('PropertyChange', ['name', 'op', 'val'])
+UpdateSet = namedtuple('UpdateSet', ['version', 'truncated', 'filterSet'])
 
 
 class MockedMOR(Mock):
@@ -88,6 +92,43 @@ def create_topology(topology_json):
     return rec_build(json.loads(Fixtures.read_file(topology_json)))
 
 
+def topology_updates(topology):
+    """
+    Helper, the `ObjectUpdate`s a PropertyCollector reports for the entities of
+    a topology generated by `create_topology`, on its first retrieval.
+    """
+    updates = []
+
+    def enter(obj, parent, **properties):
+        properties.update(name=obj.name, parent=parent)
+        changes = [PropertyChange(name, 'assign', val) for name, val in properties.iteritems()]
+        updates.append(ObjectUpdate('enter', obj, changes))
+
+    def rec_updates(obj, parent):
+        enter(obj, parent)
+        if isinstance(obj, vim.Folder):
+            for child in obj.childEntity:
+                rec_updates(child, obj)
+        elif isinstance(obj, vim.Datacenter):
+            host_folder = MockedMOR(spec="Folder", name="host")
+            enter(host_folder, obj)
+            for child in obj.hostFolder.childEntity:
+                rec_updates(child, host_folder)
+        elif isinstance(obj, vim.ClusterComputeResource):
+            for host in obj.host:
+                rec_updates(host, obj)
+        elif isinstance(obj, vim.HostSystem):
+            for vm in obj.vm:
+                enter(vm, None, **{
+                    'runtime.powerState': vm.runtime.powerState,
+                    'runtime.host': obj,
+                    'customValue': vm.customValue,
+                })
+
+    rec_updates(topology, None)
+    return updates
+
+
 class TestvSphereUnit(AgentCheckTest):
     """
     Unit tests for vSphere AgentCheck.
@@ -246,3 +287,115 @@ class TestvSphereUnit(AgentCheckTest):
                 u"vsphere_cluster:compute_resource2", u"vsphere_host:host3", u"vsphere_type:vm"
             ]
         )
+
+    def test_inventory_mor_discovery(self):
+        """
+        Discover hosts, virtual machines from the PropertyCollector inventory,
+        with the same results as when exploring the vCenter infrastructure.
+        """
+        VSphereInventory = load_class(self.CHECK_NAME, 'VSphereInventory')
+        vcenter_topology = create_topology('vsphere_topology.json')
+        updates = topology_updates(vcenter_topology)
+
+        content = Mock()
+        content.viewManager.CreateContainerView.return_value = Mock(spec=vim.view.ContainerView)
+        collector = content.propertyCollector.CreatePropertyCollector.return_value
+        # The first retrieval is truncated
+        collector.WaitForUpdatesEx.side_effect = [
+            UpdateSet('1', True, [Mock(objectSet=updates[:4])]),
+            UpdateSet('2', False, [Mock(objectSet=updates[4:])]),
+        ]
+        inventory = VSphereInventory(content)
+        self.assertEquals(inventory.update(), len(updates))
+        self.assertEquals(inventory.version, '2')
+
+        tags = [u"toto"]
+        include_regexes = {
+            'host_include': "host[2-9]",
+            'vm_include': "vm[^2]",
+        }
+        self.check._discover_inventory_mor(123, inventory, tags, include_regexes, True)
+
+        self.assertMOR(count=3)
+        self.assertMOR(
+            name="host2", spec="host",
+            tags=[
+                u"toto", u"vsphere_datacenter:datacenter1",
+                u"vsphere_cluster:compute_resource1", u"vsphere_type:host"
+            ]
+        )
+        self.assertMOR(
+            name="host3", spec="host",
+            tags=[
+                u"toto", u"folder1", u"vsphere_datacenter:datacenter2",
+                u"vsphere_cluster:compute_resource2", u"vsphere_type:host"
+            ]
+        )
+        self.assertMOR(
+            name="vm4", spec="vm",
+            tags=[
+                u"toto", u"folder1", u"vsphere_datacenter:datacenter2",
+                u"vsphere_cluster:compute_resource2", u"vsphere_host:host3", u"vsphere_type:vm"
+            ]
+        )
+
+        # Next updates only bring the changes: vm3 is powered on, vm4 is gone
+        vm3, vm4 = [u.obj for u in updates if u.obj.name in ('vm3', 'vm4')]
+        collector.WaitForUpdatesEx.side_effect = [
+            UpdateSet('3', False, [Mock(objectSet=[
+                ObjectUpdate('modify', vm3, [PropertyChange('runtime.powerState', 'assign', 'poweredOn')]),
+                ObjectUpdate('leave', vm4, []),
+            ])]),
+            None,
+        ]
+        self.assertEquals(inventory.update(), 2)
+        self.assertEquals(inventory.version, '3')
+
+        self._mor_list[:] = []
+        self.check._discover_inventory_mor(123, inventory, tags, include_regexes, True)
+        self.assertMOR(count=3)
+        self.assertMOR(name="vm3", spec="vm")
+        self.assertFalse([mor for mor in self._mor_list if mor['hostname'] == 'vm4'])
+
+        # No changes
+        collector.WaitForUpdatesEx.side_effect = [None]
+        self.assertEquals(inventory.update(), 0)
+
+    def test_batched_collection(self):
+        """
+        Query the metrics of the MORs in batches, one QueryPerf call per batch.
+        """
+        instance = {'name': 'vsphere_mock'}
+        self.check.init_config = {'batch_query_perf_size': 2}
+        self.check.metrics_metadata = {
+            'vsphere_mock': {1: {'name': 'mem.usage', 'unit': 'percent'}}
+        }
+        mors = [
+            dict(mor_type='vm', mor=MockedMOR(spec="VirtualMachine", name="vm%s" % i),
+                 hostname="vm%s" % i, tags=[], metrics=[vim.PerformanceManager.MetricId(counterId=1, instance='')])
+            for i in xrange(5)
+        ]
+        self.check.morlist = {'vsphere_mock': dict((str(mor['mor']), mor) for mor in mors)}
+
+        def query_perf(querySpec):
+            return [
+                Mock(entity=spec.entity, value=[Mock(id=Mock(counterId=1, instance=''), value=[5000])])
+                for spec in querySpec
+            ]
+        perf_manager = Mock()
+        perf_manager.QueryPerf.side_effect = query_perf
+        server_instance = Mock()
+        server_instance.content.perfManager = perf_manager
+        self.check._get_server_instance = Mock(return_value=server_instance)
+
+        self.check.collect_metrics(instance)
+        self.assertTrue(self.check.exceptionq.empty(), self.check.exceptionq.queue)
+        self.assertEquals(perf_manager.QueryPerf.call_count, 3)
+        self.assertEquals(sorted(len(c[1]['querySpec']) for c in perf_manager.QueryPerf.call_args_list), [1, 2, 2])
+
+        metrics = self.check.get_metrics()
+        usage = [m for m in metrics if m[0] == 'vsphere.mem.usage']
+        self.assertEquals(sorted(m[3]['hostname'] for m in usage), ['vm%s' % i for i in xrange(5)])
+        self.assertEquals(usage[0][2], 50)
+        batches = [m for m in metrics if m[0] == 'stackstate.agent.vsphere.query_perf.batches']
+        self.assertEquals(batches[0][2], 3)
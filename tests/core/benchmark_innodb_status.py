@@ -0,0 +1,110 @@
+"""
+Performance tests for the MySQL check's SHOW ENGINE INNODB STATUS parser:
+the sectioned parser against a line by line parse of the whole output, on a
+captured status inflated with the transactions of a busy server.
+"""
+# stdlib
+from collections import defaultdict
+import os
+import re
+import time
+
+# project
+from tests.checks.common import load_class
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..', 'checks', 'fixtures', 'mysql', 'innodb_status_5.6')
+SKIPPED_SECTIONS = re.compile(
+    r'^-+\n(?:INDIVIDUAL BUFFER POOL INFO|LATEST DETECTED DEADLOCK)\n-+\n.*?(?=^-+\n[A-Z])', re.M | re.S)
+
+TRANSACTION = """---TRANSACTION %(id)s, ACTIVE %(sec)s sec fetching rows
+mysql tables in use 1, locked 1
+%(structs)s lock struct(s), heap size 1184, 12 row lock(s), undo log entries 3
+MySQL thread id %(thread)s, OS thread handle 0x7f5c3c4b8700, query id 8%(thread)s 10.0.0.12 app Sending data
+SELECT o.id, o.amount FROM orders o JOIN customers c ON c.id = o.customer_id WHERE c.region = 'eu' FOR UPDATE
+Trx read view will not see trx with id >= %(id)s, sees < %(id)s
+"""
+LOCK_WAIT = """---TRANSACTION %(id)s, ACTIVE %(sec)s sec starting index read
+mysql tables in use 1, locked 1
+LOCK WAIT 2 lock struct(s), heap size 360, 1 row lock(s)
+MySQL thread id %(thread)s, OS thread handle 0x7f5c3c3b7700, query id 9%(thread)s 10.0.0.13 app updating
+UPDATE orders SET amount = 13 WHERE id = 1
+------- TRX HAS BEEN WAITING %(sec)s SEC FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 6 page no 3 n bits 72 index `PRIMARY` of table `shop`.`orders` trx id %(id)s lock_mode X waiting
+Record lock, heap no 2 PHYSICAL RECORD: n_fields 5; compact format; info bits 0
+ 0: len 4; hex 80000001; asc     ;;
+ 1: len 6; hex 00000000e3c1; asc       ;;
+ 2: len 7; hex 0b000001510110; asc     Q  ;;
+------------------
+"""
+IDLE = """---TRANSACTION 0, not started
+MySQL thread id %(thread)s, OS thread handle 0x7f5c3c4f9700, query id 7%(thread)s 10.0.0.14 app cleaning up
+"""
+
+
+class TestInnoDBStatusPerf(object):
+
+    TRANSACTIONS = 5000
+    ROUNDS = 5
+
+    @classmethod
+    def build_status(cls, captured):
+        """
+        The captured status, with thousands of idle, running and waiting
+        transactions in its TRANSACTIONS section
+        """
+        transactions = []
+        for i in xrange(cls.TRANSACTIONS):
+            template = (IDLE, TRANSACTION, TRANSACTION, LOCK_WAIT)[i % 4]
+            transactions.append(template % {'id': 60000 + i, 'sec': i % 60, 'structs': i % 7 + 1, 'thread': i})
+        marker = 'LIST OF TRANSACTIONS FOR EACH SESSION:\n'
+        return captured.replace(marker, marker + ''.join(transactions))
+
+    @staticmethod
+    def load_check():
+        MySql = load_class('mysql', 'MySql')
+        return MySql('mysql', {}, {}, instances=[{'server': 'localhost'}])
+
+    @staticmethod
+    def legacy_parse(check, status_text):
+        results = defaultdict(int)
+        check._parse_innodb_status_lines(status_text.splitlines(), results)
+        return results
+
+    def parses_per_second(self, status_text, parse):
+        best = None
+        for _ in xrange(self.ROUNDS):
+            start = time.time()
+            parse(status_text)
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+        return 1 / best
+
+    def test_parser_throughput(self):
+        with open(FIXTURE) as f:
+            status_text = self.build_status(f.read())
+        check = self.load_check()
+
+        legacy_ps = self.parses_per_second(status_text, lambda text: self.legacy_parse(check, text))
+        sectioned_ps = self.parses_per_second(status_text, check._parse_innodb_status)
+
+        print "status of %d KB, %d transactions" % (len(status_text) / 1024, self.TRANSACTIONS)
+        print "line parser: %.1f parses/s" % legacy_ps
+        print "sectioned parser: %.1f parses/s (x%.2f)" % (sectioned_ps, sectioned_ps / legacy_ps)
+        assert sectioned_ps > legacy_ps
+
+    def test_parser_results(self):
+        # Without several buffer pools or a deadlock, which the line parser
+        # mixes up with the totals and the current transactions, both parsers
+        # must agree
+        with open(FIXTURE) as f:
+            captured = f.read()
+        captured = SKIPPED_SECTIONS.sub('', captured)
+        status_text = self.build_status(captured)
+        check = self.load_check()
+
+        assert check._parse_innodb_status(status_text) == self.legacy_parse(check, status_text)
+
+
+if __name__ == '__main__':
+    t = TestInnoDBStatusPerf()
+    t.test_parser_throughput()
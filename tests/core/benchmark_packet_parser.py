@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the dogstatsd packet parser: packets/s of
+`Aggregator.parse_metric_context` (and the submission path built on it)
+against the generic `parse_metric_packet` + `_extract_magic_tags` +
+`submit_metric` path.
+"""
+# stdlib
+import random
+import time
+
+# project
+from aggregator import MetricsBucketAggregator
+
+
+class TestPacketParserPerf(object):
+
+    PACKET_COUNT = 200000
+    METRIC_NAMES = 500
+    TAG_SETS = 200
+    ROUNDS = 3
+
+    @classmethod
+    def build_corpus(cls):
+        """
+        A corpus shaped like production traffic: a few hundred metric names,
+        a bounded number of tag sets sent over and over, some host/device
+        overrides and sampled timers.
+        """
+        rand = random.Random(42)
+        tag_sets = []
+        for i in xrange(cls.TAG_SETS):
+            tags = [
+                'env:%s' % rand.choice(['prod', 'staging']),
+                'service:svc-%s' % rand.randint(0, 20),
+                'version:1.%s.%s' % (rand.randint(0, 9), rand.randint(0, 30)),
+                'endpoint:/api/v1/resource-%s' % rand.randint(0, 50),
+                'status_code:%s' % rand.choice([200, 201, 404, 500]),
+            ]
+            if i % 10 == 0:
+                tags.append('host:web-%s' % rand.randint(0, 10))
+            if i % 25 == 0:
+                tags.append('device:sd%s' % rand.choice('abc'))
+            rand.shuffle(tags)
+            tag_sets.append(','.join(tags))
+
+        types = ['c', 'c', 'g', 'ms', 'ms', 'h', 's']
+        corpus = []
+        for _ in xrange(cls.PACKET_COUNT):
+            mtype = rand.choice(types)
+            name = 'app.%s.metric.%s' % (mtype, rand.randint(0, cls.METRIC_NAMES))
+            if mtype == 's':
+                value = 'user-%s' % rand.randint(0, 1000)
+            elif mtype == 'ms':
+                value = '%.3f' % rand.uniform(0, 500)
+            else:
+                value = str(rand.randint(0, 100))
+            packet = '%s:%s|%s' % (name, value, mtype)
+            if mtype == 'ms' and rand.random() < 0.3:
+                packet += '|@0.5'
+            if rand.random() < 0.9:
+                packet += '|#' + rand.choice(tag_sets)
+            corpus.append(packet)
+        return corpus
+
+    @staticmethod
+    def legacy_submit(aggregator, packet):
+        for name, value, mtype, tags, sample_rate in aggregator.parse_metric_packet(packet):
+            hostname, device_name, tags = aggregator._extract_magic_tags(tags)
+            aggregator.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                                     device_name=device_name, sample_rate=sample_rate)
+
+    @staticmethod
+    def context_submit(aggregator, packet):
+        for context, value, mtype, sample_rate in aggregator.parse_metric_context(packet):
+            aggregator.submit_context_metric(context, value, mtype, sample_rate=sample_rate)
+
+    def packets_per_second(self, corpus, submit):
+        best = None
+        for _ in xrange(self.ROUNDS):
+            aggregator = MetricsBucketAggregator('my.host', interval=10)
+            start = time.time()
+            for packet in corpus:
+                submit(aggregator, packet)
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+        return len(corpus) / best
+
+    def test_parser_throughput(self):
+        corpus = self.build_corpus()
+
+        legacy_pps = self.packets_per_second(corpus, self.legacy_submit)
+        context_pps = self.packets_per_second(corpus, self.context_submit)
+
+        print "generic parser: %d packets/s" % legacy_pps
+        print "context parser: %d packets/s (x%.2f)" % (context_pps, context_pps / legacy_pps)
+        assert context_pps > legacy_pps
+
+    def test_parser_results(self):
+        # Both paths must aggregate the corpus identically
+        corpus = self.build_corpus()[:20000]
+        legacy = MetricsBucketAggregator('my.host', interval=10)
+        context = MetricsBucketAggregator('my.host', interval=10)
+        for packet in corpus:
+            self.legacy_submit(legacy, packet)
+            self.context_submit(context, packet)
+
+        def values(aggregator):
+            return dict(
+                (metric.context.key, getattr(metric, 'samples', None) or getattr(metric, 'values', None) or metric.value)
+                for metric_by_context in aggregator.metric_by_bucket.values()
+                for metric in metric_by_context.itervalues()
+            )
+        assert values(legacy) == values(context)
+
+
+if __name__ == '__main__':
+    t = TestPacketParserPerf()
+    t.test_parser_throughput()
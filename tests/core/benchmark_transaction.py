@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the forwarder transaction scheduler: flush latency,
+completion and eviction with a large backlog of queued transactions.
+"""
+# stdlib
+from datetime import datetime, timedelta
+import time
+
+# project
+from transaction import Transaction, TransactionManager
+
+
+class NoopTransaction(Transaction):
+    """ A transaction whose flush is still running when `flush` returns """
+
+    def __init__(self, next_flush):
+        Transaction.__init__(self)
+        self._endpoint = 'https://example.com'
+        self._size = 1
+        self._next_flush = next_flush
+
+    def flush(self):
+        pass
+
+
+class TestTransactionSchedulerPerf(object):
+
+    QUEUED = 100000
+    DUE = 100
+
+    def build_manager(self, max_queue_size=None):
+        manager = TransactionManager(timedelta(seconds=0), max_queue_size or self.QUEUED * 2,
+                                     timedelta(seconds=0), max_parallelism=self.DUE)
+        later = datetime.utcnow() + timedelta(hours=1)
+        for _ in xrange(self.QUEUED - self.DUE):
+            manager.append(NoopTransaction(later))
+        for _ in xrange(self.DUE):
+            manager.append(NoopTransaction(datetime.utcnow()))
+        return manager
+
+    @staticmethod
+    def legacy_due(transactions, now):
+        # What flush used to do: scan all the transactions, sort the due ones
+        to_flush = [tr for tr in transactions if tr.time_to_flush(now)]
+        return sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
+
+    def test_flush_latency(self):
+        manager = self.build_manager()
+        transactions = list(manager._transactions)
+
+        start = time.time()
+        self.legacy_due(transactions, datetime.utcnow())
+        legacy_latency = time.time() - start
+
+        start = time.time()
+        manager.flush()
+        flush_latency = time.time() - start
+        assert manager._running_flushes == self.DUE
+
+        start = time.time()
+        for tr in transactions[-self.DUE:]:
+            manager.tr_success(tr)
+        manager.flush_next()
+        success_latency = time.time() - start
+        assert manager._total_count == self.QUEUED - self.DUE
+        assert manager._trs_to_flush is None
+
+        print "legacy scan of %d transactions: %.2fms" % (self.QUEUED, legacy_latency * 1000)
+        print "flush of %d due transactions: %.2fms" % (self.DUE, flush_latency * 1000)
+        print "completion of %d transactions: %.2fms" % (self.DUE, success_latency * 1000)
+        assert flush_latency < legacy_latency
+
+    def test_eviction(self):
+        manager = self.build_manager(max_queue_size=self.QUEUED)
+        later = datetime.utcnow() + timedelta(hours=2)
+
+        start = time.time()
+        for _ in xrange(self.DUE * 10):
+            manager.append(NoopTransaction(later))
+        duration = time.time() - start
+
+        assert manager._total_count == self.QUEUED
+        print "%d appends to a full queue: %.2fms" % (self.DUE * 10, duration * 1000)
+
+
+if __name__ == '__main__':
+    t = TestTransactionSchedulerPerf()
+    t.test_flush_latency()
+    t.test_eviction()
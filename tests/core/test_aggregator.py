@@ -10,7 +10,8 @@ import nose.tools as nt
 
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator, TagCache
+from utils.sketch import TopK
 
 
 class TestMetricsAggregator(unittest.TestCase):
@@ -163,6 +164,122 @@ class TestMetricsAggregator(unittest.TestCase):
         nt.assert_equal(fourth['points'][0][1], 16)
         nt.assert_equal(fourth['device_name'], 'floppy')
 
+    def test_parse_metric_context(self):
+        stats = MetricsAggregator('myhost')
+        packets = [
+            'my.gauge:1|g',
+            'my.counter:1.5|c|@0.5|#tag2,tag1,tag2,host:test-a',
+            'my.set:abc|s|#device:floppy,tag:a:b',
+            # Multi-value and out-of-order metadata use the generic parser
+            'my.counter:1|c|#tag1:1|@0.5',
+            'my.counter:2|c:3|c|#tag1',
+        ]
+        for packet in packets:
+            legacy = []
+            for name, value, mtype, tags, sample_rate in stats.parse_metric_packet(packet):
+                hostname, device_name, tags = stats._extract_magic_tags(tags)
+                context = (name, tuple(sorted(set(tags or ()))), hostname or 'myhost', device_name)
+                legacy.append((context, value, mtype, sample_rate))
+            nt.assert_equal(stats.parse_metric_context(packet), legacy)
+
+        nt.assert_equal(stats.parse_metric_context('my.counter:1.5|c|@0.5|#tag2,tag1,tag2,host:test-a'),
+                        [(('my.counter', ('tag1', 'tag2'), 'test-a', None), 1.5, 'c', 0.5)])
+
+        # Errors are handled like the generic parser does
+        nt.assert_equal(stats.parse_metric_context('my.counter:1|c|@2'),
+                        [(('my.counter', (), 'myhost', None), 1, 'c', 1)])
+        nt.assert_raises(Exception, stats.parse_metric_context, 'my.counter:abc|c')
+
+    def test_tag_cache(self):
+        cache = TagCache(size=2)
+        nt.assert_equal(cache.get('b,a,host:h'), (('a', 'b'), 'h', None))
+        nt.assert_equal(cache.get('device:d'), ((), None, 'd'))
+        # Filling the hot generation demotes it, entries stay reachable once
+        cache.get('c')
+        nt.assert_equal(cache.cold, {'b,a,host:h': (('a', 'b'), 'h', None), 'device:d': ((), None, 'd')})
+        cache.get('b,a,host:h')
+        nt.assert_equal(set(cache.hot), set(['c', 'b,a,host:h']))
+        # Entries not used for two generations are dropped
+        cache.get('e')
+        nt.assert_equal(set(cache.cold), set(['c', 'b,a,host:h']))
+        nt.assert_equal(set(cache.hot), set(['e']))
+
+    def test_context_stats(self):
+        stats = MetricsAggregator('myhost')
+        nt.assert_equal(stats.context_stats(), (0, 0))
+
+        for i in xrange(100):
+            stats.submit_packets('my.counter:1|c|#a:{0}'.format(i))
+            stats.submit_packets('my.histogram:{0}|h|#a:{0}'.format(i))
+            stats.submit_packets('my.histogram:{0}|h|#a:{0}'.format(i))
+        stats.increment('my.counter', tags=['a:0'])
+
+        context_count, context_memory = stats.context_stats()
+        nt.assert_equal(context_count, 200)
+        nt.assert_equal(len(stats.metrics), 200)
+        nt.assert_true(0 < context_memory < 1000, context_memory)
+
+        # The reported tags are the ones of the first submission
+        metric = stats.metrics[('my.counter', ('a:0',), 'myhost', None)]
+        nt.assert_equal(metric.value, 2)
+        nt.assert_equal(metric.tags, ('a:0',))
+        nt.assert_false(hasattr(metric, '__dict__'))
+
+    def test_context_limits(self):
+        stats = MetricsAggregator('myhost', context_limit=6, context_limit_per_metric=3)
+        for i in xrange(5):
+            stats.submit_packets('my.counter:1|c|#id:{0},env:prod'.format(i))
+        stats.submit_packets('my.counter:1|c|#id:0,env:prod')
+        for i in xrange(5):
+            stats.submit_packets('other.counter:1|c|@0.5|#id:{0}'.format(i))
+
+        # 3 contexts for my.counter, 2 for other.counter, plus their overflow series
+        nt.assert_equal(len(stats.contexts), 7)
+        nt.assert_equal(stats.contexts.overflow_count, 5)
+
+        metrics = dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics[('my.counter', ('env:prod', 'id:0'))], 2)
+        nt.assert_equal(metrics[('my.counter', ())], 2)
+        nt.assert_equal(metrics[('other.counter', ())], 6)
+        nt.assert_equal(sum(v for (name, _), v in metrics.iteritems() if name == 'other.counter'), 10)
+
+        # Top metric names and tag keys by contexts
+        nt.assert_equal(stats.contexts.top_metrics.top(2), [('my.counter', 5), ('other.counter', 5)])
+        nt.assert_equal(stats.contexts.top_tag_keys.top(1), [('id', 10)])
+
+        stats.send_context_stats('stackstate.stsstatsd')
+        metrics = dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics[('stackstate.stsstatsd.contexts.overflow', ())], 5)
+        nt.assert_equal(metrics[('stackstate.stsstatsd.contexts.by_metric', ('metric_name:my.counter',))], 5)
+        nt.assert_equal(metrics[('stackstate.stsstatsd.contexts.by_tag_key', ('tag_key:env',))], 5)
+
+        # Top contexts are counted between two reports
+        nt.assert_equal(stats.contexts.top_metrics.top(2), [])
+        stats.submit_packets('my.counter:1|c|#id:5')
+        stats.send_context_stats('stackstate.stsstatsd')
+        metrics = dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics[('stackstate.stsstatsd.contexts.by_metric', ('metric_name:my.counter',))], 1)
+
+        # Overflow series are reported from the aggregator's host, whatever the sample's
+        stats = MetricsAggregator('myhost', context_limit=1)
+        for i in xrange(5):
+            stats.submit_packets('my.counter:1|c|#host:host{0}'.format(i))
+        nt.assert_equal(len(stats.contexts), 2)
+        nt.assert_equal(stats.contexts.overflow_count, 4)
+        metrics = dict(((m['metric'], m['host']), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics, {('my.counter', 'host0'): 1, ('my.counter', 'myhost'): 4})
+
+    def test_top_k(self):
+        top = TopK(3)
+        for item in 'aaaaabbbcd':
+            top.offer(item)
+        nt.assert_equal(top.top(2), [('a', 5), ('b', 3)])
+        # `e` takes over the smallest counter, inheriting its count as error
+        top.offer('e')
+        nt.assert_equal(top.top(3), [('a', 5), ('b', 3), ('e', 3)])
+        nt.assert_equal(top.errors['e'], 2)
+        nt.assert_equal(len(top.counts), 3)
+
     def test_tags_gh442(self):
         import stsstatsd
         from aggregator import api_formatter
@@ -406,6 +523,22 @@ class TestMetricsAggregator(unittest.TestCase):
         assert counter['points'][0][1] == 2
         assert gauge['points'][0][1] == 1
 
+    def test_datagram_batch_submission(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets_batch([
+            'counter:1|c\ngauge:1|g',
+            'counter:1|c',
+            'string.value:abc|c',
+            'counter:1|c',
+        ])
+
+        # The bad datagram is dropped on its own
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(2, len(metrics))
+        counter, gauge = metrics
+        nt.assert_equal(counter['points'][0][1], 3)
+        nt.assert_equal(gauge['points'][0][1], 1)
+
     def test_monokey_batching_notags(self):
         # The min is not enabled by default
         stats = MetricsAggregator(
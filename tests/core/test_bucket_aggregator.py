@@ -22,7 +22,7 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
     @staticmethod
     def sort_metrics(metrics):
         def sort_by(m):
-            return (m['metric'], ','.join(m['tags'] or []))
+            return (m['metric'], m['host'], ','.join(m['tags'] or []))
         return sorted(metrics, key=sort_by)
 
     @staticmethod
@@ -735,6 +735,96 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         assert counter['points'][0][1] == 2
         assert gauge['points'][0][1] == 1
 
+    def test_merge_partials(self):
+        # Partial aggregates merged from several shards flush like one aggregator
+        packets = [
+            'counter:1|c|#a:b',
+            'counter:2|c|#a:b',
+            'counter:4|c|@0.5',
+            'gauge:1|g',
+            'gauge:5|g',
+            'histogram:1|h',
+            'histogram:2|h|#host:other',
+            'histogram:3|ms',
+            'set:a|s',
+            'set:b|s',
+            'set:a|s',
+            '_e{5,4}:title|text',
+            '_sc|check|0',
+        ]
+        single = MetricsBucketAggregator('myhost', interval=self.interval)
+        shards = [MetricsBucketAggregator('myhost', interval=self.interval) for _ in range(2)]
+        merged = MetricsBucketAggregator('myhost', interval=self.interval)
+
+        self.wait_for_bucket_boundary()
+        for i, packet in enumerate(packets):
+            single.submit_packets(packet)
+            shards[i % 2].submit_packets(packet)
+        for shard in shards:
+            merged.merge_partials(shard.export_partials())
+            nt.assert_equal(shard.metric_by_bucket, {})
+
+        self.sleep_for_interval_length()
+        nt.assert_equal(merged.count, single.count)
+        nt.assert_equal(self.sort_metrics(merged.flush()), self.sort_metrics(single.flush()))
+        nt.assert_equal(len(merged.flush_events()), 1)
+        nt.assert_equal(len(merged.flush_service_checks()), 1)
+
+    def test_merge_late_partials(self):
+        # A partial of a bucket that was already flushed goes to the next bucket
+        shard = MetricsBucketAggregator('myhost', interval=self.interval)
+        merged = MetricsBucketAggregator('myhost', interval=self.interval)
+
+        self.wait_for_bucket_boundary()
+        shard.submit_packets('counter:1|c')
+        shard.submit_packets('other_counter:1|c')
+        merged.merge_partials(shard.export_partials())
+        shard.submit_packets('counter:2|c')
+        late_partials = shard.export_partials()
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(merged.flush())
+        nt.assert_equal([m['metric'] for m in metrics], ['counter', 'other_counter'])
+        first_bucket = metrics[0]['points'][0][0]
+
+        merged.merge_partials(late_partials)
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(merged.flush())
+        # No second point for the flushed bucket
+        nt.assert_equal(len(metrics), 2)
+        for metric in metrics:
+            nt.assert_true(metric['points'][0][0] > first_bucket)
+        nt.assert_equal(metrics[0]['points'][0][1], 2)
+        nt.assert_equal(metrics[1]['points'][0][1], 0)
+
+    def test_context_interning(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, expiry_seconds=4)
+        self.wait_for_bucket_boundary()
+        stats.submit_packets('counter:1|c|#b,a')
+        stats.submit_packets('gauge:1|g')
+        self.sleep_for_interval_length()
+        stats.submit_packets('counter:1|c|#a,b,a')
+
+        # Both buckets share the same context
+        nt.assert_equal(len(stats.metric_by_bucket), 2)
+        nt.assert_equal(len(stats.contexts), 2)
+        counter_context = stats.contexts.intern(('counter', ('a', 'b'), 'myhost', None))
+        for metric_by_context in stats.metric_by_bucket.values():
+            nt.assert_true(metric_by_context[counter_context.id].context is counter_context)
+        nt.assert_false(hasattr(metric_by_context[counter_context.id], '__dict__'))
+
+        # Flushed contexts are released, but counters keep theirs until they expire
+        self.sleep_for_interval_length()
+        nt.assert_equal(len(stats.flush()), 3)
+        nt.assert_equal(stats.contexts.by_key.keys(), [counter_context.key])
+
+        self.sleep_for_interval_length(4)
+        stats.flush()
+        nt.assert_equal(len(stats.contexts), 0)
+
+        # Ids get reused
+        stats.submit_packets('other:1|c')
+        nt.assert_equal(len(stats.contexts.by_id), 2)
 
     def test_bad_packets_throw_errors(self):
         packets = [
@@ -0,0 +1,83 @@
+# stdlib
+import threading
+import unittest
+
+# project
+from checks.scheduler import CheckScheduler
+
+
+class FakeCheck(object):
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.release = threading.Event()
+        self.release.set()
+
+
+class TestCheckScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = CheckScheduler(self.run_check, 2, timeout=0.2)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    @staticmethod
+    def run_check(check):
+        check.release.wait(5)
+        check.runs += 1
+        return check.name, check.runs
+
+    def test_concurrent_runs(self):
+        checks = [FakeCheck('foo'), FakeCheck('bar'), FakeCheck('baz')]
+        self.scheduler.schedule(checks)
+
+        self.assertTrue(self.scheduler.wait())
+        self.assertEquals(sorted(self.scheduler.pop_results()), [('bar', 1), ('baz', 1), ('foo', 1)])
+        self.assertEquals(self.scheduler.pop_results(), [])
+
+        stats = self.scheduler.get_stats('foo')
+        self.assertEquals(stats['overruns'], 0)
+        self.assertEquals(stats['timeouts'], 0)
+        self.assertFalse(stats['running'])
+        self.assertTrue(stats['run_time'] >= 0)
+        self.assertTrue(stats['queue_wait'] >= 0)
+
+    def test_slow_check(self):
+        slow, fast = FakeCheck('slow'), FakeCheck('fast')
+        slow.release.clear()
+        self.scheduler.schedule([slow, fast])
+
+        # The fast check isn't delayed by the slow one
+        self.assertFalse(self.scheduler.wait())
+        self.assertEquals(self.scheduler.pop_results(), [('fast', 1)])
+        self.assertEquals(self.scheduler.get_stats('slow')['timeouts'], 1)
+        self.assertTrue(self.scheduler.get_stats('slow')['running'])
+
+        # Still running: skipped
+        self.scheduler.schedule([slow, fast])
+        self.assertFalse(self.scheduler.wait())
+        self.assertEquals(self.scheduler.pop_results(), [('fast', 2)])
+        self.assertEquals(self.scheduler.get_stats('slow')['overruns'], 1)
+        # Timeouts are counted once per run
+        self.assertEquals(self.scheduler.get_stats('slow')['timeouts'], 1)
+
+        # Its results are collected once it finishes
+        slow.release.set()
+        self.assertTrue(self.scheduler.wait(5))
+        self.assertEquals(self.scheduler.pop_results(), [('slow', 1)])
+        self.assertFalse(self.scheduler.get_stats('slow')['running'])
+
+    def test_failing_check(self):
+        def fail(check):
+            raise Exception("boom")
+        scheduler = CheckScheduler(fail, 1)
+        try:
+            scheduler.schedule([FakeCheck('foo')])
+            self.assertTrue(scheduler.wait())
+            self.assertEquals(scheduler.pop_results(), [])
+            # It is run again
+            scheduler.schedule([FakeCheck('foo')])
+            self.assertTrue(scheduler.wait())
+            self.assertEquals(scheduler.get_stats('foo')['overruns'], 0)
+        finally:
+            scheduler.stop()
@@ -1,3 +1,7 @@
+# stdlib
+import cPickle as pickle
+import json
+
 # 3p
 from nose.plugins.attrib import attr
 import nose.tools as nt
@@ -7,9 +11,13 @@ from checks import AgentCheck
 from checks.check_status import (
     CheckStatus,
     CollectorStatus,
+    DogstatsdStatus,
+    EmitterStatus,
     InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
+    status_from_json,
+    status_to_json,
 )
 
 
@@ -73,3 +81,49 @@ def test_persistence_fail():
 
     status = CollectorStatus.load_latest_status()
     assert not status
+
+
+def test_status_json():
+    chk1 = CheckStatus("dummy", [InstanceStatus(1, STATUS_OK, warnings=["careful"])], 1, 2,
+                       library_versions={'foo': '1.0'})
+    chk2 = CheckStatus("broken", [], init_failed_error=Exception("failure"))
+    c1 = CollectorStatus([chk1, chk2], [EmitterStatus("http_emitter")])
+
+    c2 = status_from_json(status_to_json(c1))
+    assert isinstance(c2, CollectorStatus)
+    nt.assert_equal(c2.created_at, c1.created_at)
+    nt.assert_equal([cs.name for cs in c2.check_statuses], ["dummy", "broken"])
+    nt.assert_equal(c2.check_statuses[0].instance_statuses[0].warnings, ["careful"])
+    nt.assert_equal(c2.status, STATUS_ERROR)
+    nt.assert_equal(repr(c2.check_statuses[1].init_failed_error), "Exception('failure',)")
+
+    CollectorStatus.verbose = False
+    nt.assert_equal(c2.to_dict()['checks'], c1.to_dict()['checks'])
+    nt.assert_equal(json.loads(json.dumps(c2.to_dict()))['checks']['broken'], c1.to_dict()['checks']['broken'])
+
+    d1 = DogstatsdStatus(flush_count=3, top_metric_contexts=[('foo', 12)])
+    d2 = status_from_json(status_to_json(d1))
+    nt.assert_equal(d2.body_lines(), d1.body_lines())
+
+
+def test_live_status():
+    prefix = "test_live_"
+    CollectorStatus.remove_latest_status(prefix)
+    CollectorStatus.serve_status(prefix)
+    try:
+        CollectorStatus([CheckStatus("first", [])]).persist(prefix)
+        CollectorStatus([CheckStatus("second", [])]).persist(prefix)
+
+        # The latest status is served from memory...
+        status = CollectorStatus.load_latest_status(prefix)
+        nt.assert_equal([cs.name for cs in status.check_statuses], ["second"])
+
+        # ...while the one on disk is only a periodic snapshot
+        with open(CollectorStatus._get_pickle_path(prefix)) as f:
+            status = pickle.load(f)
+        nt.assert_equal([cs.name for cs in status.check_statuses], ["first"])
+    finally:
+        CollectorStatus.remove_latest_status(prefix)
+
+    assert CollectorStatus.load_live_status(prefix) is None
+    assert CollectorStatus.load_latest_status(prefix) is None
@@ -388,6 +388,35 @@ class TestCore(unittest.TestCase):
         assertTopology(emitted_topologies[2], check2, 4)
         assertTopology(emitted_topologies[3], check2, 3)
 
+    def test_collector_check_runners(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_runners': 2,
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        init_config = {}
+        check1 = DummyTopologyCheck(1, 'dummy_topology_check', init_config, agentConfig, instances=[{"instance_id": 1, "pass": True}])
+        check2 = DummyTopologyCheck(2, 'other_topology_check', init_config, agentConfig, instances=[{"instance_id": 2, "pass": True}])
+
+        c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        try:
+            payload, _ = c.run({
+                'initialized_checks': [check1, check2],
+                'init_failed_checks': {}
+            })
+        finally:
+            c.stop()
+
+        self.assertEquals(len(payload['topologies']), 2)
+        check_status = c._check_statuses['other_topology_check']
+        self.assertEquals(check_status.scheduling_stats['overruns'], 0)
+        self.assertFalse(check_status.scheduling_stats['running'])
+        self.assertEquals(len([sc for sc in payload['service_checks'] if sc['check'] == 'stackstate.agent.check_status']), 2)
+
     def test_apptags(self):
         '''
         Tests that the app tags are sent if specified so
@@ -11,8 +11,9 @@ from shutil import copyfile, rmtree
 import ntpath
 
 # project
+import config
 from config import get_config, load_check_directory, _conf_path_to_check_name
-from util import windows_friendly_colon_split
+from util import check_yaml, windows_friendly_colon_split
 from utils.hostname import is_valid_hostname
 from utils.pidfile import PidFile
 from utils.platform import Platform
@@ -316,6 +317,63 @@ class TestConfigLoadCheckDirectory(unittest.TestCase):
         self.assertEquals(1, len(checks['initialized_checks']))
         self.assertEquals(2, checks['initialized_checks'][0].instance_count())  # check that we picked the right conf
 
+    def testConfigReload(self, *args):
+        copyfile('%s/valid_conf.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        copyfile('%s/valid_check_1.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_ETC_CHECKS_DIR)
+        agentConfig = {"additional_checksd": TEMP_ETC_CHECKS_DIR}
+        check = load_check_directory(agentConfig, "foo")['initialized_checks'][0]
+
+        # Unchanged check: kept
+        checks = load_check_directory(agentConfig, "foo", previous_checks=[check])
+        self.assertTrue(checks['initialized_checks'][0] is check)
+
+        # Changed config: rebuilt
+        copyfile('%s/valid_conf_2.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        checks = load_check_directory(agentConfig, "foo", previous_checks=[check])
+        self.assertFalse(checks['initialized_checks'][0] is check)
+        self.assertEquals(2, checks['initialized_checks'][0].instance_count())
+        check = checks['initialized_checks'][0]
+
+        # Changed code: rebuilt
+        copyfile('%s/valid_check_2.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_ETC_CHECKS_DIR)
+        checks = load_check_directory(agentConfig, "foo", previous_checks=[check])
+        self.assertFalse(checks['initialized_checks'][0] is check)
+        self.assertEquals('valid_check_2', checks['initialized_checks'][0].check(None))
+
+    def testConfigCache(self, *args):
+        copyfile('%s/valid_conf.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        copyfile('%s/valid_check_1.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_ETC_CHECKS_DIR)
+        config._check_configs_cache.clear()
+        agentConfig = {"additional_checksd": TEMP_ETC_CHECKS_DIR}
+
+        with mock.patch('config.check_yaml', side_effect=check_yaml) as parse:
+            load_check_directory(agentConfig, "foo")
+            checks = load_check_directory(agentConfig, "foo")
+            self.assertEquals(1, parse.call_count)
+
+            # The checks can't modify the cached config
+            checks['initialized_checks'][0].instances.append({})
+            checks = load_check_directory(agentConfig, "foo")
+            self.assertEquals(1, checks['initialized_checks'][0].instance_count())
+
+            # Rewritten with the same content: not parsed again
+            copyfile('%s/valid_conf.yaml' % FIXTURE_PATH,
+                '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+            load_check_directory(agentConfig, "foo")
+            self.assertEquals(1, parse.call_count)
+
+            copyfile('%s/valid_conf_2.yaml' % FIXTURE_PATH,
+                '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+            checks = load_check_directory(agentConfig, "foo")
+            self.assertEquals(2, parse.call_count)
+            self.assertEquals(2, checks['initialized_checks'][0].instance_count())
+
     def tearDown(self):
         for _dir in self.TEMP_DIRS:
             rmtree(_dir)
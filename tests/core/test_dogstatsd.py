@@ -2,15 +2,20 @@
 from unittest import TestCase
 import socket
 import threading
+import time
 import Queue
 from collections import defaultdict
+import zlib
 
 # 3p
 import mock
+import simplejson as json
 
 # project
+from checks.check_status import DogstatsdStatus
 from stsstatsd import mapto_v6, get_socket_address
-from stsstatsd import Server, init
+from aggregator import api_formatter, MetricsBucketAggregator
+from stsstatsd import Reporter, serialize_metrics_chunks, Server, ShardedServer, init
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
 
 
@@ -45,6 +50,93 @@ class TestFunctions(TestCase):
         self.assertEqual(args[1], '0.0.0.0')
 
 
+class TestSerialization(TestCase):
+    @staticmethod
+    def load(payload, headers):
+        if headers.get('Content-Encoding') == 'deflate':
+            payload = zlib.decompress(payload)
+        return json.loads(payload)['series']
+
+    def test_small_payload(self):
+        payloads = list(serialize_metrics_chunks([api_formatter('foo', 1, 1, ['a:b'], 'host')], 'host', 100))
+        self.assertEqual(len(payloads), 1)
+        payload, headers = payloads[0]
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual([s['metric'] for s in self.load(payload, headers)],
+                         ['foo', 'stackstate.stsstatsd.serialization_status'])
+
+    def test_chunked_payloads(self):
+        metrics = [api_formatter('metric.%s' % i, i, 1, ['id:%s' % (i * 7919 % 10007)], 'host')
+                   for i in xrange(20000)]
+        payloads = list(serialize_metrics_chunks(metrics, 'host', 64 * 1024))
+        self.assertTrue(len(payloads) > 1)
+
+        series = []
+        for payload, headers in payloads:
+            self.assertEqual(headers['Content-Encoding'], 'deflate')
+            self.assertTrue(len(payload) <= 64 * 1024, len(payload))
+            series += self.load(payload, headers)
+        self.assertEqual([s['metric'] for s in series[:-1]], [m['metric'] for m in metrics])
+        self.assertEqual(series[-1]['tags'], ['status:success'])
+
+        # Without a limit, everything goes in one payload
+        payloads = list(serialize_metrics_chunks(metrics, 'host'))
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(len(self.load(*payloads[0])), 20001)
+
+    def test_bad_characters(self):
+        metrics = [api_formatter('foo\xff', 1, 1, None, 'host'), api_formatter('bar', 1, 1, None, 'host')]
+        series = self.load(*list(serialize_metrics_chunks(metrics, 'host'))[0])
+        self.assertEqual([s['metric'] for s in series],
+                         [u'foo\ufffd', 'bar', 'stackstate.stsstatsd.serialization_status'])
+        self.assertEqual(series[-1]['tags'], ['status:failure'])
+
+    @mock.patch('stsstatsd.PAYLOAD_RETRY_DELAY', 0)
+    def test_reporter_submit(self):
+        reporter = Reporter(10, None, 'http://localhost', 'key', max_payload_size=16 * 1024,
+                            upload_workers=3)
+        posted = []
+        lock = threading.Lock()
+
+        def post(url, data, timeout, headers):
+            with lock:
+                posted.append(data)
+                # The first attempt of every payload fails
+                status = 503 if posted.count(data) == 1 else 202
+            return mock.Mock(status_code=status, raise_for_status=mock.Mock())
+        reporter.session.post = post
+
+        metrics = [api_formatter('metric.%s' % i, i, 1, ['id:%s' % (i * 7919 % 10007)], 'host')
+                   for i in xrange(5000)]
+        try:
+            reporter.submit(metrics)
+        finally:
+            reporter.stop()
+
+        payloads = set(posted)
+        self.assertTrue(len(payloads) > 1)
+        self.assertEqual(len(posted), 2 * len(payloads))
+        series = sum((self.load(payload, {'Content-Encoding': 'deflate'}) for payload in payloads), [])
+        self.assertEqual(len(series), 5001)
+
+    def test_reporter_status(self):
+        aggregator = MetricsBucketAggregator('myhost', interval=10)
+        reporter = Reporter(10, aggregator, 'http://localhost', 'key')
+        reporter.submit = mock.Mock()
+        for i in xrange(3):
+            aggregator.submit_packets('my.counter:1|c|#id:{0}'.format(i))
+
+        with mock.patch.object(DogstatsdStatus, 'persist', autospec=True) as persist:
+            reporter.report()
+
+        # The status reports the same top contexts as the metrics
+        status = persist.call_args[0][0]
+        self.assertEqual(status.top_metric_contexts[0], ('my.counter', 3))
+        self.assertEqual(status.top_tag_key_contexts, [('id', 3)])
+        self.assertIn(('stackstate.stsstatsd.contexts.by_metric', ('metric_name:my.counter',), 'myhost', None),
+                      aggregator.contexts.by_key)
+
+
 class TestServer(TestCase):
     def test_init(self):
         s = Server(None, 'localhost', '1234')
@@ -67,6 +159,63 @@ class TestServer(TestCase):
         s2.start()
         self.assertFalse(s2.running)
 
+    @mock.patch('stsstatsd.UDP_SOCKET_TIMEOUT', 0.1)
+    def test_start_batched(self):
+        aggregator = mock.MagicMock()
+        s = Server(aggregator, '127.0.0.1', '12346', recv_batch_size=8, so_rcvbuf=65536)
+        thread = threading.Thread(target=s.start)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.2)
+
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(3):
+            client_sock.sendto('metric:%s|c' % i, ('127.0.0.1', 12346))
+        time.sleep(0.2)
+        s.stop()
+        thread.join(1)
+
+        self.assertFalse(aggregator.submit_packets.called)
+        received = []
+        for args, _ in aggregator.submit_packets_batch.call_args_list:
+            self.assertTrue(len(args[0]) <= 8)
+            received.extend(args[0])
+        self.assertEqual(received, ['metric:0|c', 'metric:1|c', 'metric:2|c'])
+
+    @mock.patch('stsstatsd.WORKER_EXPORT_INTERVAL', 0.1)
+    @mock.patch('stsstatsd.UDP_SOCKET_TIMEOUT', 0.1)
+    def test_sharded_server(self):
+        def aggregator_factory():
+            return MetricsBucketAggregator('myhost', interval=10)
+
+        aggregator = aggregator_factory()
+        s = ShardedServer(aggregator, aggregator_factory, 2, '127.0.0.1', '12347')
+        thread = threading.Thread(target=s.start)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.5)
+        self.assertEqual(len(s.workers), 2)
+
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(20):
+            client_sock.sendto('metric:1|c\nset:%s|s' % i, ('127.0.0.1', 12347))
+        time.sleep(1)
+        s.stop()
+        thread.join(10)
+
+        self.assertFalse(any(w.is_alive() for w in s.workers))
+        self.assertEqual(aggregator.count, 40)
+        # Samples may straddle a bucket boundary
+        counter_value, set_values = 0, set()
+        for metric_by_context in aggregator.metric_by_bucket.values():
+            for metric in metric_by_context.values():
+                if metric.name == 'metric':
+                    counter_value += metric.value
+                else:
+                    set_values.update(metric.values)
+        self.assertEqual(counter_value, 20)
+        self.assertEqual(len(set_values), 20)
+
     def _get_socket(self, addr, port):
         sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
         sock.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
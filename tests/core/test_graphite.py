@@ -0,0 +1,107 @@
+# stdlib
+import cPickle as pickle
+import struct
+import unittest
+
+# project
+from graphite import GraphiteAggregator, GraphiteConnection, GraphiteServer, parse_plaintext
+
+
+class MockStream(object):
+    def __init__(self):
+        self.read_callback = None
+        self.streaming_callback = None
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_bytes(self, num_bytes, callback):
+        self.read_callback = callback
+
+    def read_until_close(self, callback, streaming_callback=None):
+        self.read_callback = callback
+        self.streaming_callback = streaming_callback
+
+
+class MockApplication(object):
+    def __init__(self):
+        self.metrics = []
+
+    def appendMetric(self, prefix, name, host, device, ts, value):
+        self.metrics.append((prefix, name, host, device, ts, value))
+
+
+class TestGraphite(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = GraphiteAggregator()
+        self.stream = MockStream()
+        self.connection = GraphiteConnection(self.stream, ('127.0.0.1', 4242), self.aggregator, 'myhost')
+
+    def test_parse_plaintext(self):
+        points, errors = parse_plaintext("foo.bar 1.5 1400000000\n\nfoo.baz 3 1400000010\nnope\nfoo x 12\n")
+        self.assertEquals(points, [('foo.bar', (1400000000, 1.5)), ('foo.baz', (1400000010, 3))])
+        self.assertEquals(errors, 2)
+
+    def test_aggregation(self):
+        for value, ts in ((1, 10), (4, 20), (3, 15)):
+            self.aggregator.add('foo', 'myhost', 'N/A', ts, value)
+        self.aggregator.add('bar', 'myhost', 'N/A', 12, 2)
+
+        points, counters = self.aggregator.flush()
+        self.assertEquals(sorted(points), [('bar', 'myhost', 'N/A', 12, 2), ('foo', 'myhost', 'N/A', 20, 8 / 3.0)])
+        self.assertEquals(counters, (4, 0))
+        self.assertEquals(self.aggregator.flush(), ([], (0, 0)))
+
+        expected = {'sum': 8, 'min': 1, 'max': 4, 'last': 4}
+        for method, value in expected.iteritems():
+            aggregator = GraphiteAggregator(method)
+            for point_value, ts in ((1, 10), (4, 20), (3, 15)):
+                aggregator.add('foo', 'myhost', 'N/A', ts, point_value)
+            self.assertEquals(aggregator.flush()[0], [('foo', 'myhost', 'N/A', 20, value)])
+
+    def test_plaintext_protocol(self):
+        data = "foo.bar 1 1400000000\nfoo.bar 3 1400000005\nfoo.baz 2 14"
+        self.stream.read_callback(data[:4])
+        # Lines are parsed as soon as they are complete
+        self.stream.streaming_callback(data[4:30])
+        self.assertEquals(self.aggregator.points_received, 1)
+        self.stream.streaming_callback(data[30:])
+        self.assertEquals(self.aggregator.points_received, 2)
+        self.stream.streaming_callback("00000000\nbroken line\n")
+        # The last line doesn't need a newline
+        self.stream.read_callback("foo.baz 4 1400000010")
+
+        points, counters = self.aggregator.flush()
+        self.assertEquals(sorted(points), [
+            ('foo.bar', 'myhost', 'N/A', 1400000005, 2),
+            ('foo.baz', 'myhost', 'N/A', 1400000010, 3),
+        ])
+        self.assertEquals(counters, (4, 1))
+
+    def test_pickle_protocol(self):
+        payload = pickle.dumps([('foo.bar', (1400000000, 1)), ('foo.bar', (1400000005, '3')), ('foo.baz', ('x', 1))])
+        self.stream.read_callback(struct.pack("!L", len(payload)))
+        self.stream.read_callback(payload)
+
+        points, counters = self.aggregator.flush()
+        self.assertEquals(points, [('foo.bar', 'myhost', 'N/A', 1400000005, 2)])
+        self.assertEquals(counters, (2, 1))
+
+    def test_server_flush(self):
+        app = MockApplication()
+        server = GraphiteServer(app, 'myhost')
+        server.aggregator.add('foo', 'myhost', 'N/A', 10, 1)
+        server.aggregator.add('foo', 'myhost', 'N/A', 20, 2)
+        server.aggregator.parse_errors += 1
+        server.flush()
+
+        self.assertEquals(app.metrics[0], ('graphite', 'foo', 'myhost', 'N/A', 20, 1.5))
+        stats = dict((name, value) for _, name, _, _, _, value in app.metrics[1:])
+        self.assertEquals(stats['stackstate.agent.graphite.points_received'], 2)
+        self.assertEquals(stats['stackstate.agent.graphite.points_posted'], 1)
+        self.assertEquals(stats['stackstate.agent.graphite.parse_errors'], 1)
+
+        # Nothing is posted without any activity
+        app.metrics = []
+        server.flush()
+        self.assertEquals(app.metrics, [])
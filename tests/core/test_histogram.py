@@ -1,9 +1,16 @@
 # stdlib
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, Histogram, MetricsAggregator, SketchHistogram
+from config import (
+    get_histogram_aggregates,
+    get_histogram_backend,
+    get_histogram_percentiles,
+    get_histogram_relative_accuracy,
+)
+from utils.sketch import DDSketch
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -152,3 +159,99 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['sum'], 190, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def _flush_values(self, stats):
+        value_by_type = {}
+        for k in stats.flush():
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+        return value_by_type
+
+    def test_sketch_backend(self):
+        aggregates = DEFAULT_HISTOGRAM_AGGREGATES + ['min', 'sum']
+        percentiles = [0.5, 0.75, 0.95, 0.99]
+        exact = MetricsAggregator('myhost', histogram_aggregates=aggregates,
+                                  histogram_percentiles=percentiles)
+        sketch = MetricsAggregator('myhost', histogram_aggregates=aggregates,
+                                   histogram_percentiles=percentiles,
+                                   histogram_backend='sketch')
+        self.assertEquals(sketch.metric_type_to_class['ms'], SketchHistogram)
+
+        rand = random.Random(1)
+        for _ in xrange(5000):
+            value = round(rand.lognormvariate(3, 2) - 5, 3)
+            exact.submit_packets('myhistogram:{0}|ms'.format(value))
+            sketch.submit_packets('myhistogram:{0}|ms'.format(value))
+        exact.submit_packets('myhistogram:0|ms|@0.5')
+        sketch.submit_packets('myhistogram:0|ms|@0.5')
+
+        exact_values = self._flush_values(exact)
+        sketch_values = self._flush_values(sketch)
+        self.assertEquals(sorted(exact_values.keys()), sorted(sketch_values.keys()))
+
+        for name in ['min', 'max', 'count']:
+            self.assertEquals(sketch_values[name], exact_values[name], name)
+        for name in ['sum', 'avg']:
+            self.assertAlmostEqual(sketch_values[name], exact_values[name], 6)
+        for name in ['median', '50percentile', '75percentile', '95percentile', '99percentile']:
+            self.assertTrue(abs(sketch_values[name] - exact_values[name]) <= 0.01 * abs(exact_values[name]),
+                            (name, sketch_values[name], exact_values[name]))
+
+    def test_sketch_small_counts(self):
+        # Ranks are picked like in the sorted samples
+        for count in [1, 2, 3, 20]:
+            exact = MetricsAggregator('myhost', histogram_percentiles=[0.5, 0.95])
+            sketch = MetricsAggregator('myhost', histogram_percentiles=[0.5, 0.95],
+                                       histogram_backend='sketch', histogram_relative_accuracy=0.001)
+            for i in xrange(count):
+                exact.submit_packets('myhistogram:{0}|h'.format(i))
+                sketch.submit_packets('myhistogram:{0}|h'.format(i))
+
+            exact_values = self._flush_values(exact)
+            for name, value in self._flush_values(sketch).iteritems():
+                self.assertAlmostEqual(value, exact_values[name], delta=0.001 * exact_values[name] + 1e-9)
+
+    def test_sketch_merge(self):
+        rand = random.Random(2)
+        values = [rand.uniform(-100, 1000) for _ in xrange(2000)] + [0]
+        whole = DDSketch()
+        parts = [DDSketch() for _ in xrange(3)]
+        for i, value in enumerate(values):
+            whole.add(value)
+            parts[i % 3].add(value)
+
+        merged = DDSketch()
+        for part in parts:
+            merged.merge(part)
+
+        self.assertEquals(merged.count, whole.count)
+        self.assertEquals((merged.min, merged.max), (whole.min, whole.max))
+        self.assertAlmostEqual(merged.sum, whole.sum, 6)
+        for q in [0.01, 0.25, 0.5, 0.9, 0.99]:
+            self.assertEquals(merged.get_quantile_value(q), whole.get_quantile_value(q))
+
+        self.assertRaises(ValueError, merged.merge, DDSketch(0.05))
+
+    def test_sketch_bounded_bins(self):
+        # 64 bins cover about 5 orders of magnitude at 10% accuracy
+        sketch = DDSketch(0.1, max_bins=64)
+        for exponent in xrange(-20, 20):
+            sketch.add(10.0 ** exponent)
+        self.assertTrue(sketch.bin_count() <= 64)
+        self.assertEquals(sketch.count, 40)
+        # The high quantiles keep their accuracy, the lowest bins are collapsed
+        self.assertAlmostEqual(sketch.get_quantile_value(1), 1e19, delta=1e19 * 0.1)
+        self.assertAlmostEqual(sketch.get_quantile_value(0.9), 1e15, delta=1e15 * 0.1)
+        self.assertTrue(sketch.get_quantile_value(0.5) > 1e13)
+
+    def test_sketch_config(self):
+        self.assertEquals(get_histogram_backend('Sketch'), 'sketch')
+        self.assertEquals(get_histogram_backend('samples'), 'samples')
+        self.assertEquals(get_histogram_backend('tdigest'), None)
+        self.assertEquals(get_histogram_relative_accuracy('0.005'), 0.005)
+        self.assertEquals(get_histogram_relative_accuracy('2'), None)
+
+        stats = MetricsAggregator('myhost', histogram_backend='sketch', histogram_relative_accuracy=0.05)
+        stats.submit_packets('myhistogram:1|h')
+        metric = stats.metrics.values()[0]
+        self.assertEquals(metric.relative_accuracy, 0.05)
+        self.assertEquals(metric.sketch.relative_accuracy, 0.05)
@@ -5,7 +5,7 @@
 import unittest
 import os
 
-from utils.kubernetes import KubeStateProcessor, NAMESPACE
+from utils.kubernetes import KubeListCache, KubeStateProcessor, NAMESPACE
 from utils.prometheus import parse_metric_family
 
 import mock
@@ -285,3 +285,39 @@ class TestKubeStateProcessor(unittest.TestCase):
         for i, call in enumerate(calls):
             args = call[1]
             self.assertEqual(args, expected[i])
+
+
+class TestKubeListCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = KubeListCache()
+        self.cache.clear()
+        self.fetched = []
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return {'metadata': {'resourceVersion': '42'}, 'items': [{'name': url}]}
+
+    def test_ttl(self):
+        response, cached = self.cache.get('pods/', self.fetch, 10)
+        self.assertFalse(cached)
+        self.assertEqual(self.cache.get('pods/', self.fetch, 10), (response, True))
+        self.assertEqual(self.cache.get('nodes/', self.fetch, 10)[1], False)
+        self.assertEqual(self.fetched, ['pods/', 'nodes/'])
+
+        # Without a ttl the cache is bypassed
+        self.cache.get('pods/', self.fetch, 0)
+        self.assertEqual(self.fetched, ['pods/', 'nodes/', 'pods/'])
+        # The cache is process-wide
+        self.assertEqual(KubeListCache().get('pods/', self.fetch, 10), (response, True))
+
+    def test_resource_version(self):
+        response, _ = self.cache.get('pods/', self.fetch, 10)
+
+        # Nothing changed in the cluster, the same objects are returned
+        refreshed, cached = self.cache.get('pods/', self.fetch, 1e-9)
+        self.assertFalse(cached)
+        self.assertTrue(refreshed is response)
+
+        changed, _ = self.cache.get('pods/', lambda url: {'metadata': {'resourceVersion': '43'}, 'items': []}, 1e-9)
+        self.assertEqual(changed['items'], [])
+        self.assertEqual(self.cache.get('pods/', self.fetch, 10), (changed, True))
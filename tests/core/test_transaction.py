@@ -1,25 +1,30 @@
 # stdlib
 from datetime import datetime, timedelta
+import shutil
+import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 # 3rd party
 from nose.plugins.attrib import attr
 #import requests
-#import simplejson as json
+import simplejson as json
 from tornado.web import Application
 
 # project
 #from config import get_version
 from stsagent import (
-    #APIMetricTransaction,
-    #APIServiceCheckTransaction,
+    APIMetricTransaction,
+    APIServiceCheckTransaction,
     MAX_QUEUE_SIZE,
     MetricTransaction,
+    PayloadCoalescer,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import Transaction, TransactionManager, TransactionQueue
+from utils.spill_queue import SpillQueue
 
 
 class memTransaction(Transaction):
@@ -42,6 +47,9 @@ class memTransaction(Transaction):
 
         self._trManager.flush_next()
 
+    def get_spill_record(self):
+        return {'size': self._size}
+
 
 class SleepingTransaction(Transaction):
     def __init__(self, manager, delay=0.5):
@@ -116,6 +124,71 @@ class TestTransaction(unittest.TestCase):
         trManager.flush()
         self.assertEqual(len(trManager._transactions), 0)
 
+    def testSpillQueue(self):
+        """Test that transactions over the memory limit are spilled to disk and replayed"""
+        spill_dir = tempfile.mkdtemp()
+        try:
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                           timedelta(seconds=0), max_endpoint_errors=100,
+                                           spill_queue=SpillQueue(spill_dir))
+            trManager._restore_transaction = lambda record: memTransaction(record['size'], trManager)
+
+            step = 10
+            oneTrSize = (MAX_QUEUE_SIZE / step) - 1
+            for i in xrange(step + 2):
+                trManager.append(memTransaction(oneTrSize, trManager))
+
+            # The two oldest transactions don't fit in memory
+            self.assertEqual(len(trManager._transactions), step)
+            self.assertEqual(len(trManager._spill_queue), 2)
+
+            # Once memory is freed they are replayed
+            for tr in trManager._transactions:
+                tr.is_flushable = True
+            trManager.flush()
+            self.assertEqual(len(trManager._transactions), 0)
+            trManager.flush()
+            self.assertEqual(len(trManager._spill_queue), 0)
+            self.assertEqual(len(trManager._transactions), 2)
+            self.assertEqual(trManager._transactions_replayed, 2)
+
+            # What's left in memory is kept on disk for the next run
+            trManager.close()
+            self.assertEqual(len(trManager._transactions), 0)
+            self.assertEqual(len(SpillQueue(spill_dir)), 2)
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def testTransactionQueue(self):
+        """Test the flush and eviction order of the queue"""
+        queue = TransactionQueue()
+        now = datetime.utcnow()
+        trs = []
+        for i, delay in enumerate([0, 30, 0, 60, 30]):
+            tr = Transaction()
+            tr.set_id(i + 1)
+            tr._next_flush = now + timedelta(seconds=delay)
+            queue.add(tr)
+            trs.append(tr)
+
+        self.assertEqual([t.get_id() for t in queue], [1, 2, 3, 4, 5])
+        self.assertEqual(queue[1], trs[1])
+        self.assertEqual([t.get_id() for t in queue.pop_due(now)], [1, 3])
+        self.assertEqual(queue.pop_due(now), [])
+        self.assertEqual(len(queue), 5)
+
+        # Rescheduled and removed transactions
+        trs[0]._next_flush = now + timedelta(seconds=90)
+        queue.schedule(trs[0])
+        self.assertTrue(queue.remove(trs[2]))
+        self.assertFalse(queue.remove(trs[2]))
+        self.assertEqual([t.get_id() for t in queue.pop_due(now + timedelta(seconds=30))], [2, 5])
+
+        # Furthest next flush first, then oldest first
+        self.assertEqual([queue.pop_evictable().get_id() for _ in xrange(4)], [1, 4, 2, 5])
+        self.assertIs(queue.pop_evictable(), None)
+        self.assertEqual(len(queue), 0)
+
     def testThrottling(self):
         """Test throttling while flushing"""
 
@@ -343,3 +416,52 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(len(trManager._transactions), 2)
         self.assertEqual(trManager._transactions[0]._endpoint, 'https://app.datadoghq.com')
         self.assertEqual(trManager._transactions[1]._endpoint, 'https://app.example.com')
+
+    def test_payload_coalescing(self):
+        config = {
+            "endpoints": {"https://app.datadoghq.com": ['api_key']},
+            "dd_url": "https://app.datadoghq.com",
+            "api_key": 'api_key',
+            "use_dd": True
+        }
+        app = Application()
+        app._agentConfig = config
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       THROTTLING_DELAY, max_endpoint_errors=100)
+        trManager._flush_without_ioloop = True
+        trManager._trs_to_flush = []  # Pretend a flush is running, to keep the transactions queued
+        for tr_class in [MetricTransaction, APIServiceCheckTransaction]:
+            tr_class._trManager = trManager
+            tr_class.set_application(app)
+            tr_class.set_endpoints(config['endpoints'])
+
+        series = [{'metric': 'foo', 'points': [[1, i]]} for i in xrange(4)]
+        payload = json.dumps({'series': series})
+        coalescer = PayloadCoalescer(1, max_size=2 * len(payload) + 1)
+        compressed = {'Content-Encoding': 'deflate', 'Content-Type': 'application/json'}
+        self.assertTrue(coalescer.add(APIMetricTransaction, zlib.compress(json.dumps({'series': series[:2]})), compressed))
+        self.assertTrue(coalescer.add(APIMetricTransaction, json.dumps({'series': series[2:]}), {}))
+        self.assertTrue(coalescer.add(APIServiceCheckTransaction, json.dumps([{'check': 'bar'}]), {}))
+        # Payloads which can't be merged are sent as is
+        self.assertFalse(coalescer.add(APIMetricTransaction, json.dumps({'series': [], 'other': 1}), {}))
+        self.assertFalse(coalescer.add(APIMetricTransaction, json.dumps({'series': series * 5}), {}))
+        self.assertFalse(coalescer.add(APIMetricTransaction, zlib.compress(json.dumps({'series': series * 5})), compressed))
+        self.assertFalse(coalescer.add(APIMetricTransaction, 'not json', {}))
+        self.assertEqual(len(trManager._transactions), 0)
+
+        coalescer.flush()
+        self.assertEqual(len(trManager._transactions), 2)
+        payloads = dict(
+            (type(tr), json.loads(zlib.decompress(tr._data))) for tr in trManager._transactions
+        )
+        self.assertEqual(payloads[APIMetricTransaction], {'series': series})
+        self.assertEqual(payloads[APIServiceCheckTransaction], [{'check': 'bar'}])
+        for tr in trManager._transactions:
+            self.assertEqual(tr._headers['Content-Encoding'], 'deflate')
+
+        # A batch is sent early instead of growing past the maximum size
+        for i in xrange(4):
+            self.assertTrue(coalescer.add(APIMetricTransaction, payload, {}))
+        self.assertEqual(len(trManager._transactions), 3)
+        coalescer.flush()
+        self.assertEqual(len(trManager._transactions), 4)
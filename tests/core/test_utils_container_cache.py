@@ -0,0 +1,176 @@
+# stdlib
+from Queue import Queue
+from unittest import TestCase
+import time
+
+# 3p
+import mock
+
+# project
+from utils.dockerutil import ContainerCache
+
+
+def container(container_id, status='Up 2 minutes'):
+    return {'Id': container_id, 'Names': ['/%s' % container_id], 'Status': status}
+
+
+class MockClient(object):
+    def __init__(self, containers):
+        self.containers_by_id = dict((co['Id'], co) for co in containers)
+        self.calls = []
+
+    def containers(self, all=False, size=False, filters=None):
+        self.calls.append(filters)
+        if filters:
+            return [dict(co) for co_id, co in self.containers_by_id.iteritems() if co_id.startswith(filters['id'])]
+        return [dict(co) for co in self.containers_by_id.itervalues()]
+
+
+class MockDockerUtil(object):
+    def __init__(self):
+        self.event_queue = Queue()
+
+    def _stream(self):
+        while True:
+            event = self.event_queue.get()
+            if event is None:
+                raise IOError("stream closed")
+            yield event
+
+    def open_events_stream(self):
+        return self._stream(), self
+
+    def shutdown(self, how):
+        self.event_queue.put(None)
+
+
+class TestContainerCache(TestCase):
+    def setUp(self):
+        self.client = MockClient([container('aaa'), container('bbb')])
+        self.cache = ContainerCache(MockDockerUtil())
+        # Act as if the events stream was up
+        self.cache._streaming = True
+
+    def get_ids(self, **kwargs):
+        return sorted(co['Id'] for co in self.cache.get_containers(self.client, **kwargs))
+
+    def test_listing(self):
+        self.assertEquals(self.get_ids(), ['aaa', 'bbb'])
+        self.assertEquals(self.client.calls, [None])
+
+        # Nothing changed, no call to the daemon
+        self.assertEquals(self.get_ids(), ['aaa', 'bbb'])
+        self.assertEquals(self.client.calls, [None])
+
+        # Containers are kept between calls
+        self.cache.containers['aaa']['_pid'] = 42
+        self.assertEquals(self.cache.containers['aaa'].get('_pid'), 42)
+
+    def test_events(self):
+        self.get_ids()
+        self.client.calls = []
+
+        self.client.containers_by_id['ccc'] = container('ccc')
+        self.client.containers_by_id['aaa'] = container('aaa', status='Exited (0) 1 second ago')
+        self.cache.containers['aaa']['_pid'] = 42
+        self.cache.handle_event({'status': 'create', 'id': 'ccc'})
+        self.cache.handle_event({'status': 'die', 'id': 'aaa'})
+        self.cache.handle_event({'status': 'exec_create: ls', 'id': 'bbb'})
+        self.cache.handle_event({'status': 'pull', 'id': 'redis:latest', 'Type': 'image'})
+        self.cache.handle_event('not an event')
+
+        self.assertEquals(self.get_ids(), ['aaa', 'bbb', 'ccc'])
+        self.assertEquals(sorted(f['id'] for f in self.client.calls), ['aaa', 'ccc'])
+        self.assertEquals(self.cache.containers['aaa']['Status'], 'Exited (0) 1 second ago')
+        self.assertFalse('_pid' in self.cache.containers['aaa'])
+
+        self.client.calls = []
+        del self.client.containers_by_id['bbb']
+        self.cache.handle_event({'status': 'destroy', 'id': 'bbb'})
+        self.assertEquals(self.get_ids(), ['aaa', 'ccc'])
+        self.assertEquals(self.client.calls, [])
+
+    def test_full_listing(self):
+        self.get_ids()
+        self.client.calls = []
+
+        # Container sizes
+        self.get_ids(size=True)
+        self.assertEquals(self.client.calls, [None])
+
+        # Too many changes
+        self.client.calls = []
+        for i in xrange(20):
+            self.cache.handle_event({'status': 'start', 'id': 'c%s' % i})
+        self.get_ids()
+        self.assertEquals(self.client.calls, [None])
+
+        # Periodic listing
+        self.client.calls = []
+        self.cache._latest_full_listing = time.time() - self.cache.full_listing_interval - 1
+        self.get_ids()
+        self.assertEquals(self.client.calls, [None])
+
+        # Events stream down
+        self.client.calls = []
+        self.cache._streaming = False
+        self.get_ids()
+        self.get_ids()
+        self.assertEquals(self.client.calls, [None, None])
+
+    def test_failed_listing(self):
+        self.get_ids()
+        self.cache.handle_event({'status': 'start', 'id': 'aaa'})
+
+        def fail(*args, **kwargs):
+            raise IOError()
+        containers = self.client.containers
+        self.client.containers = fail
+        self.assertRaises(IOError, self.get_ids)
+
+        # Changes are kept, and the next listing is a full one
+        self.client.containers = containers
+        self.client.calls = []
+        self.get_ids()
+        self.assertEquals(self.client.calls, [None])
+
+    @mock.patch('utils.dockerutil.EVENTS_STREAM_RETRY_DELAY', 0)
+    def test_events_stream(self):
+        docker_util = self.cache.docker_util
+        self.cache._streaming = False
+        self.cache.start()
+        for _ in xrange(100):
+            if self.cache._streaming:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.cache._streaming)
+
+        self.get_ids()
+        self.client.calls = []
+        self.client.containers_by_id['ccc'] = container('ccc')
+        docker_util.event_queue.put({'status': 'start', 'id': 'ccc', 'Type': 'container'})
+        for _ in xrange(100):
+            if self.cache._changed:
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.get_ids(), ['aaa', 'bbb', 'ccc'])
+        self.assertEquals(self.client.calls, [{'id': 'ccc'}])
+
+        # The stream breaks: events may be missed, containers are fully listed
+        docker_util.event_queue.put(None)
+        for _ in xrange(100):
+            if not self.cache._synced:
+                break
+            time.sleep(0.01)
+        self.client.calls = []
+        self.get_ids()
+        self.assertEquals(self.client.calls, [None])
+
+        # Stopping unblocks the thread reading the stream
+        for _ in xrange(100):
+            if self.cache._streaming:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.cache._streaming)
+        self.cache.stop()
+        self.assertFalse(self.cache._thread.is_alive())
@@ -1,12 +1,15 @@
 # stdlib
 from unittest import TestCase
+import os
+import shutil
 import socket
+import tempfile
 
 # 3p
 from nose.plugins.skip import SkipTest
 
 # project
-from utils.net import inet_pton, _inet_pton_win
+from utils.net import get_udp_socket_stats, inet_pton, _inet_pton_win
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
 
 
@@ -29,3 +32,22 @@ class TestUtilsNet(TestCase):
 
         if not hasattr(socket, 'IPV6_V6ONLY'):
             self.assertEqual(IPV6_V6ONLY, 27)
+
+    def test_get_udp_socket_stats(self):
+        proc_path = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(proc_path, 'net'))
+            header = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+            with open(os.path.join(proc_path, 'net', 'udp'), 'w') as f:
+                f.write(header)
+                f.write("  12: 0100007F:2021 00000000:0000 07 00000000:00000100 00:00000000 00000000     0        0 1001 2 ffff880000000000 3\n")
+                f.write("  13: 0100007F:0035 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1002 2 ffff880000000000 9\n")
+            with open(os.path.join(proc_path, 'net', 'udp6'), 'w') as f:
+                f.write(header)
+                f.write("  40: 00000000000000000000000000000000:2021 00000000000000000000000000000000:0000 07 00000000:00000010 00:00000000 00000000     0        0 1003 2 ffff880000000000 4\n")
+
+            self.assertEqual(get_udp_socket_stats(8225, proc_path), {'rx_queue': 272, 'drops': 7})
+            self.assertIsNone(get_udp_socket_stats(8226, proc_path))
+            self.assertIsNone(get_udp_socket_stats(8225, os.path.join(proc_path, 'missing')))
+        finally:
+            shutil.rmtree(proc_path)
@@ -0,0 +1,75 @@
+# stdlib
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+# project
+from utils.spill_queue import SpillQueue
+
+
+class TestSpillQueue(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_put_pop(self):
+        queue = SpillQueue(self.path, segment_size=100)
+        for i in xrange(10):
+            queue.put({'id': i, 'data': 'x' * 30})
+
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(len(self.segment_files()), 5)
+        # Newest segment first, records in order within a segment
+        self.assertEqual([r['id'] for r in queue.pop_segment()], [8, 9])
+        self.assertEqual([r['id'] for r in queue.pop_segment()], [6, 7])
+        self.assertEqual(len(queue), 6)
+        self.assertEqual(len(self.segment_files()), 3)
+
+        queue.put({'id': 10})
+        self.assertEqual([r['id'] for r in queue.pop_segment()], [10])
+        self.assertEqual([r['id'] for r in queue.pop_segment()], [4, 5])
+
+    def test_max_size(self):
+        queue = SpillQueue(self.path, max_size=500, segment_size=100)
+        for i in xrange(50):
+            queue.put({'id': i, 'data': 'x' * 30})
+        self.assertTrue(queue.size <= 500)
+        # The oldest records are dropped
+        ids = []
+        while len(queue):
+            ids = [r['id'] for r in queue.pop_segment()] + ids
+        self.assertEqual(ids, range(50 - len(ids), 50))
+        self.assertEqual(self.segment_files(), [])
+
+    def test_reopen(self):
+        queue = SpillQueue(self.path, segment_size=100, fsync_batch=1)
+        for i in xrange(5):
+            queue.put({'id': i})
+        queue.close()
+
+        queue = SpillQueue(self.path, segment_size=100)
+        self.assertEqual(len(queue), 5)
+        queue.put({'id': 5})
+        ids = []
+        while len(queue):
+            ids = [r['id'] for r in queue.pop_segment()] + ids
+        self.assertEqual(ids, range(6))
+
+    def test_torn_write(self):
+        queue = SpillQueue(self.path, fsync_batch=1)
+        for i in xrange(3):
+            queue.put({'id': i})
+        # Crash in the middle of a write, without closing the queue
+        segment_path = os.path.join(self.path, self.segment_files()[0])
+        with open(segment_path, 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+
+        queue = SpillQueue(self.path)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual([r['id'] for r in queue.pop_segment()], [0, 1, 2])
@@ -1,8 +1,10 @@
 
 # stdlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import heapq
+from itertools import islice
 import logging
-from operator import attrgetter
 import sys
 import time
 
@@ -18,6 +20,11 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+EPOCH = datetime(1970, 1, 1)
+# Heaps are rebuilt without their stale entries past this many entries per
+# queued transaction
+HEAP_COMPACTION_RATIO = 2
+
 class Transaction(object):
 
     def __init__(self):
@@ -62,15 +69,127 @@ class Transaction(object):
     def time_to_flush(self,now = datetime.utcnow()):
         return self._next_flush <= now
 
+    def get_spill_record(self):
+        """ Picklable state to write the transaction to disk, None if it can't be """
+        return None
+
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+class TransactionQueue(object):
+    """
+    The transactions of a TransactionManager, iterated in insertion order.
+
+    Two heaps, whose entries are invalidated in place when a transaction is
+    removed or rescheduled, give in O(log n):
+     * the transactions due for a flush, keyed on their next flush time.
+       Transactions being flushed are out of it until they are rescheduled.
+     * the transaction to evict first when the queue is full: the one whose
+       next flush is the furthest away, the oldest one first.
+    """
+
+    def __init__(self):
+        self._by_id = OrderedDict()
+        # Heaps of [key, id, transaction], and the current entry of each id
+        self._schedule = []
+        self._schedule_entries = {}
+        self._eviction = []
+        self._eviction_entries = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return self._by_id.itervalues()
+
+    def __contains__(self, tr):
+        return self._by_id.get(tr.get_id()) is tr
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._by_id)
+        for tr in islice(self._by_id.itervalues(), index, None):
+            return tr
+        raise IndexError("transaction index out of range")
+
+    @staticmethod
+    def _push(heap, entries, key, tr):
+        tr_id = tr.get_id()
+        entry = entries.get(tr_id)
+        if entry is not None:
+            entry[-1] = None
+        entry = [key, tr_id, tr]
+        entries[tr_id] = entry
+        heapq.heappush(heap, entry)
+
+    @staticmethod
+    def _invalidate(entries, tr_id):
+        entry = entries.pop(tr_id, None)
+        if entry is not None:
+            entry[-1] = None
+
+    def _compact(self):
+        if len(self._schedule) > HEAP_COMPACTION_RATIO * len(self._by_id) + 1:
+            self._schedule = [e for e in self._schedule if e[-1] is not None]
+            heapq.heapify(self._schedule)
+        if len(self._eviction) > HEAP_COMPACTION_RATIO * len(self._by_id) + 1:
+            self._eviction = [e for e in self._eviction if e[-1] is not None]
+            heapq.heapify(self._eviction)
+
+    def add(self, tr):
+        self._by_id[tr.get_id()] = tr
+        self.schedule(tr)
+
+    def schedule(self, tr):
+        """ (Re)schedule a transaction on its next flush time """
+        if tr not in self:
+            return
+        next_flush = tr.get_next_flush()
+        self._push(self._schedule, self._schedule_entries, next_flush, tr)
+        self._push(self._eviction, self._eviction_entries,
+                   -(next_flush - EPOCH).total_seconds(), tr)
+        self._compact()
+
+    def remove(self, tr):
+        """ Remove a transaction, return whether it was queued """
+        if tr not in self:
+            return False
+        tr_id = tr.get_id()
+        del self._by_id[tr_id]
+        self._invalidate(self._schedule_entries, tr_id)
+        self._invalidate(self._eviction_entries, tr_id)
+        self._compact()
+        return True
+
+    def pop_due(self, now):
+        """ Return the transactions due for a flush at `now`, and unschedule them """
+        due = []
+        schedule = self._schedule
+        while schedule and (schedule[0][-1] is None or schedule[0][0] <= now):
+            next_flush, tr_id, tr = heapq.heappop(schedule)
+            if tr is not None:
+                del self._schedule_entries[tr_id]
+                due.append(tr)
+        return due
+
+    def pop_evictable(self):
+        """ Remove and return the transaction to evict first, None if empty """
+        eviction = self._eviction
+        while eviction:
+            tr = heapq.heappop(eviction)[-1]
+            if tr is not None:
+                self.remove(tr)
+                return tr
+        return None
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
-                 max_parallelism=1, max_endpoint_errors=4):
+                 max_parallelism=1, max_endpoint_errors=4, spill_queue=None,
+                 restore_transaction=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
@@ -80,7 +199,7 @@ class TransactionManager(object):
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = TransactionQueue()  # All non commited transactions
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -94,13 +213,24 @@ class TransactionManager(object):
         #  if this overlaps
         self._counter = 0
 
-        self._trs_to_flush = None # Current transactions being flushed
+        # Heap of (error count, -id, transaction) being flushed, lowest error
+        # count then newest first
+        self._trs_to_flush = None
+        # Endpoints which failed too many times during the current flush
+        self._down_endpoints = set()
         self._last_flush = datetime.utcnow() # Last flush (for throttling)
 
         # Error management
         self._endpoints_errors = {}
         self._finished_flushes = 0
 
+        # Transactions that don't fit in memory are spilled to this SpillQueue,
+        # and rebuilt with `restore_transaction` once there is room again
+        self._spill_queue = spill_queue
+        self._restore_transaction = restore_transaction
+        self._transactions_replayed = 0
+        self._last_status = (time.time(), 0)
+
         # Track an initial status message.
         ForwarderStatus().persist()
 
@@ -128,16 +258,17 @@ class TransactionManager(object):
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
+            while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE and self._transactions:
+                tr2 = self._transactions.pop_evictable()
+                self._total_count = self._total_count - 1
+                self._total_size = self._total_size - tr2.get_size()
+                if self.spill(tr2):
+                    log.debug("Spilled transaction %s to disk" % tr2.get_id())
+                else:
                     log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
+        self._transactions.add(tr)
         self._total_count += 1
         self._transactions_received += 1
         self._total_size = self._total_size + tr_size
@@ -145,18 +276,84 @@ class TransactionManager(object):
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def spill(self, tr):
+        """ Write a transaction to the spill queue, return whether it was """
+        if self._spill_queue is None:
+            return False
+        record = tr.get_spill_record()
+        if record is None:
+            return False
+        try:
+            self._spill_queue.put(record)
+        except Exception:
+            log.exception("Unable to spill transaction %s to disk", tr.get_id())
+            return False
+        return True
+
+    def replay_spilled(self):
+        """
+        Move spilled transactions back in memory, newest first, as long as
+        they fit in the queue.
+        """
+        spill_queue = self._spill_queue
+        if spill_queue is None or self._restore_transaction is None:
+            return
+        while len(spill_queue) and (not self._transactions or
+               self._total_size + spill_queue.next_segment_size() <= self._MAX_QUEUE_SIZE):
+            for record in spill_queue.pop_segment():
+                tr = self._restore_transaction(record)
+                if tr is None:
+                    continue
+                tr.set_id(self.get_tr_id())
+                self._transactions.add(tr)
+                self._total_count += 1
+                self._total_size += tr.get_size()
+                self._transactions_replayed += 1
+                log.debug("Transaction %s replayed from disk" % tr.get_id())
+
+    def close(self):
+        """ Spill the transactions left in memory, they are replayed after a restart """
+        if self._spill_queue is None:
+            return
+        for tr in self._transactions:
+            self.spill(tr)
+        self._transactions = TransactionQueue()
+        self._total_count = 0
+        self._total_size = 0
+        self._spill_queue.close()
+
+    def persist_status(self):
+        spill_queue_length = spill_queue_size = replay_rate = None
+        if self._spill_queue is not None:
+            spill_queue_length = len(self._spill_queue)
+            spill_queue_size = self._spill_queue.size
+            # Transactions replayed from disk per second since the last status
+            now = time.time()
+            last_time, last_replayed = self._last_status
+            replay_rate = round((self._transactions_replayed - last_replayed) / max(now - last_time, 1e-3), 2)
+            self._last_status = (now, self._transactions_replayed)
+
+        ForwarderStatus(
+            queue_length=self._total_count,
+            queue_size=self._total_size,
+            flush_count=self._flush_count,
+            transactions_received=self._transactions_received,
+            transactions_flushed=self._transactions_flushed,
+            transactions_rejected=self._transactions_rejected,
+            spill_queue_length=spill_queue_length,
+            spill_queue_size=spill_queue_size,
+            spill_replay_rate=replay_rate).persist()
+
     def flush(self):
 
         if self._trs_to_flush is not None:
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
+        self.replay_spilled()
+
         # Do we have something to do ?
-        now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        to_flush = self._transactions.pop_due(datetime.utcnow())
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -167,10 +364,12 @@ class TransactionManager(object):
                 log.debug("Flushing %s transaction%s during flush #%s" % (count,plural(count), str(self._flush_count + 1)))
 
             self._endpoints_errors = {}
+            self._down_endpoints = set()
             self._finished_flushes = 0
 
-            # We sort LIFO-style, taking into account errors
-            self._trs_to_flush = sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
+            # We flush LIFO-style, taking into account errors
+            self._trs_to_flush = [(tr._error_count, -tr._id, tr) for tr in to_flush]
+            heapq.heapify(self._trs_to_flush)
             self._flush_time = datetime.utcnow()
             self.flush_next()
         else:
@@ -184,13 +383,23 @@ class TransactionManager(object):
 
         self._flush_count += 1
 
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self.persist_status()
+
+    def _pop_tr_to_flush(self):
+        """
+        Pop the next transaction to flush, skipping the ones evicted since the
+        flush started and rescheduling the ones of down endpoints.
+        """
+        while self._trs_to_flush:
+            tr = heapq.heappop(self._trs_to_flush)[-1]
+            if tr not in self._transactions:
+                continue
+            if tr._endpoint in self._down_endpoints:
+                tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                self._transactions.schedule(tr)
+                continue
+            return tr
+        return None
 
     def flush_next(self):
 
@@ -198,6 +407,8 @@ class TransactionManager(object):
             # Running for too long?
             if datetime.utcnow() - self._flush_time >= self._MAX_FLUSH_DURATION:
                 log.warn('Flush %s is taking more than 10s, stopping it', self._flush_count)
+                for _, _, tr in self._trs_to_flush:
+                    self._transactions.schedule(tr)
                 self._trs_to_flush = []
                 return self.flush_next()
 
@@ -205,7 +416,9 @@ class TransactionManager(object):
             delay = td.total_seconds()
 
             if delay <= 0 and self._running_flushes < self._MAX_PARALLELISM:
-                tr = self._trs_to_flush.pop()
+                tr = self._pop_tr_to_flush()
+                if tr is None:
+                    return self.flush_next()
                 self._running_flushes += 1
                 self._last_flush = datetime.utcnow()
                 log.debug("Flushing transaction %d", tr.get_id())
@@ -245,6 +458,7 @@ class TransactionManager(object):
         self._finished_flushes += 1
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        self._transactions.schedule(tr)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
                  tr.get_id(),
                  tr.get_error_count(),
@@ -253,18 +467,11 @@ class TransactionManager(object):
         self._endpoints_errors[tr._endpoint] = self._endpoints_errors.get(tr._endpoint, 0) + 1
         # Endpoint failed too many times, it's probably an enpoint issue
         # Let's avoid blocking on it
+        # Its transactions are rescheduled as they come up in the current flush
         if self._endpoints_errors[tr._endpoint] == self._MAX_ENDPOINT_ERRORS:
-            new_trs_to_flush = []
-            for transaction in self._trs_to_flush:
-                if transaction._endpoint != tr._endpoint:
-                    new_trs_to_flush.append(transaction)
-                else:
-                    transaction.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-            log.debug('Endpoint %s seems down, removed %s transaction from current flush',
-                      tr._endpoint,
-                      len(self._trs_to_flush) - len(new_trs_to_flush))
-
-            self._trs_to_flush = new_trs_to_flush
+            log.debug('Endpoint %s seems down, skipping its transactions in the current flush',
+                      tr._endpoint)
+            self._down_endpoints.add(tr._endpoint)
 
     def tr_error_reject_request(self, tr):
         self._running_flushes -= 1
@@ -274,26 +481,20 @@ class TransactionManager(object):
                  "It will not be replayed.",
                  tr.get_id(),
                  tr.get_size() / 1024)
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
+        if self._transactions.remove(tr):
+            self._total_count -= 1
+            self._total_size -= tr.get_size()
         self._transactions_flushed += 1
         self.print_queue_stats()
         self._transactions_rejected += 1
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self.persist_status()
 
     def tr_success(self, tr):
         self._running_flushes -= 1
         self._finished_flushes += 1
         log.debug("Transaction %d completed",  tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
+        if self._transactions.remove(tr):
+            self._total_count -= 1
+            self._total_size -= tr.get_size()
         self._transactions_flushed += 1
         self.print_queue_stats()
@@ -5,6 +5,7 @@ import os
 import re
 import socket
 import struct
+import threading
 import time
 
 # 3rd party
@@ -32,6 +33,18 @@ CONFIG_RELOAD_STATUS = ['start', 'die', 'stop', 'kill']  # used to trigger servi
 
 DEFAULT_CONTAINER_EXCLUDE = ["docker_image:gcr.io/google_containers/pause.*"]
 
+# Container events after which the cached listing of a container is stale
+CONTAINER_REFRESH_STATUS = ['create', 'start', 'restart', 'die', 'stop', 'kill', 'oom',
+                            'pause', 'unpause', 'rename', 'update']
+CONTAINER_REMOVE_STATUS = ['destroy']
+# Seconds between two full container listings, even if the events stream is up
+FULL_LISTING_INTERVAL = 300
+# Past this many changed containers, one full listing is cheaper than listing them one by one
+MAX_CONTAINER_REFRESH = 10
+EVENTS_STREAM_RETRY_DELAY = 5
+# Seconds to wait for the events thread to exit when the cache is stopped
+EVENTS_THREAD_STOP_TIMEOUT = 5
+
 log = logging.getLogger(__name__)
 
 
@@ -186,6 +199,22 @@ class DockerUtil:
     def client(self):
         return Client(**self.settings)
 
+    @property
+    def stream_client(self):
+        """A client without read timeout, for long-lived streams like the events one"""
+        settings = dict(self.settings)
+        settings['timeout'] = None
+        return Client(**settings)
+
+    def open_events_stream(self):
+        """
+        Return a generator of the decoded events of the daemon, and the socket
+        of the stream, to shut it down from another thread.
+        """
+        client = self.stream_client
+        response = client.get(client._url('/events'), stream=True)
+        return client._stream_helper(response, decode=True), client._get_raw_response_socket(response)
+
     def set_docker_settings(self, init_config, instance):
         """Update docker settings"""
         self._docker_root = init_config.get('docker_root', '/')
@@ -408,3 +437,155 @@ class DockerUtil:
     def _drop(cls):
         if cls in cls._instances:
             del cls._instances[cls]
+
+
+class ContainerCache(object):
+    """
+    The containers of the daemon, as returned by its container listing, kept
+    current by a thread consuming the events stream so that they don't have
+    to be listed at every check run.
+
+    The thread only records which containers changed: `get_containers` lists
+    them again, one by one, when it's called. A full listing is done instead
+    when the cache may have missed events (first call, events stream down or
+    interrupted since the last call), when container sizes are requested and
+    every `FULL_LISTING_INTERVAL` seconds.
+
+    The container dicts are kept between calls, so anything the caller caches
+    in them (extracted tags, pid...) stays until the container changes.
+    """
+
+    def __init__(self, docker_util, full_listing_interval=FULL_LISTING_INTERVAL):
+        self.docker_util = docker_util
+        self.full_listing_interval = full_listing_interval
+
+        self.containers = {}
+        self._lock = threading.Lock()
+        # Ids of the containers to list again
+        self._changed = set()
+        # Ids of the containers destroyed since the last listing started
+        self._destroyed = set()
+        # False until a full listing is done while the events stream is up
+        self._synced = False
+        self._streaming = False
+        self._latest_full_listing = 0
+
+        self._stopped = threading.Event()
+        self._thread = None
+        # Socket of the events stream, shut down to unblock the thread
+        self._events_socket = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._consume_events, name='docker-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            events_socket = self._events_socket
+        # The thread may be blocked reading the stream
+        if events_socket is not None:
+            try:
+                events_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self._thread is not None:
+            self._thread.join(EVENTS_THREAD_STOP_TIMEOUT)
+            if self._thread.is_alive():
+                log.warning("Docker events thread still running after %ss", EVENTS_THREAD_STOP_TIMEOUT)
+        self._stream_down()
+
+    def _consume_events(self):
+        while not self._stopped.is_set():
+            try:
+                event_generator, events_socket = self.docker_util.open_events_stream()
+                with self._lock:
+                    self._streaming = True
+                    self._events_socket = events_socket
+                # Stopped before the socket could be shut down
+                if self._stopped.is_set():
+                    return
+                for event in event_generator:
+                    if self._stopped.is_set():
+                        return
+                    self.handle_event(event)
+                log.info("Docker events stream closed, reconnecting")
+                self._stream_down()
+            except Exception as e:
+                self._stream_down()
+                log.warning("Docker events stream interrupted, reconnecting in %ss: %s",
+                            EVENTS_STREAM_RETRY_DELAY, e)
+                self._stopped.wait(EVENTS_STREAM_RETRY_DELAY)
+
+    def _stream_down(self):
+        # Events may be missed until the stream is up again
+        with self._lock:
+            self._streaming = False
+            self._synced = False
+            self._events_socket = None
+
+    def handle_event(self, event):
+        # see DockerUtil.get_events
+        if not isinstance(event, dict):
+            log.debug('Unable to parse Docker event: %s', event)
+            return
+        # Events of other objects (images, networks...) only come with a type on API >= 1.22
+        if event.get('Type', 'container') != 'container':
+            return
+
+        status = event.get('status')
+        container_id = event.get('id')
+        if status in CONTAINER_REMOVE_STATUS:
+            with self._lock:
+                self.containers.pop(container_id, None)
+                self._changed.discard(container_id)
+                self._destroyed.add(container_id)
+        elif status in CONTAINER_REFRESH_STATUS:
+            with self._lock:
+                self._changed.add(container_id)
+
+    def get_containers(self, client, size=False):
+        """
+        Return the list of all the containers, up to date with the events
+        received so far. `client` is used for the listings.
+        """
+        with self._lock:
+            full_listing = (size or not self._synced or not self._streaming
+                            or len(self._changed) > MAX_CONTAINER_REFRESH
+                            or time.time() - self._latest_full_listing > self.full_listing_interval)
+            changed, self._changed = self._changed, set()
+            self._destroyed = set()
+            if full_listing:
+                # Reset by the events thread if the stream breaks during the listing
+                self._synced = self._streaming
+
+        try:
+            if full_listing:
+                containers = dict((co['Id'], co) for co in client.containers(all=True, size=size))
+                self._latest_full_listing = time.time()
+            else:
+                containers = dict(self.containers)
+                for container_id in changed:
+                    # The id filter matches prefixes
+                    listed = [co for co in client.containers(all=True, filters={'id': container_id})
+                              if co['Id'] == container_id]
+                    if listed:
+                        containers[container_id] = listed[0]
+                    else:
+                        containers.pop(container_id, None)
+        except Exception:
+            with self._lock:
+                self._changed.update(changed)
+                self._synced = False
+            raise
+
+        with self._lock:
+            # Containers destroyed during the listing may still be in it
+            for container_id in self._destroyed:
+                containers.pop(container_id, None)
+            self.containers = containers
+        return containers.values()
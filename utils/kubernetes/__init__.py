@@ -5,3 +5,4 @@
 from .kube_state_processor import KubeStateProcessor  # noqa: F401
 from .kube_state_processor import NAMESPACE  # noqa: F401
 from .kubeutil import KubeUtil  # noqa: F401
+from .list_cache import KubeListCache  # noqa: F401
@@ -10,6 +10,7 @@ from util import check_yaml
 from utils.checkfiles import get_conf_path
 from utils.http import retrieve_json
 from utils.dockerutil import DockerUtil
+from utils.kubernetes.list_cache import KubeListCache
 
 import requests
 
@@ -38,6 +39,8 @@ class KubeUtil:
     CA_CRT_PATH = '/run/secrets/kubernetes.io/serviceaccount/ca.crt'
     AUTH_TOKEN_PATH = '/run/secrets/kubernetes.io/serviceaccount/token'
     DEFAULT_TIMEOUT_SECONDS = 10
+    # How long the lists of objects from the API are shared between checks
+    DEFAULT_API_CACHE_TTL = 10
 
     POD_NAME_LABEL = "io.kubernetes.pod.name"
     NAMESPACE_LABEL = "io.kubernetes.pod.namespace"
@@ -59,6 +62,7 @@ class KubeUtil:
                 instance = {}
 
         self.timeoutSeconds = instance.get("timeoutSeconds", KubeUtil.DEFAULT_TIMEOUT_SECONDS)
+        self.api_cache_ttl = float(instance.get('api_cache_ttl', KubeUtil.DEFAULT_API_CACHE_TTL))
         self.method = instance.get('method', KubeUtil.DEFAULT_METHOD)
         self.host = instance.get("host") or self.docker_util.get_hostname()
         self._node_ip = self._node_name = None  # lazy evaluation
@@ -84,6 +88,7 @@ class KubeUtil:
         self.endpoints_list_url = urljoin(self.kubernetes_api_url, KubeUtil.ENDPOINTS_LIST_PATH)
         self.pods_list_url = urljoin(self.kubernetes_api_url, KubeUtil.PODS_LIST_PATH)
         self.deployments_list_url = urljoin(self.kubernetes_api_extension_url, KubeUtil.DEPLOYMENTS_LIST_PATH)
+        self.replicasets_list_url = urljoin(self.kubernetes_api_extension_url, KubeUtil.REPLICASETS_LIST_PATH)
 
         self.kube_health_url = urljoin(self.kubelet_api_url, 'healthz')
 
@@ -91,6 +96,12 @@ class KubeUtil:
         # default value is 0 but TTL for k8s events is one hour anyways
         self.last_event_collection_ts = defaultdict(int)
 
+        # lists of objects are shared with the other KubeUtil through this cache,
+        # count the API requests and the cache hits since the last report
+        self.list_cache = KubeListCache()
+        self.api_requests = 0
+        self.api_cache_hits = 0
+
     def get_kube_labels(self, excluded_keys=None):
         pods = self.retrieve_pods_list()
         return self.extract_kube_labels(pods, excluded_keys=excluded_keys)
@@ -152,18 +163,14 @@ class KubeUtil:
     def retrieve_pods_list(self):
         """
         Retrieve the list of pods for this cluster querying the kubelet API.
-
-        TODO: the list of pods could be cached with some policy to be decided.
         """
-        return self.retrieve_json_with_optional_auth(url=self.pods_list_url)
+        return self.retrieve_list(self.pods_list_url)
 
     def retrieve_endpoints_list(self):
         """
         Retrieve the list of endpoints for this cluster querying the kubelet API.
-
-        TODO: the list of endpoints could be cached with some policy to be decided.
         """
-        return self.retrieve_json_with_optional_auth(url=self.endpoints_list_url)
+        return self.retrieve_list(self.endpoints_list_url)
 
     def retrieve_machine_info(self):
         """
@@ -181,13 +188,13 @@ class KubeUtil:
         """
         Retrieve the list of nodes for this cluster querying the kublet API.
         """
-        return self.retrieve_json_with_optional_auth(self.nodes_list_url)
+        return self.retrieve_list(self.nodes_list_url)
 
     def retrieve_services_list(self):
         """
         Retrieve the list of services for this cluster querying the kublet API.
         """
-        return self.retrieve_json_with_optional_auth(url=self.services_list_url)
+        return self.retrieve_list(self.services_list_url)
 
     def retrieve_json_with_optional_auth(self, url):
         if self.use_kube_auth:
@@ -195,12 +202,44 @@ class KubeUtil:
         else:
             return retrieve_json(url=url, timeout=self.timeoutSeconds)
 
+    def retrieve_list(self, url):
+        """
+        Retrieve a list of objects from the API, through the cache shared by
+        all the KubeUtil of the agent. The list must not be modified.
+        """
+        response, cached = self.list_cache.get(url, self.retrieve_json_with_optional_auth, self.api_cache_ttl)
+        if cached:
+            self.api_cache_hits += 1
+        else:
+            self.api_requests += 1
+        return response
+
+    def report_api_stats(self, check, tags=None):
+        """
+        Submit the API requests and cache hits of the lists retrieved since the
+        last report through the given check.
+        """
+        total = self.api_requests + self.api_cache_hits
+        if not total:
+            return
+        check.gauge('kubernetes.api.requests', self.api_requests, tags=tags)
+        check.gauge('kubernetes.api.cache_hits', self.api_cache_hits, tags=tags)
+        check.gauge('kubernetes.api.cache_hit_ratio', float(self.api_cache_hits) / total, tags=tags)
+        self.api_requests = 0
+        self.api_cache_hits = 0
+
     def retrieve_deployments_list(self):
         """
         Retrieve the list of deployments for this cluster querying the kublet API extensions.
         https://kubernetes.io/docs/concepts/workloads/controllers/deployment/
         """
-        return self.retrieve_json_with_optional_auth(url=self.deployments_list_url)
+        return self.retrieve_list(self.deployments_list_url)
+
+    def retrieve_replicasets_list(self):
+        """
+        Retrieve the list of all the replicasets for this cluster querying the kublet API extensions.
+        """
+        return self._retrieve_replicaset_list(fetch_url=self.replicasets_list_url)
 
     def retrieve_replicaset_filtered_list(self, namespace = None, labels_dict = None):
         """
@@ -228,7 +267,7 @@ class KubeUtil:
         Retrieve the list of replicasets for given parameters, namespace and labels selector.
         https://kubernetes.io/docs/concepts/workloads/controllers/replicaset/
         """
-        return self.retrieve_json_with_optional_auth(url=fetch_url)
+        return self.retrieve_list(fetch_url)
 
     def _to_label_selector(self, labels_dict):
         """
@@ -0,0 +1,63 @@
+# stdlib
+import threading
+import time
+
+# project
+from utils.singleton import Singleton
+
+
+class KubeListCache:
+    """
+    Process-wide cache of the list responses of the Kubernetes API, shared by
+    every KubeUtil so that the checks (and the service discovery) running in
+    the same collection don't list the same objects over and over.
+
+    A response is served from the cache for `ttl` seconds. When it is fetched
+    again and the list still has the same resourceVersion, the cached response
+    is kept, so that consumers get the very same objects as long as nothing
+    changed in the cluster.
+
+    The responses are shared: callers must not modify them.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        # url -> (fetch timestamp, resourceVersion, response)
+        self._responses = {}
+
+    def get(self, url, fetch, ttl):
+        """
+        Return the response of `fetch(url)`, from the cache if it is less than
+        `ttl` seconds old, and whether it was served from the cache.
+        """
+        if ttl <= 0:
+            return fetch(url), False
+
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+
+        # Concurrent callers wait for the one listing the same url
+        with url_lock:
+            entry = self._responses.get(url)
+            if entry is not None and time.time() - entry[0] < ttl:
+                return entry[2], True
+
+            response = fetch(url)
+            version = self.resource_version(response)
+            if entry is not None and version is not None and version == entry[1]:
+                response = entry[2]
+            self._responses[url] = (time.time(), version, response)
+            return response, False
+
+    def clear(self):
+        with self._lock:
+            self._responses = {}
+
+    @staticmethod
+    def resource_version(response):
+        try:
+            return response['metadata']['resourceVersion']
+        except (KeyError, TypeError):
+            return None
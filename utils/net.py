@@ -1,6 +1,7 @@
 
 # lib
 import ctypes
+import os
 import socket
 
 # 3p
@@ -23,6 +24,13 @@ try:
 except AttributeError:
     IPV6_V6ONLY = 27  # from `Ws2ipdef.h`
 
+# Python 2 doesn't expose SO_REUSEPORT, only Linux >= 3.9 balances
+# datagrams across the sockets sharing a port with it.
+try:
+    SO_REUSEPORT = socket.SO_REUSEPORT
+except AttributeError:
+    SO_REUSEPORT = 15  # from `asm-generic/socket.h`
+
 
 class sockaddr(ctypes.Structure):
     _fields_ = [("sa_family", ctypes.c_short),
@@ -58,3 +66,32 @@ try:
     from socket import inet_pton
 except ImportError:
     inet_pton = _inet_pton_win
+
+
+def get_udp_socket_stats(port, proc_path='/proc'):
+    """
+    Return the kernel receive backlog (bytes) and drop counters of the UDP
+    sockets bound to `port`, summed across `/proc/net/udp` and `/proc/net/udp6`.
+    Several sockets can share the port (SO_REUSEPORT), so every match is counted.
+    Return None when the proc files can't be read (e.g. not on Linux).
+    """
+    port_hex = ':%04X' % int(port)
+    stats = {'rx_queue': 0, 'drops': 0}
+    found = False
+    for name in ('udp', 'udp6'):
+        try:
+            with open(os.path.join(proc_path, 'net', name)) as f:
+                # Skip the header line
+                f.readline()
+                for line in f:
+                    fields = line.split()
+                    # sl local_address rem_address st tx_queue:rx_queue ... inode ref pointer drops
+                    if len(fields) < 13 or not fields[1].endswith(port_hex):
+                        continue
+                    found = True
+                    stats['rx_queue'] += int(fields[4].split(':')[1], 16)
+                    stats['drops'] += int(fields[12])
+        except (IOError, OSError, ValueError):
+            continue
+
+    return stats if found else None
@@ -0,0 +1,203 @@
+# stdlib
+from array import array
+import math
+import sys
+
+# Quantiles returned by the sketch are within this relative error of the
+# exact ones computed over the raw samples.
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Enough to cover values from 1e-6 to 1e12 at 1% accuracy. Past that, the
+# lowest bins get collapsed together.
+DEFAULT_MAX_BINS = 2048
+
+
+class _BinStore(object):
+    """
+    Dense counts of consecutive bin keys, stored in a compact array.
+    `offset` is the key of `bins[0]`.
+    """
+
+    def __init__(self, max_bins):
+        self.max_bins = max_bins
+        self.bins = array('d')
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.bins)
+
+    def add(self, key, weight=1):
+        bins = self.bins
+        if not bins:
+            self.offset = key
+            bins.append(weight)
+            return
+
+        if key < self.offset:
+            top = self.offset + len(bins) - 1
+            new_offset = max(key, top - self.max_bins + 1)
+            if new_offset < self.offset:
+                bins[0:0] = array('d', [0]) * (self.offset - new_offset)
+                self.offset = new_offset
+            # Keys below the range are collapsed into the lowest bin
+            key = max(key, self.offset)
+        elif key >= self.offset + len(bins):
+            bins.extend(array('d', [0]) * (key - self.offset - len(bins) + 1))
+            extra = len(bins) - self.max_bins
+            if extra > 0:
+                collapsed = sum(bins[:extra + 1])
+                del bins[:extra]
+                bins[0] = collapsed
+                self.offset += extra
+
+        bins[key - self.offset] += weight
+
+    def merge(self, other):
+        for i, weight in enumerate(other.bins):
+            if weight:
+                self.add(other.offset + i, weight)
+
+    def items(self, reverse=False):
+        """ Yield the (key, count) of non-empty bins. """
+        indexes = xrange(len(self.bins))
+        if reverse:
+            indexes = reversed(indexes)
+        for i in indexes:
+            if self.bins[i]:
+                yield self.offset + i, self.bins[i]
+
+
+class DDSketch(object):
+    """
+    A mergeable quantile sketch with bounded memory (DDSketch).
+
+    Values are counted in logarithmically sized bins: bin `k` holds the values
+    in ]gamma^(k-1), gamma^k], so any value can be approximated by the bin
+    midpoint within `relative_accuracy`. Count, sum, min and max are exact.
+
+    See https://arxiv.org/abs/1908.10693
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = _BinStore(max_bins)
+        self.negative = _BinStore(max_bins)
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        if value > 0:
+            self.positive.add(self._key(value))
+        elif value < 0:
+            self.negative.add(self._key(-value))
+        else:
+            self.zero_count += 1
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if self.gamma != other.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracies")
+        if not other.count:
+            return
+
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def get_value_at_rank(self, rank):
+        """
+        Approximate the value the sorted samples would hold at index `rank`.
+        Negative ranks count from the end, like list indexes.
+        """
+        if not self.count:
+            return None
+        if rank < 0:
+            rank += self.count
+        rank = min(max(rank, 0), self.count - 1)
+
+        seen = 0
+        for key, weight in self.negative.items(reverse=True):
+            seen += weight
+            if seen > rank:
+                return max(-self._value(key), self.min)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        for key, weight in self.positive.items():
+            seen += weight
+            if seen > rank:
+                return min(self._value(key), self.max)
+
+        return self.max
+
+    def get_quantile_value(self, quantile):
+        return self.get_value_at_rank(int(round(quantile * self.count - 1)))
+
+    def bin_count(self):
+        return len(self.positive) + len(self.negative)
+
+    def memory_usage(self):
+        """ Approximate size in bytes of the sketch and of its bins. """
+        return sys.getsizeof(self) + sys.getsizeof(self.positive.bins) + sys.getsizeof(self.negative.bins)
+
+
+class TopK(object):
+    """
+    Approximate top-k of the most frequent items of a stream, in bounded
+    memory (Space-Saving). At most `capacity` counters are kept: an unseen
+    item takes over the smallest counter, so counts are overestimated by at
+    most the count they inherited (kept as the error).
+
+    See https://www.cs.ucsb.edu/sites/default/files/documents/2005-23.pdf
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def offer(self, item, count=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+        else:
+            evicted = min(counts, key=counts.get)
+            min_count = counts.pop(evicted)
+            del self.errors[evicted]
+            counts[item] = min_count + count
+            self.errors[item] = min_count
+
+    def clear(self):
+        self.counts = {}
+        self.errors = {}
+
+    def top(self, k):
+        """ Return the `k` most frequent items as [(item, count), ...], most frequent first. """
+        return sorted(self.counts.iteritems(), key=lambda item_count: (-item_count[1], item_count[0]))[:k]
@@ -0,0 +1,225 @@
+# stdlib
+import logging
+import mmap
+import os
+import cPickle as pickle
+import struct
+import zlib
+
+# 3p
+import simplejson as json
+
+log = logging.getLogger(__name__)
+
+# Disk space used by the queue, past it the oldest segments are dropped
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# A segment is closed and a new one started past this size
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+# Records written between two fsyncs
+DEFAULT_FSYNC_BATCH = 16
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_FILE = 'index.json'
+# Each record is its payload length and crc32, followed by the payload
+RECORD_HEADER = struct.Struct('!II')
+
+
+def _crc32(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+
+def _iter_payloads(buf):
+    """
+    Yield (payload, end offset) of the valid records of a segment, stopping
+    at the first truncated or corrupted one (e.g. a write torn by a crash).
+    """
+    offset = 0
+    size = len(buf)
+    while offset + RECORD_HEADER.size <= size:
+        length, crc = RECORD_HEADER.unpack_from(buf, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if end > size:
+            return
+        payload = buf[start:end]
+        if _crc32(payload) != crc:
+            return
+        yield payload, end
+        offset = end
+
+
+class SpillQueue(object):
+    """
+    A persistent queue of picklable records, kept in append-only segment
+    files under `path` so it uses a constant amount of memory whatever its
+    size on disk.
+
+    Records are appended to the last segment and fsynced every
+    `fsync_batch` records. Segments are read back whole, newest first, with
+    mmap. `index.json` keeps the record count and size of every segment, so
+    reopening the queue only scans the segments that changed since the index
+    was written.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, segment_size=DEFAULT_SEGMENT_SIZE,
+                 fsync_batch=DEFAULT_FSYNC_BATCH):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+
+        # [segment id, record count, size in bytes], oldest first
+        self.segments = []
+        self.record_count = 0
+        self.size = 0
+        # Last segment, open for appending
+        self.active = None
+        self.unsynced = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._open()
+
+    def __len__(self):
+        return self.record_count
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, '%010d%s' % (segment_id, SEGMENT_SUFFIX))
+
+    def _open(self):
+        index = {}
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                index = dict((segment_id, (count, size)) for segment_id, count, size in json.load(f)['segments'])
+        except (IOError, ValueError, KeyError, TypeError):
+            log.debug("No usable spill queue index in %s, scanning the segments", self.path)
+
+        segment_ids = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+        for segment_id in segment_ids:
+            segment_path = self._segment_path(segment_id)
+            file_size = os.path.getsize(segment_path)
+            if segment_id in index and index[segment_id][1] == file_size:
+                count, size = index[segment_id]
+            else:
+                count, size = self._scan(segment_path, file_size)
+            if not count:
+                os.remove(segment_path)
+                continue
+            self.segments.append([segment_id, count, size])
+            self.record_count += count
+            self.size += size
+
+        if self.record_count:
+            log.info("Found %s spilled records (%s bytes) in %s", self.record_count, self.size, self.path)
+        self._write_index()
+
+    def _scan(self, segment_path, file_size):
+        """ Count the valid records of a segment, and cut off a torn tail. """
+        count, size = 0, 0
+        if file_size:
+            with open(segment_path, 'r+b') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for _, size in _iter_payloads(buf):
+                        count += 1
+                finally:
+                    buf.close()
+                if size < file_size:
+                    log.warning("Truncating %s bytes of corrupted records in %s", file_size - size, segment_path)
+                    f.truncate(size)
+        return count, size
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'segments': self.segments}, f)
+        try:
+            os.rename(tmp_path, index_path)
+        except OSError:
+            # Windows doesn't replace existing files
+            os.remove(index_path)
+            os.rename(tmp_path, index_path)
+
+    def _sync(self):
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        self.unsynced = 0
+
+    def _close_active(self):
+        if self.active is not None:
+            self._sync()
+            self.active.close()
+            self.active = None
+
+    def _roll(self):
+        self._close_active()
+        segment_id = self.segments[-1][0] + 1 if self.segments else 0
+        self.active = open(self._segment_path(segment_id), 'ab')
+        self.segments.append([segment_id, 0, 0])
+        self._write_index()
+
+    def put(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        if self.active is None or self.segments[-1][2] >= self.segment_size:
+            self._roll()
+
+        self.active.write(RECORD_HEADER.pack(len(payload), _crc32(payload)))
+        self.active.write(payload)
+        record_size = RECORD_HEADER.size + len(payload)
+        segment = self.segments[-1]
+        segment[1] += 1
+        segment[2] += record_size
+        self.record_count += 1
+        self.size += record_size
+
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_batch:
+            self._sync()
+
+        while self.size > self.max_size and len(self.segments) > 1:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        segment_id, count, size = self.segments.pop(0)
+        os.remove(self._segment_path(segment_id))
+        self.record_count -= count
+        self.size -= size
+        log.warning("Spill queue is full (%s bytes), dropped its %s oldest records", self.max_size, count)
+        self._write_index()
+
+    def next_segment_size(self):
+        """ Size in bytes of the segment `pop_segment` returns next. """
+        return self.segments[-1][2] if self.segments else 0
+
+    def pop_segment(self):
+        """ Remove the newest segment and return its records, oldest first. """
+        if not self.segments:
+            return []
+        segment_id, count, size = self.segments.pop()
+        segment_path = self._segment_path(segment_id)
+        if self.active is not None and self.active.name == segment_path:
+            self._close_active()
+
+        records = []
+        if size:
+            with open(segment_path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for payload, _ in _iter_payloads(buf):
+                        records.append(pickle.loads(payload))
+                finally:
+                    buf.close()
+        os.remove(segment_path)
+
+        self.record_count -= count
+        self.size -= size
+        self._write_index()
+        return records
+
+    def close(self):
+        self._close_active()
+        self._write_index()